@@ -0,0 +1,204 @@
+"""Admission control for the Flask server: bounded queue, deadlines, and priorities.
+
+Each request asks for one of a fixed number of slots before doing its work. Waiting requests are granted slots
+by priority (lower number first), then earliest deadline. A request is rejected right away (Overloaded) if the
+queue is full or it would not get a slot and finish before its deadline, and it is rejected if its deadline
+passes while waiting. Service times are learned per endpoint, and a request that gets its slot with too little
+time left for its normal path is marked degraded so the handler can do something cheaper.
+"""
+
+import itertools
+import math
+import threading
+import time
+
+from metrics import metrics
+
+
+class Overloaded(Exception):
+    """Request was shed, server can't finish it before its deadline."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"server overloaded ({reason}), try again later")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Slot held by an admitted request, released when the 'with' block exits."""
+
+    def __init__(
+        self,
+        scheduler: "RequestScheduler",
+        endpoint: str,
+        priority: int,
+        deadline: float,
+    ):
+        self.scheduler = scheduler
+        self.endpoint = endpoint
+        self.priority = priority
+        self.deadline = deadline
+        # True if there wasn't enough time left for the normal path when the slot was granted
+        self.degraded = False
+        self.started: float = None
+
+    def remaining(self) -> float:
+        """Seconds until deadline."""
+        return self.deadline - time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.scheduler is not None:
+            self.scheduler._release(self)
+
+
+class RequestScheduler:
+    """Grants a fixed number of request slots by priority and deadline."""
+
+    def __init__(
+        self,
+        slots: int = 1,
+        max_queue: int = 16,
+        reserved_slots: int = 0,
+        smoothing: float = 0.3,
+    ):
+        """
+        Args:
+        - slots: Requests that can run at once
+        - max_queue: Max requests waiting for a slot, more are rejected right away
+        - reserved_slots: Slots only priority 0 requests can use, so low priority work can't take all of them
+        - smoothing: Weight of newest duration in each endpoint's service time estimate
+        """
+        self.slots = slots
+        self.max_queue = max_queue
+        self.reserved_slots = reserved_slots
+        self.smoothing = smoothing
+        # (priority, deadline, order, ticket) of each waiting request
+        self.waiting: list[tuple[int, float, int, Ticket]] = []
+        self.running: list[Ticket] = []
+        # (endpoint, degraded) -> smoothed duration in seconds
+        self.estimates: dict[tuple[str, bool], float] = {}
+        self.order = itertools.count()
+        self.changed = threading.Condition()
+
+    def estimate(self, endpoint: str, degraded: bool = False) -> float:
+        """Expected seconds a request to endpoint takes once admitted, 0 if not known yet."""
+        with self.changed:
+            return self.estimates.get((endpoint, degraded), 0.0)
+
+    def _update_metrics(self):
+        metrics.set("admission_queue_depth", len(self.waiting))
+        metrics.set("admission_running", len(self.running))
+
+    def _shed(self, reason: str, retry_after: float):
+        metrics.increment("admission_shed")
+        metrics.increment(f"admission_shed_{reason}")
+        raise Overloaded(reason, retry_after)
+
+    def _predicted_wait(self, key: tuple) -> float:
+        """Seconds until a request with key (priority, deadline, order) would get a slot. Must hold lock."""
+        now = time.time()
+        running_left = sum(
+            max(
+                0.0,
+                self.estimates.get((t.endpoint, t.degraded), 0.0) - (now - t.started),
+            )
+            for t in self.running
+        )
+        ahead = sum(
+            self.estimates.get((entry[3].endpoint, False), 0.0)
+            for entry in self.waiting
+            if entry[:3] < key
+        )
+        return (running_left + ahead) / self.slots
+
+    def _can_run(self, ticket: Ticket) -> bool:
+        """True if a slot is free for ticket's priority. Must hold lock."""
+        if len(self.running) >= self.slots:
+            return False
+        if ticket.priority == 0:
+            return True
+        low_priority_running = sum(1 for t in self.running if t.priority != 0)
+        return low_priority_running < self.slots - self.reserved_slots
+
+    def _next_runnable(self) -> Ticket:
+        """First waiting ticket (by priority and deadline) that a slot is free for. Must hold lock."""
+        for entry in sorted(self.waiting):
+            if self._can_run(entry[3]):
+                return entry[3]
+        return None
+
+    def admit(
+        self, endpoint: str, priority: int, deadline: float, can_degrade: bool = False
+    ) -> Ticket:
+        """Wait for a slot, use the returned ticket in a 'with' block to release it.
+
+        Args:
+        - endpoint: Name used to learn service times (e.g. request path)
+        - priority: 0 is the highest
+        - deadline: time.time() by which the request must finish
+        - can_degrade: Endpoint has a cheaper path, so only that needs to fit before the deadline
+
+        Raises:
+        - Overloaded: Queue is full, request can't finish before deadline, or deadline passed while waiting
+        """
+        ticket = Ticket(self, endpoint, priority, deadline)
+        with self.changed:
+            if len(self.waiting) >= self.max_queue:
+                self._shed("queue_full", self._predicted_wait((math.inf,)))
+
+            key = (priority, deadline, next(self.order))
+            wait = self._predicted_wait(key)
+            # Cheapest way to serve it, a degraded path not seen yet is assumed to fit
+            cost = self.estimates.get((endpoint, can_degrade), 0.0)
+            if time.time() + wait + cost > deadline:
+                self._shed("deadline", wait)
+
+            entry = (*key, ticket)
+            self.waiting.append(entry)
+            self._update_metrics()
+            while self._next_runnable() is not ticket:
+                timeout = deadline - time.time()
+                if timeout <= 0 or not self.changed.wait(timeout):
+                    if self._next_runnable() is ticket:
+                        break
+                    self.waiting.remove(entry)
+                    self._update_metrics()
+                    # Another waiter may be runnable now that this one left
+                    self.changed.notify_all()
+                    self._shed("expired", self._predicted_wait((math.inf,)))
+
+            self.waiting.remove(entry)
+            ticket.started = time.time()
+            full_cost = self.estimates.get((endpoint, False), 0.0)
+            ticket.degraded = can_degrade and ticket.started + full_cost > deadline
+            self.running.append(ticket)
+            self._update_metrics()
+            # Another slot may still be free for the next waiter
+            self.changed.notify_all()
+
+        metrics.increment("admission_admitted")
+        if ticket.degraded:
+            metrics.increment("admission_degraded")
+        return ticket
+
+    def _release(self, ticket: Ticket):
+        duration = time.time() - ticket.started
+        with self.changed:
+            key = (ticket.endpoint, ticket.degraded)
+            previous = self.estimates.get(key)
+            self.estimates[key] = (
+                duration
+                if previous is None
+                else self.smoothing * duration + (1 - self.smoothing) * previous
+            )
+            self.running.remove(ticket)
+            self._update_metrics()
+            self.changed.notify_all()
+
+
+def no_admission() -> Ticket:
+    """Ticket that doesn't hold a slot, for when admission control is off."""
+    return Ticket(None, "", 0, math.inf)
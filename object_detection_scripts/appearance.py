@@ -0,0 +1,256 @@
+"""Appearance memory: what each instruction object looked like in the operator's photo, so user mode can find it
+again by feature matching before running GroundingDINO.
+
+When the operator flow finds an object, a crop around its box and the crop's ORB keypoints and descriptors are
+saved (one .npz and one .jpg per instruction object, next to but separate from the parser output file). In user
+mode, the object's descriptors are matched against the frame (ratio test), and a RANSAC homography maps the box
+into the frame. The match is used only if enough matches are geometrically consistent, else detection runs.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from object_detection import Candidate
+
+APPEARANCE_DIR = "appearance_memory"
+# Frames are matched at most this size (longest side), ORB's scale pyramid covers the difference
+MAX_FRAME_SIDE = 1280
+
+
+class Appearance(NamedTuple):
+    # (N, 2) keypoint positions in crop pixels
+    keypoints: np.ndarray
+    # (N, 32) ORB descriptors
+    descriptors: np.ndarray
+    # (x1, y1, x2, y2) of the object box in crop pixels
+    box: np.ndarray
+
+
+class AppearanceMemory:
+    """ORB features of instruction objects found by the operator, stored in directory."""
+
+    def __init__(
+        self,
+        directory: str = APPEARANCE_DIR,
+        min_inliers: int = 15,
+        min_inlier_ratio: float = 0.4,
+        ratio: float = 0.75,
+        features: int = 500,
+        padding: float = 0.15,
+    ):
+        """
+        Args:
+        - directory: Where appearances are saved
+        - min_inliers: Min matches consistent with the homography for a match to be used
+        - min_inlier_ratio: Min fraction of ratio-test matches that are consistent with the homography
+        - ratio: Lowe's ratio test, best match must be closer than ratio times the second best
+        - features: Max ORB keypoints per image
+        - padding: Crop is the box grown by this fraction of its size on each side, for texture around the
+          object (e.g. the panel around a button)
+        """
+        self.directory = directory
+        self.min_inliers = min_inliers
+        self.min_inlier_ratio = min_inlier_ratio
+        self.ratio = ratio
+        self.features = features
+        self.padding = padding
+        # Path -> loaded appearance, None if there is none
+        self.cache: dict[str, Appearance] = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, instruction_num: int, object_prompt: str) -> str:
+        """Path of an instruction object's appearance, without extension."""
+        digest = hashlib.sha1(object_prompt.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, f"{instruction_num}_{digest}")
+
+    def _features(self, gray: np.ndarray) -> tuple[list, np.ndarray]:
+        # ORB objects aren't shared between threads
+        orb = cv2.ORB_create(self.features)
+        return orb.detectAndCompute(gray, None)
+
+    def remember(
+        self,
+        image_path: str,
+        box: tuple[float, float, float, float],
+        instruction_num: int,
+        object_prompt: str,
+    ) -> bool:
+        """Save appearance of object found at box (x1, y1, x2, y2) in image.
+
+        Returns:
+        - False if the crop doesn't have enough keypoints to be matched (nothing is saved)
+        """
+        # Orientation isn't applied, boxes are in the pixels as stored (same as PIL decodes for detection)
+        image = cv2.imread(
+            image_path, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+        if image is None:
+            return False
+        height, width = image.shape
+        x1, y1, x2, y2 = box
+        pad_x, pad_y = (x2 - x1) * self.padding, (y2 - y1) * self.padding
+        left, top = max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y))
+        right = min(width, int(x2 + pad_x) + 1)
+        bottom = min(height, int(y2 + pad_y) + 1)
+        crop = image[top:bottom, left:right]
+        if crop.size == 0:
+            return False
+
+        keypoints, descriptors = self._features(crop)
+        if descriptors is None or len(keypoints) < self.min_inliers:
+            print(f"Appearance of '{object_prompt}' not saved, too little texture")
+            return False
+        appearance = Appearance(
+            np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32),
+            descriptors,
+            np.array([x1 - left, y1 - top, x2 - left, y2 - top], dtype=np.float32),
+        )
+        path = self.path(instruction_num, object_prompt)
+        np.savez(path + ".npz", **appearance._asdict())
+        cv2.imwrite(path + ".jpg", crop)
+        with self.lock:
+            self.cache[path] = appearance
+        metrics.increment("appearance_saved")
+        return True
+
+    def _load(self, path: str) -> Appearance:
+        with self.lock:
+            if path in self.cache:
+                return self.cache[path]
+        appearance = None
+        if os.path.exists(path + ".npz"):
+            with np.load(path + ".npz") as data:
+                appearance = Appearance(*(data[field] for field in Appearance._fields))
+        with self.lock:
+            self.cache[path] = appearance
+        return appearance
+
+    def locate(
+        self, image_path: str, instruction_num: int, object_prompt: str
+    ) -> Candidate:
+        """Find instruction object in image by matching its saved appearance.
+
+        Returns:
+        - Object box in image pixels (confidence is the fraction of matches that are inliers), None if there is
+          no saved appearance or the match is weak
+        """
+        appearance = self._load(self.path(instruction_num, object_prompt))
+        if appearance is None:
+            return None
+        begin = time.time()
+        frame = cv2.imread(
+            image_path, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+        if frame is None:
+            return None
+        scale = min(1.0, MAX_FRAME_SIDE / max(frame.shape))
+        if scale < 1.0:
+            frame = cv2.resize(
+                frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+
+        candidate = None
+        keypoints, descriptors = self._features(frame)
+        if descriptors is not None and len(keypoints) >= self.min_inliers:
+            pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(
+                appearance.descriptors, descriptors, k=2
+            )
+            good = [
+                pair[0]
+                for pair in pairs
+                if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance
+            ]
+            if len(good) >= self.min_inliers:
+                candidate = self._verify(
+                    appearance, keypoints, good, scale, frame.shape, object_prompt
+                )
+
+        metrics.increment("appearance_seconds", time.time() - begin)
+        if candidate is not None:
+            metrics.increment("appearance_hits")
+            print(f"Appearance matched: {candidate}")
+        else:
+            metrics.increment("appearance_misses")
+        return candidate
+
+    def _verify(
+        self,
+        appearance: Appearance,
+        keypoints: list,
+        matches: list,
+        scale: float,
+        frame_shape: tuple[int, int],
+        object_prompt: str,
+    ) -> Candidate:
+        """Box from a RANSAC homography of the matches, None if too few inliers or the box is implausible."""
+        source = appearance.keypoints[[match.queryIdx for match in matches]]
+        target = np.float32([keypoints[match.trainIdx].pt for match in matches])
+        homography, inlier_mask = cv2.findHomography(source, target, cv2.RANSAC, 5.0)
+        if homography is None:
+            return None
+        inliers = int(inlier_mask.sum())
+        inlier_ratio = inliers / len(matches)
+        if inliers < self.min_inliers or inlier_ratio < self.min_inlier_ratio:
+            return None
+
+        x1, y1, x2, y2 = appearance.box
+        corners = np.float32([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
+        projected = cv2.perspectiveTransform(
+            corners.reshape(-1, 1, 2), homography
+        ).reshape(-1, 2)
+        # Mirrored or folded box means the homography is degenerate
+        orientation = cv2.contourArea(corners, oriented=True)
+        projected_orientation = cv2.contourArea(projected, oriented=True)
+        if orientation * projected_orientation <= 0 or not cv2.isContourConvex(
+            projected
+        ):
+            return None
+        height, width = frame_shape
+        center = projected.mean(axis=0)
+        if not (0 <= center[0] < width and 0 <= center[1] < height):
+            return None
+
+        center /= scale
+        projected /= scale
+        (left, top), (right, bottom) = projected.min(axis=0), projected.max(axis=0)
+        return Candidate(
+            (round(float(center[0]), 1), round(float(center[1]), 1)),
+            (
+                round(float(left), 1),
+                round(float(top), 1),
+                round(float(right), 1),
+                round(float(bottom), 1),
+            ),
+            round(inlier_ratio, 3),
+            object_prompt,
+        )
+
+    def forget(self, instruction_nums: list[int], saved_before: float):
+        """Forget appearances of instructions saved before time saved_before (e.g. by an earlier parse of them)."""
+        prefixes = tuple(f"{num}_" for num in set(instruction_nums))
+        with self.lock:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if (
+                    name.startswith(prefixes)
+                    and name.endswith((".npz", ".jpg"))
+                    and os.path.getmtime(path) < saved_before
+                ):
+                    os.remove(path)
+                    self.cache.pop(os.path.splitext(path)[0], None)
+
+    def clear(self):
+        """Forget every appearance (e.g. parsed instructions were cleared)."""
+        with self.lock:
+            self.cache.clear()
+            for name in os.listdir(self.directory):
+                if name.endswith((".npz", ".jpg")):
+                    os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,161 @@
+"""Bounded store for debug artifacts (detection plots, crops sent to GPT) saved during requests.
+
+Artifacts are saved as <root>/<request_id>/<name>. A request's directory is only created when the request is
+sampled (1 in every sample_every requests), so unsampled requests skip drawing entirely. The directory on disk
+is the source of truth, so model worker processes can share one store root.
+"""
+
+import itertools
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from werkzeug.utils import secure_filename
+
+
+class ArtifactStore:
+    """Saves artifacts per request and evicts the oldest by total size, count, and age."""
+
+    def __init__(
+        self,
+        root: str = "artifacts",
+        max_bytes: int = 500 * 1024 * 1024,
+        max_count: int = 1000,
+        max_age: float = 24 * 60 * 60,
+        sample_every: int = 1,
+        evict_interval: float = 1,
+    ):
+        """
+        Args:
+        - root: Directory artifacts are saved in
+        - max_bytes: Max total size of all artifacts
+        - max_count: Max number of artifact files
+        - max_age: Seconds after which artifacts are removed
+        - sample_every: Keep artifacts for 1 in every sample_every requests (1 keeps all, 0 keeps none)
+        - evict_interval: Min seconds between eviction passes
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_age = max_age
+        self.sample_every = sample_every
+        self.evict_interval = evict_interval
+        self.request_count = itertools.count()
+        self.last_evict = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def new_request_id(self) -> str:
+        """Make unique ID for a request, and decide whether its artifacts are kept (sampled)."""
+        timestamp = datetime.now().strftime("%m-%d_%H-%M-%S")
+        request_id = f"{timestamp}_{uuid.uuid4().hex[:8]}"
+        count = next(self.request_count)
+        if self.sample_every > 0 and count % self.sample_every == 0:
+            os.makedirs(os.path.join(self.root, request_id), exist_ok=True)
+        return request_id
+
+    def _request_dir(self, request_id: str) -> str:
+        """Directory for request's artifacts, None if request_id is invalid."""
+        if not request_id or secure_filename(request_id) != request_id:
+            return None
+        return os.path.join(self.root, request_id)
+
+    def is_kept(self, request_id: str) -> bool:
+        """True if request was sampled (and hasn't been evicted), so its artifacts should be saved."""
+        request_dir = self._request_dir(request_id)
+        return request_dir is not None and os.path.isdir(request_dir)
+
+    def artifact_path(self, request_id: str, name: str) -> str:
+        """Path to save artifact 'name' of request to, None if the request's artifacts aren't kept."""
+        if not self.is_kept(request_id):
+            return None
+        return os.path.join(self._request_dir(request_id), secure_filename(name))
+
+    def add_file(self, request_id: str, name: str, filepath: str) -> bool:
+        """Move existing file into the store as artifact 'name' of request.
+
+        Returns:
+        - True if the file was moved, False if the request's artifacts aren't kept (file is left alone)
+        """
+        path = self.artifact_path(request_id, name)
+        if path is None or not os.path.exists(filepath):
+            return False
+        shutil.move(filepath, path)
+        self.saved()
+        return True
+
+    def saved(self):
+        """Called after an artifact is written, evicts old artifacts if it's been evict_interval since last time."""
+        with self.lock:
+            now = time.time()
+            if now - self.last_evict < self.evict_interval:
+                return
+            self.last_evict = now
+        self.evict()
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        """All artifact files as (modified time, size, path)."""
+        files = []
+        with os.scandir(self.root) as request_dirs:
+            for request_dir in request_dirs:
+                if not request_dir.is_dir():
+                    continue
+                with os.scandir(request_dir.path) as artifacts:
+                    for artifact in artifacts:
+                        try:
+                            stat = artifact.stat()
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, artifact.path))
+        return files
+
+    def evict(self):
+        """Remove artifacts older than max_age, then oldest ones until under max_count and max_bytes."""
+        files = sorted(self._scan())
+        total_bytes = sum(size for _, size, _ in files)
+        count = len(files)
+        oldest_allowed = time.time() - self.max_age
+
+        for mtime, size, path in files:
+            if (
+                mtime >= oldest_allowed
+                and count <= self.max_count
+                and total_bytes <= self.max_bytes
+            ):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            count -= 1
+            total_bytes -= size
+
+        # Remove empty request directories, except recent ones that may still be getting artifacts
+        with os.scandir(self.root) as request_dirs:
+            for request_dir in request_dirs:
+                if not request_dir.is_dir():
+                    continue
+                try:
+                    is_empty = len(os.listdir(request_dir.path)) == 0
+                    if request_dir.stat().st_mtime < oldest_allowed or (
+                        is_empty and time.time() - request_dir.stat().st_mtime > 60
+                    ):
+                        shutil.rmtree(request_dir.path, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+
+    def list_artifacts(self, request_id: str) -> list[str]:
+        """Names of artifacts saved for request."""
+        if not self.is_kept(request_id):
+            return []
+        return sorted(os.listdir(self._request_dir(request_id)))
+
+    def get_artifact_path(self, request_id: str, name: str) -> str:
+        """Path of existing artifact, None if it doesn't exist."""
+        path = self.artifact_path(request_id, name)
+        if path is None or not os.path.isfile(path):
+            return None
+        return path
@@ -0,0 +1,452 @@
+"""Async (ASGI) version of server.py exposing the same endpoints and JSON responses.
+
+GPT-4V calls are awaited on the event loop, so many '/parse_instruction' requests can wait on the LLM at once
+without holding a thread each. Object detection is CPU/GPU-bound, so it is dispatched to a bounded executor.
+
+Run with: hypercorn async_server:app --bind 0.0.0.0:5000
+"""
+
+import asyncio
+import json
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from quart import Quart, request, websocket
+from artifact_store import ArtifactStore
+from object_detection import (
+    ObjectDetection,
+    ObjectDetectionInterface,
+    DetectionException,
+)
+from instruction_parser import parse_instruction_async
+from task_guidance import (
+    delete_images,
+    detect_objects_from_json,
+    instruction_gpt_calls_async,
+    get_instructions_from_file,
+    parse_coordinates,
+    updated_instructions,
+)
+from werkzeug.exceptions import BadRequest
+from werkzeug.utils import secure_filename
+
+
+app = Quart(__name__)
+# Debug artifacts saved per request, same settings as server.py
+app.config["ARTIFACT_ROOT"] = "artifacts"
+app.config["ARTIFACT_MAX_BYTES"] = 500 * 1024 * 1024
+app.config["ARTIFACT_MAX_COUNT"] = 1000
+app.config["ARTIFACT_MAX_AGE"] = 24 * 60 * 60
+app.config["ARTIFACT_SAMPLE_EVERY"] = 1
+app.config["ARTIFACTS"] = ArtifactStore(
+    app.config["ARTIFACT_ROOT"],
+    app.config["ARTIFACT_MAX_BYTES"],
+    app.config["ARTIFACT_MAX_COUNT"],
+    app.config["ARTIFACT_MAX_AGE"],
+    app.config["ARTIFACT_SAMPLE_EVERY"],
+)
+artifacts: ArtifactStore = app.config["ARTIFACTS"]
+app.config["DETECTOR"] = ObjectDetectionInterface(
+    ObjectDetection(artifact_store=artifacts)
+)
+detector: ObjectDetectionInterface = app.config["DETECTOR"]
+# Run object detection once on test image since first takes way longer (caching)
+detector.prime_detection_with_test()
+# Configure other app config data
+app.config["CROP_THRESHOLD"] = 0.2
+app.config["OBJECT_THRESHOLD"] = 0.2
+# Max 'topK' candidate boxes a detection request can ask for
+app.config["MAX_TOP_K"] = 10
+# Number of threads running detection. The detector holds per-detection state, so only one by default.
+app.config["DETECTION_WORKERS"] = 1
+# Max number of detection calls waiting for or running in the executor before new ones wait on the event loop
+app.config["DETECTION_QUEUE_LIMIT"] = 8
+# Max bytes of one '/stream' frame message
+app.config["STREAM_MAX_FRAME_BYTES"] = 16 * 1024 * 1024
+# Structure to hold instructions input in 'instructions.txt'
+app.config["INSTRUCTIONS"] = []
+instructions: list[str] = app.config["INSTRUCTIONS"]
+# Flag to determine whether to update instructions
+app.config["UPDATE"] = False
+
+
+class DetectionExecutor:
+    """Bounded executor for blocking detection work called from the event loop."""
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="detection"
+        )
+        # Limits how much detection work can be queued in the executor at once
+        self.slots = asyncio.Semaphore(queue_limit)
+
+    async def __call__(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on a detection thread and await its result."""
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, partial(func, *args, **kwargs)
+            )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+@app.before_serving
+async def create_executor():
+    """Executor and output lock must be created inside the server's event loop (for their semaphore/lock)."""
+    app.config["EXECUTOR"] = DetectionExecutor(
+        app.config["DETECTION_WORKERS"], app.config["DETECTION_QUEUE_LIMIT"]
+    )
+    # Parse requests read and write 'parser_output.json' (and updated_instructions) one at a time
+    app.config["OUTPUT_LOCK"] = asyncio.Lock()
+
+
+@app.after_serving
+async def shutdown_executor():
+    app.config["EXECUTOR"].shutdown()
+
+
+@app.after_request
+async def print_response(response):
+    """Called after request finishes, simply prints results."""
+    print(await response.get_data(as_text=True))
+    print(response.status_code)
+    return response
+
+
+@app.errorhandler(Exception)
+async def handle_exception(e):
+    return {"error": f"{type(e).__name__}: {e}"}, 500
+
+
+@app.errorhandler(BadRequest)
+async def handle_bad_request(e: BadRequest):
+    """Invalid request field, e.g. a topK that isn't an integer."""
+    return {"error": e.description}, 400
+
+
+def request_top_k(form) -> int:
+    """Candidate boxes requested ('topK' field of form), 0 if none, at most MAX_TOP_K."""
+    top_k = form.get("topK", "0")
+    try:
+        top_k = int(top_k)
+    except ValueError:
+        raise BadRequest(f"topK '{top_k}' is not an integer")
+    return max(0, min(top_k, app.config["MAX_TOP_K"]))
+
+
+async def save_image_from_request() -> str:
+    """Checks and saves image from HTTP post request.
+
+    Returns: filepath string of image
+    """
+    HEADER = "image"
+    files = await request.files
+
+    # Check if file header exists in request
+    if HEADER not in files:
+        raise DetectionException(
+            f"the file header {HEADER} does not exist in the request"
+        )
+
+    image = files[HEADER]
+
+    # Check if file in request is valid
+    if not image:
+        raise DetectionException("the file in the request was not valid")
+
+    now = datetime.now()
+    timestamp = now.strftime("%m-%d_%H-%M-%S")
+
+    # Unique even if headsets send the same filename in the same second
+    filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{secure_filename(image.filename)}"
+    await image.save(filename)
+
+    return filename
+
+
+@app.route("/upload_image", methods=["POST"])
+async def upload_image():
+    """Endpoint for server to send an image and run object detection on it.
+
+    Returns:
+    - Sends back response containing center (x, y) of detected object and action to perform
+    - With 'topK' field, also 'candidates' boxes, see server.py upload_image
+    """
+    request_begin = time.time()
+    request_id = artifacts.new_request_id()
+    filepath = await save_image_from_request()
+    try:
+        form = await request.form
+        instruction_num: int = int(form["instructionNum"])
+        picture_num: int = int(form["pictureNum"])
+        # Optional hints, see server.py upload_image
+        roi = parse_coordinates(form.get("roi"), "roi", 4)
+        previous_center = parse_coordinates(
+            form.get("previousCenter"), "previousCenter", 2
+        )
+        top_k = request_top_k(form)
+        candidates = []
+        found_center, action = await app.config["EXECUTOR"](
+            detect_objects_from_json,
+            detector,
+            filepath,
+            app.config["CROP_THRESHOLD"],
+            app.config["OBJECT_THRESHOLD"],
+            instruction_num,
+            picture_num,
+            request_id,
+            roi,
+            previous_center,
+            top_k=top_k,
+            candidates=candidates,
+        )
+    finally:
+        delete_images(filepath)
+
+    detector_response = {
+        "center": found_center,
+        "action": action,
+        "requestId": request_id,
+    }
+    if top_k > 0:
+        detector_response["candidates"] = [
+            candidate._asdict() for candidate in candidates
+        ]
+    print(f"Request time: {time.time() - request_begin} s")
+    return detector_response
+
+
+@app.route("/test_hello", methods=["GET"])
+async def test_hello():
+    """Simple request for testing."""
+    return {"test": "hello"}
+
+
+@app.route("/parse_instruction", methods=["POST"])
+async def instruction_to_json():
+    """Parse instruction. Must call 'get_instructions' endpoint first.
+
+    Adds output to 'parser_output.json' file. If successful, returns object center and action.
+    """
+    request_begin = time.time()
+    request_id = artifacts.new_request_id()
+    filepath = await save_image_from_request()
+    try:
+        form = await request.form
+        instruction_num: int = int(form["instructionNum"])
+        # Output will be written to parser_output.json
+        found_center, action = await instruction_gpt_calls_async(
+            detector,
+            instructions,
+            instruction_num,
+            app.config["CROP_THRESHOLD"],
+            app.config["OBJECT_THRESHOLD"],
+            filepath,
+            app.config["UPDATE"],
+            parse=parse_instruction_async,
+            run_blocking=app.config["EXECUTOR"],
+            request_id=request_id,
+            output_lock=app.config["OUTPUT_LOCK"],
+        )
+    finally:
+        delete_images(filepath)
+
+    detector_response = {
+        "center": found_center,
+        "action": action,
+        "requestId": request_id,
+    }
+    print(f"Request time: {time.time() - request_begin} s")
+    return detector_response
+
+
+# Big-endian uint32 length of JSON header at start of each '/stream' frame message
+FRAME_HEADER_SIZE = struct.Struct(">I")
+
+
+def decode_frame_message(message: bytes) -> tuple[dict, bytes]:
+    """Split '/stream' frame message into JSON header and JPEG bytes."""
+    if len(message) < FRAME_HEADER_SIZE.size:
+        raise DetectionException("frame message is too short")
+    (header_size,) = FRAME_HEADER_SIZE.unpack_from(message)
+    header_end = FRAME_HEADER_SIZE.size + header_size
+    if header_end > len(message):
+        raise DetectionException("frame header is longer than the message")
+    header = json.loads(message[FRAME_HEADER_SIZE.size : header_end])
+    if not isinstance(header, dict):
+        raise DetectionException("frame header must be a JSON object")
+    return header, message[header_end:]
+
+
+def detect_on_frame(
+    jpeg: bytes,
+    instruction_num: int,
+    picture_num: int,
+    roi: tuple[float, float, float, float] = None,
+    previous_center: tuple[float, float] = None,
+) -> tuple[tuple[float, float], str]:
+    """Save frame to a file and run detection on it (runs on a detection thread)."""
+    filepath = f"stream_frame_{uuid.uuid4().hex[:8]}.jpg"
+    with open(filepath, "wb") as file:
+        file.write(jpeg)
+    try:
+        return detect_objects_from_json(
+            detector,
+            filepath,
+            app.config["CROP_THRESHOLD"],
+            app.config["OBJECT_THRESHOLD"],
+            instruction_num,
+            picture_num,
+            roi=roi,
+            previous_center=previous_center,
+        )
+    finally:
+        delete_images(filepath)
+
+
+class LatestFrame:
+    """Holds only the newest frame not yet processed, a new frame replaces (drops) an older waiting one."""
+
+    def __init__(self):
+        self.frame: tuple[dict, bytes, float] = None
+        self.available = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, header: dict, jpeg: bytes):
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = (header, jpeg, time.time())
+        self.available.set()
+
+    def close(self):
+        """No more frames will arrive, wakes up take."""
+        self.closed = True
+        self.available.set()
+
+    async def take(self) -> tuple[dict, bytes, float]:
+        """Wait for a frame and take it, returns (header, JPEG bytes, time received), or None once closed."""
+        # Connection is gone, so a pending frame's result couldn't be sent anyway
+        if self.closed:
+            return None
+        await self.available.wait()
+        self.available.clear()
+        if self.closed:
+            return None
+        frame = self.frame
+        self.frame = None
+        return frame
+
+
+@app.websocket("/stream")
+async def stream_frames():
+    """Continuous guidance for one headset session over a WebSocket.
+
+    Client sends binary messages: 4-byte big-endian header length, JSON header, then JPEG bytes. Header has
+    'instructionNum', 'pictureNum', optional 'frameId' (echoed back), and optional 'roi' [x1, y1, x2, y2] and
+    'previousCenter' [x, y] hints (see '/upload_image'). Only the newest frame is processed, frames arriving
+    while detection runs replace each other, so queueing is bounded to one frame.
+
+    Server sends a JSON text message per processed frame: 'frameId', 'instructionNum', 'pictureNum', 'center',
+    'action', 'latency' (seconds from receiving the frame), and 'dropped' (frames skipped so far), or 'error'.
+    """
+    latest = LatestFrame()
+
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if not isinstance(message, bytes):
+                    await websocket.send_json(
+                        {"error": "frames must be binary messages"}
+                    )
+                    continue
+                if len(message) > app.config["STREAM_MAX_FRAME_BYTES"]:
+                    await websocket.send_json({"error": "frame is too large"})
+                    continue
+                try:
+                    header, jpeg = decode_frame_message(message)
+                except (DetectionException, ValueError) as e:
+                    await websocket.send_json({"error": f"invalid frame: {e}"})
+                    continue
+                latest.put(header, jpeg)
+        finally:
+            # Wakes up the processing loop so it stops too
+            latest.close()
+
+    receiver = asyncio.ensure_future(receive_frames())
+    try:
+        while True:
+            frame = await latest.take()
+            if frame is None:
+                break
+            header, jpeg, received = frame
+            frame_id = header.get("frameId")
+            try:
+                instruction_num = int(header["instructionNum"])
+                picture_num = int(header["pictureNum"])
+                found_center, action = await app.config["EXECUTOR"](
+                    detect_on_frame,
+                    jpeg,
+                    instruction_num,
+                    picture_num,
+                    parse_coordinates(header.get("roi"), "roi", 4),
+                    parse_coordinates(
+                        header.get("previousCenter"), "previousCenter", 2
+                    ),
+                )
+            except Exception as e:
+                await websocket.send_json(
+                    {"frameId": frame_id, "error": f"{type(e).__name__}: {e}"}
+                )
+                continue
+            await websocket.send_json(
+                {
+                    "frameId": frame_id,
+                    "instructionNum": instruction_num,
+                    "pictureNum": picture_num,
+                    "center": found_center,
+                    "action": action,
+                    "latency": time.time() - received,
+                    "dropped": latest.dropped,
+                }
+            )
+    finally:
+        # Connection closed (receive or send raised), stop reading frames
+        receiver.cancel()
+
+
+@app.route("/update_instructions", methods=["GET"])
+async def update_instructions():
+    """Get list of instructions from 'instructions.txt' and add to instructions list."""
+    app.config["UPDATE"] = True
+    updated_instructions.clear()
+    return await get_instructions()
+
+
+@app.route("/get_instructions", methods=["GET"])
+async def get_instructions(clear_output: bool = False):
+    """Get list of instructions from 'instructions.txt' and add to instructions list."""
+    instructions.clear()
+    instructions.extend(get_instructions_from_file(clear_output))
+    return instructions
+
+
+@app.route("/new_instructions", methods=["GET"])
+async def new_instructions():
+    """Get new instructions and clear old outputs (clears parser JSON file).
+
+    Clearing the JSON output file means that the operator phase must occur again.
+    """
+    app.config["UPDATE"] = False
+    return await get_instructions(clear_output=True)
+
+
+# Run server (for production use hypercorn, see module docstring)
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", debug=False, use_reloader=False)
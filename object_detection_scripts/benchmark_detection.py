@@ -0,0 +1,190 @@
+"""Benchmark latency and accuracy of detection modes against each other on the same cases.
+
+Modes:
+- two_pass: run_object_detection_with_crop as used by the server (second pass re-encodes the crop)
+- reuse_features: second pass ROI-aligns the first pass's backbone features instead (experimental)
+- reduced_queries: two_pass with --num-queries decoder queries and --top-k boxes thresholded per pass
+
+Cases file is the same as threshold_sweep.py's, a JSON list of {"image": path, "prompt": str, "expected":
+[x1, y1, x2, y2] (optional)}. A mode's center is correct if it is inside the expected box, or for cases without
+one, within --center-tolerance pixels of the two_pass center. data/detection_cases.json labels one object in
+each of the data/*.jpg pictures.
+
+Example: python benchmark_detection.py data/detection_cases.json --modes two_pass reduced_queries --repeat 3
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+
+from object_detection import ObjectDetectionInterface
+from replay import percentile
+
+# Decoder queries and max thresholded boxes per image of reduced_queries mode
+REDUCED_NUM_QUERIES = 300
+REDUCED_TOP_K = 10
+
+
+def run_with_crop(
+    detector: ObjectDetectionInterface, case: dict, thresholds: tuple[float, float]
+) -> tuple[float, float]:
+    """Center in original image pixels found by two-pass detection, None if not found."""
+    center, top_left_coord, cropped_image_path = (
+        detector.run_object_detection_with_crop(
+            case["image"], case["prompt"], *thresholds
+        )
+    )
+    if cropped_image_path is not None and os.path.exists(cropped_image_path):
+        os.remove(cropped_image_path)
+    if center is None:
+        return None
+    return top_left_coord[0] + center[0], top_left_coord[1] + center[1]
+
+
+def two_pass(detector: ObjectDetectionInterface, case: dict, thresholds):
+    detector.reuse_features = False
+    return run_with_crop(detector, case, thresholds)
+
+
+def reuse_features(detector: ObjectDetectionInterface, case: dict, thresholds):
+    detector.reuse_features = True
+    try:
+        return run_with_crop(detector, case, thresholds)
+    finally:
+        detector.reuse_features = False
+
+
+def reduced_queries(detector: ObjectDetectionInterface, case: dict, thresholds):
+    model_detector = detector.detector
+    num_queries, top_k = model_detector.num_queries, model_detector.top_k
+    model_detector.set_num_queries(REDUCED_NUM_QUERIES)
+    model_detector.top_k = REDUCED_TOP_K
+    try:
+        return two_pass(detector, case, thresholds)
+    finally:
+        model_detector.set_num_queries(num_queries)
+        model_detector.top_k = top_k
+
+
+# Name -> mode(detector, case, (first threshold, second threshold)) -> center
+MODES = {
+    "two_pass": two_pass,
+    "reuse_features": reuse_features,
+    "reduced_queries": reduced_queries,
+}
+
+
+def is_correct(center, expected, reference, center_tolerance: float) -> bool:
+    if center is None:
+        return False
+    if expected is not None:
+        x1, y1, x2, y2 = expected
+        return x1 <= center[0] <= x2 and y1 <= center[1] <= y2
+    return reference is not None and math.dist(center, reference) <= center_tolerance
+
+
+def benchmark(
+    detector: ObjectDetectionInterface,
+    cases: list[dict],
+    modes: list[str],
+    thresholds: tuple[float, float],
+    repeat: int = 1,
+    center_tolerance: float = 10.0,
+) -> dict[str, dict]:
+    """Run every mode on every case (repeat times, after one warm-up detection per mode).
+
+    Returns:
+    - Per mode: latencies (s) of every run, center found for each case
+    """
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, got {repeat}")
+    if len(cases) == 0:
+        raise ValueError("no cases to benchmark")
+    for mode in modes:
+        MODES[mode](detector, cases[0], thresholds)
+
+    results = {mode: {"latencies": [], "centers": []} for mode in modes}
+    for case in cases:
+        for mode in modes:
+            for i in range(repeat):
+                begin = time.time()
+                center = MODES[mode](detector, case, thresholds)
+                results[mode]["latencies"].append(time.time() - begin)
+            results[mode]["centers"].append(center)
+
+    # Unlabeled cases are checked against the current (two pass) result
+    references = (
+        results["two_pass"]["centers"] if "two_pass" in results else [None] * len(cases)
+    )
+    for result in results.values():
+        result["detectionRate"] = sum(
+            center is not None for center in result["centers"]
+        ) / len(cases)
+        result["accuracy"] = sum(
+            is_correct(center, case.get("expected"), reference, center_tolerance)
+            for center, case, reference in zip(result["centers"], cases, references)
+        ) / len(cases)
+    return results
+
+
+def print_report(results: dict[str, dict]):
+    print(
+        f"{'mode':<20}{'mean':>10}{'p50':>10}{'p95':>10}{'detected':>10}{'accuracy':>10}"
+    )
+    for mode, result in results.items():
+        latencies = result["latencies"]
+        print(
+            f"{mode:<20}{sum(latencies) / len(latencies):>10.3f}"
+            f"{percentile(latencies, 0.5):>10.3f}{percentile(latencies, 0.95):>10.3f}"
+            f"{result['detectionRate']:>10.3f}{result['accuracy']:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", help="JSON file of cases")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs=2,
+        default=(0.2, 0.2),
+        help="First (cropping) and second pass box thresholds",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--num-queries",
+        type=int,
+        default=REDUCED_NUM_QUERIES,
+        help="Decoder queries per image of reduced_queries mode",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=REDUCED_TOP_K,
+        help="Max boxes per image thresholded in reduced_queries mode",
+    )
+    parser.add_argument("--center-tolerance", type=float, default=10.0)
+    parser.add_argument("--output", help="Write per-mode results to this JSON file")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    REDUCED_NUM_QUERIES, REDUCED_TOP_K = args.num_queries, args.top_k
+
+    with open(args.cases, "r") as file:
+        cases = json.load(file)
+    detector = ObjectDetectionInterface()
+    results = benchmark(
+        detector,
+        cases,
+        args.modes,
+        tuple(args.thresholds),
+        args.repeat,
+        args.center_tolerance,
+    )
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
@@ -0,0 +1,175 @@
+"""Cheap frame-quality gate run before detection, so unusable frames don't cost two model passes.
+
+Frames are scored on a small grayscale copy (decoded at reduced scale by OpenCV):
+- sharpness: variance of the Laplacian, low when the frame is blurred (e.g. the user was moving)
+- brightness: mean pixel value, and fraction of pixels clipped to black or white
+- change: mean absolute thumbnail difference from the session's previous frame (if recent), high when the
+  camera moved or something was in front of it between frames. Only checked for frames with a session, as
+  clients without one (e.g. behind a NAT) can't be told apart.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from prefetch import SIGNATURE_SIZE, frame_difference
+
+# Width frames are scored at, so sharpness is comparable between resolutions
+SCORE_WIDTH = 320
+
+
+class FrameQuality(NamedTuple):
+    sharpness: float
+    brightness: float
+    # Fraction of pixels that are (almost) black or white
+    clipped: float
+    # Difference from session's previous frame (0-255), None if there is no recent one
+    change: float
+
+
+class GateDecision(NamedTuple):
+    passed: bool
+    # Why frame was rejected ('unreadable', 'too_dark', 'too_bright', 'overexposed', 'blurry', 'moving'), else ""
+    reason: str
+    quality: FrameQuality
+
+
+def score_frame(image_path: str) -> tuple[np.ndarray, np.ndarray]:
+    """Grayscale frame at SCORE_WIDTH and its signature (thumbnail), None if it can't be decoded."""
+    # JPEGs are decoded at 1/4 scale directly
+    gray = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        return None, None
+    height, width = gray.shape
+    if width > SCORE_WIDTH:
+        gray = cv2.resize(
+            gray,
+            (SCORE_WIDTH, max(1, round(height * SCORE_WIDTH / width))),
+            interpolation=cv2.INTER_AREA,
+        )
+    signature = cv2.resize(gray, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    return gray, signature.astype(np.float32)
+
+
+class FrameGate:
+    """Scores frames and rejects unusable ones, remembering each session's last frame for change."""
+
+    def __init__(
+        self,
+        min_sharpness: float = 100.0,
+        min_brightness: float = 35.0,
+        max_brightness: float = 225.0,
+        max_clipped: float = 0.6,
+        max_change: float = 40.0,
+        change_window: float = 2.0,
+        max_sessions: int = 1000,
+    ):
+        """
+        Args:
+        - min_sharpness: Min Laplacian variance
+        - min_brightness, max_brightness: Range of mean pixel value (0-255)
+        - max_clipped: Max fraction of pixels that are black or white
+        - max_change: Max difference from session's previous frame, None to not check
+        - change_window: Seconds a previous frame is compared against, older ones are too stale to tell motion
+        - max_sessions: Sessions whose last frame is remembered, least recent are forgotten first
+        """
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.max_change = max_change
+        self.change_window = change_window
+        self.max_sessions = max_sessions
+        # session -> (signature, time) of last frame
+        self.previous: OrderedDict[str, tuple[np.ndarray, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        for name in (
+            "min_sharpness",
+            "min_brightness",
+            "max_brightness",
+            "max_clipped",
+            "max_change",
+        ):
+            if getattr(self, name) is not None:
+                metrics.set(f"frame_gate_{name}", getattr(self, name))
+
+    def _swap_previous(self, session: str, signature: np.ndarray, now: float):
+        """Store signature as session's last frame, returning the previous one if recent."""
+        with self.lock:
+            previous = self.previous.pop(session, None)
+            self.previous[session] = (signature, now)
+            while len(self.previous) > self.max_sessions:
+                self.previous.popitem(last=False)
+        if previous is None or now - previous[1] > self.change_window:
+            return None
+        return previous[0]
+
+    def observe(self, image_path: str, session: str = None):
+        """Remember frame as session's latest without checking it (e.g. frames streamed for prefetching)."""
+        if session is None:
+            return
+        _, signature = score_frame(image_path)
+        if signature is not None:
+            self._swap_previous(session, signature, time.time())
+
+    def check(self, image_path: str, session: str = None) -> GateDecision:
+        """Score frame and decide if it is worth running detection on, change is only checked with a session."""
+        begin = time.time()
+        gray, signature = score_frame(image_path)
+        if gray is None:
+            return self._decide(GateDecision(False, "unreadable", None), begin)
+        quality = FrameQuality(
+            sharpness=float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+            brightness=float(gray.mean()),
+            clipped=float(np.mean((gray <= 5) | (gray >= 250))),
+            change=None,
+        )
+        # Exposure is checked first, dark frames also have little detail
+        if quality.brightness < self.min_brightness:
+            reason = "too_dark"
+        elif quality.brightness > self.max_brightness:
+            reason = "too_bright"
+        elif quality.clipped > self.max_clipped:
+            reason = "overexposed"
+        elif quality.sharpness < self.min_sharpness:
+            reason = "blurry"
+        else:
+            reason = ""
+        if reason in ("too_dark", "too_bright", "overexposed"):
+            # Badly exposed frames aren't kept as previous frame, every next frame would look changed
+            return self._decide(GateDecision(False, reason, quality), begin)
+
+        previous = (
+            self._swap_previous(session, signature, begin)
+            if session is not None
+            else None
+        )
+        if previous is not None:
+            quality = quality._replace(change=frame_difference(previous, signature))
+        if (
+            reason == ""
+            and self.max_change is not None
+            and quality.change is not None
+            and quality.change > self.max_change
+        ):
+            reason = "moving"
+        return self._decide(GateDecision(reason == "", reason, quality), begin)
+
+    def _decide(self, decision: GateDecision, begin: float) -> GateDecision:
+        metrics.increment("frame_gate_seconds", time.time() - begin)
+        if decision.passed:
+            metrics.increment("frame_gate_passed")
+        else:
+            metrics.increment("frame_gate_rejected")
+            metrics.increment(f"frame_gate_rejected_{decision.reason}")
+            print(f"Frame rejected ({decision.reason}): {decision.quality}")
+        if decision.quality is not None:
+            metrics.set("frame_gate_last_sharpness", decision.quality.sharpness)
+            metrics.set("frame_gate_last_brightness", decision.quality.brightness)
+        return decision
@@ -1,12 +1,19 @@
 import base64
+import difflib
 import json
 from json import JSONDecodeError
+import os
 import re
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from metrics import metrics
+from prompt_history import completed_text, fit_history, turn_text
 
 load_dotenv()
 
+# Shared async client so connections to the API are reused across requests (async server only)
+async_client: AsyncOpenAI = None
+
 possible_actions = [
     "press",
     "twist",
@@ -26,6 +33,9 @@ def encode_image(image_path):
 
 def output_to_json(output) -> dict[str, list[str]]:
     """Parse output from GPT into JSON as Python object."""
+    # Content is None when the model refuses
+    if output is None:
+        return None
     start = output.find("{")
     end = output.rfind("}") + 1
     json_string = output[start:end]
@@ -42,63 +52,169 @@ def output_to_json(output) -> dict[str, list[str]]:
     #     json.dump(json_data, file, indent=4)
 
 
-def parse_instruction(
+def repair_action(action) -> str:
+    """Closest action in possible_actions, or None if action isn't close to any."""
+    if not isinstance(action, str):
+        return None
+    action = re.sub(r"\s+", " ", action).strip().lower()
+    if action == "":
+        return None
+    if action in possible_actions:
+        return action
+    for possible_action in possible_actions:
+        # Whole words of an action, e.g. 'pick up the cup' or 'place'
+        if action.startswith(possible_action + " ") or possible_action.startswith(
+            action + " "
+        ):
+            return possible_action
+    for possible_action in possible_actions:
+        # Cut off mid-word (e.g. 'p' or 'pu' of a truncated answer), too little to tell which action was meant
+        if possible_action.startswith(action):
+            return None
+    matches = difflib.get_close_matches(action, possible_actions, n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+
+def repair_output(json_data) -> dict[str, list[str]]:
+    """Fix output that is close to valid without calling GPT again.
+
+    Single strings are wrapped in lists, actions are matched to possible_actions, and lists are cut to the
+    same length (dropping pairs whose action can't be matched).
+
+    Returns:
+    - Valid output, or None if it can't be repaired (caller should call GPT again)
+    """
+    if not isinstance(json_data, dict):
+        return None
+    objects = json_data.get("objects")
+    actions = json_data.get("actions")
+    if isinstance(objects, str):
+        objects = [objects]
+    if isinstance(actions, str):
+        actions = [actions]
+    if not isinstance(objects, list) or not isinstance(actions, list):
+        return None
+
+    repaired = {"objects": [], "actions": []}
+    for obj, action in zip(objects, actions):
+        repaired_action = repair_action(action)
+        if not isinstance(obj, str) or repaired_action is None:
+            continue
+        repaired["objects"].append(obj)
+        repaired["actions"].append(repaired_action)
+    if len(repaired["objects"]) == 0:
+        return None
+
+    if repaired != json_data:
+        metrics.increment("gpt_repaired_outputs")
+        print(f"Repaired GPT output: {json.dumps(repaired)}")
+    return repaired
+
+
+# Static part of every conversation, built once so it is a byte-identical prefix (provider-side prompt caching)
+SYSTEM_PROMPT = f"You will be given multiple instructions that a user has to perform. You will be given them one at a time as the user completes them. Your output should be in JSON format. \
+                One JSON field should be called 'objects', which will contain a list of objects (strings) that exist in the provided image that the user should use to complete the current instruction. \
+                The object within the 'objects' list should have a corresponding action the user should perform on the object to complete the instruction. \
+                Another JSON field called 'actions' will contain these actions (strings) in a list where each entry is the action the user should perform on the object in the 'objects' list. \
+                The possible actions for the user include: {', '.join(possible_actions)}. Output one of these actions exactly as listed. \
+                Output only one object and action in each list that would be best to complete the instruction based on the image. Ensure the object you output exists in the current provided image. \
+                In the 'objects' list, each object string should be structured as such: '<object position> <object name>' with the following properties: \
+                <object name> is the specific object the user should use to complete the instruction. If the object is a component within a larger object, output the most specific component needed for the instruction. Be specific while trying to use the lowest amount of words for the object name. \
+                <object position> is the position of the object in the image. Check that the position ensures the object can't be confused with other similar objects, also include the object color if it is unique. Be specific while trying to use the lowest amount of words for the position. \
+                Do not include any other JSON fields other than 'objects' and 'actions', which should both be lists of the same length. \
+                Make sure the outputs make sense given previous instructions the user has completed."
+# Replace long whitespace with one space using regex
+SYSTEM_PROMPT = re.sub(r"\s+", " ", SYSTEM_PROMPT)
+
+# Model must support images and (if STRUCTURED_OUTPUT) JSON schema response format. Pinned to a dated snapshot
+# since strict json_schema output only works on specific snapshots, and the 'gpt-4o' alias can move to another
+# model. Replaces gpt-4-vision-preview, which has no JSON schema output and has been retired. Set GPT_MODEL to
+# use another model.
+GPT_MODEL = os.getenv("GPT_MODEL", "gpt-4o-2024-08-06")
+# Constrain output to OUTPUT_SCHEMA instead of scraping JSON out of free text
+STRUCTURED_OUTPUT = os.getenv("GPT_STRUCTURED_OUTPUT", "1") == "1"
+# Equal list lengths can't be expressed in the schema, repair_output fixes those
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "objects": {"type": "array", "items": {"type": "string"}},
+        "actions": {
+            "type": "array",
+            "items": {"type": "string", "enum": possible_actions},
+        },
+    },
+    "required": ["objects", "actions"],
+    "additionalProperties": False,
+}
+
+
+def completion_options() -> dict:
+    """Model options passed to every chat completion call."""
+    options = {"model": GPT_MODEL, "max_tokens": 300}
+    if STRUCTURED_OUTPUT:
+        options["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "instruction_output",
+                "schema": OUTPUT_SCHEMA,
+                "strict": True,
+            },
+        }
+    return options
+
+
+EXAMPLE = '{\n  "objects":\n  [\n    "position object 1"\n  ],\n  "actions":\n  [\n    "action 1"\n  ]\n}'
+
+PREFIX_MESSAGES = [
+    {
+        "role": "system",
+        "content": [
+            {"type": "text", "text": SYSTEM_PROMPT},
+        ],
+    },
+    {
+        "role": "assistant",
+        "content": [{"type": "text", "text": f"JSON:\n{EXAMPLE}"}],
+    },
+]
+
+# Max tokens of previous instructions/responses sent with each call, older steps are summarized to fit
+HISTORY_TOKEN_BUDGET = int(os.getenv("GPT_HISTORY_TOKEN_BUDGET", "1500"))
+# Most recent steps always sent in full, even if over budget
+HISTORY_MIN_RECENT_STEPS = int(os.getenv("GPT_HISTORY_MIN_RECENT_STEPS", "1"))
+
+
+def build_messages(
     instruction: str,
     image_path: str,
     previous_instructions: list[str],
     previous_outputs: list[str],
     high_detail: bool = False,
-) -> dict[str, list[str]]:
-    """Function to use GPT-4V to parse an instruction given an image of the environment."""
+) -> list[dict]:
+    """Build GPT-4V conversation (static prefix, history within token budget, and current instruction with image)."""
     base64_image = encode_image(image_path)
 
-    client = OpenAI()
-
-    action_string = ", ".join(possible_actions)
-
-    system_prompt = f"You will be given multiple instructions that a user has to perform. You will be given them one at a time as the user completes them. Your output should be in JSON format. \
-                    One JSON field should be called 'objects', which will contain a list of objects (strings) that exist in the provided image that the user should use to complete the current instruction. \
-                    The object within the 'objects' list should have a corresponding action the user should perform on the object to complete the instruction. \
-                    Another JSON field called 'actions' will contain these actions (strings) in a list where each entry is the action the user should perform on the object in the 'objects' list. \
-                    The possible actions for the user include: {action_string}. Output one of these actions exactly as listed. \
-                    Output only one object and action in each list that would be best to complete the instruction based on the image. Ensure the object you output exists in the current provided image. \
-                    In the 'objects' list, each object string should be structured as such: '<object position> <object name>' with the following properties: \
-                    <object name> is the specific object the user should use to complete the instruction. If the object is a component within a larger object, output the most specific component needed for the instruction. Be specific while trying to use the lowest amount of words for the object name. \
-                    <object position> is the position of the object in the image. Check that the position ensures the object can't be confused with other similar objects, also include the object color if it is unique. Be specific while trying to use the lowest amount of words for the position. \
-                    Do not include any other JSON fields other than 'objects' and 'actions', which should both be lists of the same length. \
-                    Make sure the outputs make sense given previous instructions the user has completed."
+    messages = [dict(message) for message in PREFIX_MESSAGES]
 
-    # Replace long whitespace with one space using regex
-    system_prompt = re.sub(r"\s+", " ", system_prompt)
-    # print(system_prompt)
-
-    example = '{\n  "objects":\n  [\n    "position object 1"\n  ],\n  "actions":\n  [\n    "action 1"\n  ]\n}'
-    # print(f"JSON:\n{example}")
-
-    messages = [
-        {
-            "role": "system",
-            "content": [
-                {"type": "text", "text": system_prompt},
-            ],
-        },
-        {
-            "role": "assistant",
-            "content": [{"type": "text", "text": f"JSON:\n{example}"}],
-        },
-    ]
+    history = fit_history(
+        previous_instructions,
+        previous_outputs,
+        HISTORY_TOKEN_BUDGET,
+        HISTORY_MIN_RECENT_STEPS,
+    )
+    print(
+        f"History: {len(history.instructions)} of {len(previous_instructions)} previous steps in full, ~{history.tokens} tokens"
+    )
 
     # Append previous conversation to give to GPT
-    for prev_instr, prev_response in zip(previous_instructions, previous_outputs):
+    for prev_instr, prev_response in zip(history.instructions, history.outputs):
         print("PREVIOUS CONVERSATION: ")
         print(f"Previous instruction: {prev_instr}")
         print(f"Previous response: {prev_response}")
         messages.append(
             {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": f"Next Instruction: {prev_instr}"}
-                ],
+                "content": [{"type": "text", "text": turn_text(prev_instr)}],
             },
         )
         messages.append(
@@ -108,15 +224,14 @@ def parse_instruction(
             },
         )
 
-    # Append completed instructions in summary
-    all_prev_instructions = ", ".join(previous_instructions)
+    # Append completed instructions in summary (older steps summarized)
     messages.append(
         {
             "role": "user",
             "content": [
                 {
                     "type": "text",
-                    "text": f"At this point, the user has completed these instructions: {all_prev_instructions}",
+                    "text": completed_text(history.completed),
                 }
             ],
         },
@@ -138,12 +253,56 @@ def parse_instruction(
         },
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4-vision-preview", max_tokens=300, messages=messages
+    return messages
+
+
+def parse_instruction(
+    instruction: str,
+    image_path: str,
+    previous_instructions: list[str],
+    previous_outputs: list[str],
+    high_detail: bool = False,
+) -> dict[str, list[str]]:
+    """Function to use GPT-4V to parse an instruction given an image of the environment."""
+    messages = build_messages(
+        instruction, image_path, previous_instructions, previous_outputs, high_detail
+    )
+
+    client = OpenAI()
+
+    metrics.increment("gpt_calls")
+    response = client.chat.completions.create(messages=messages, **completion_options())
+
+    output = response.choices[0].message.content
+    print(f"GPT raw output: {output}")
+    json_output = repair_output(output_to_json(output))
+
+    return json_output
+
+
+async def parse_instruction_async(
+    instruction: str,
+    image_path: str,
+    previous_instructions: list[str],
+    previous_outputs: list[str],
+    high_detail: bool = False,
+) -> dict[str, list[str]]:
+    """Same as parse_instruction, but awaits GPT-4V on the event loop instead of blocking a thread."""
+    global async_client
+    messages = build_messages(
+        instruction, image_path, previous_instructions, previous_outputs, high_detail
+    )
+
+    if async_client is None:
+        async_client = AsyncOpenAI()
+
+    metrics.increment("gpt_calls")
+    response = await async_client.chat.completions.create(
+        messages=messages, **completion_options()
     )
 
     output = response.choices[0].message.content
     print(f"GPT raw output: {output}")
-    json_output = output_to_json(output)
+    json_output = repair_output(output_to_json(output))
 
     return json_output
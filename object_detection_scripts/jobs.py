@@ -0,0 +1,142 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """Long-running request (e.g. operator instruction parsing) that reports progress as it runs."""
+
+    def __init__(self, key: str):
+        self.id = uuid.uuid4().hex
+        # Idempotency key, submitting the same key again returns this job instead of a new one
+        self.key = key
+        # One of "queued", "running", "done", "failed"
+        self.status = "queued"
+        self.events: list[dict] = []
+        self.result: dict = None
+        self.error: str = None
+        self.created = time.time()
+        self.finished: float = None
+        self.changed = threading.Condition()
+
+    def report(self, stage: str, **data):
+        """Add progress event and wake up anything waiting on this job."""
+        with self.changed:
+            self.events.append({"stage": stage, "time": time.time(), **data})
+            self.changed.notify_all()
+
+    def finish(self, status: str, result: dict = None, error: str = None):
+        """Mark job as done or failed, adds final event containing result or error."""
+        with self.changed:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            final_event = {"stage": status, "time": self.finished}
+            if result is not None:
+                final_event.update(result)
+            if error is not None:
+                final_event["error"] = error
+            self.events.append(final_event)
+            self.changed.notify_all()
+
+    @property
+    def completed(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def wait_for_events(self, start: int, timeout: float) -> list[dict]:
+        """Wait until there are events after index 'start' (or timeout) and return them."""
+        with self.changed:
+            self.changed.wait_for(
+                lambda: len(self.events) > start or self.completed, timeout
+            )
+            return self.events[start:]
+
+    def to_dict(self) -> dict:
+        with self.changed:
+            return {
+                "jobId": self.id,
+                "status": self.status,
+                "events": list(self.events),
+                "result": self.result,
+                "error": self.error,
+            }
+
+
+class JobStore:
+    """Runs jobs on a thread pool and keeps completed jobs for a bounded time."""
+
+    def __init__(self, workers: int = 2, ttl: float = 600, max_jobs: int = 100):
+        """
+        Args:
+        - workers: Number of jobs that can run at once
+        - ttl: Seconds to keep completed jobs (and their results) around
+        - max_jobs: Max number of completed jobs kept, oldest are removed first
+        """
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job"
+        )
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs: dict[str, Job] = {}
+        self.jobs_by_key: dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        """Remove expired completed jobs. Must hold lock."""
+        now = time.time()
+        completed = sorted(
+            (job for job in self.jobs.values() if job.completed),
+            key=lambda job: job.finished,
+        )
+        num_over = len(completed) - self.max_jobs
+        for i, job in enumerate(completed):
+            if i < num_over or now - job.finished > self.ttl:
+                del self.jobs[job.id]
+                if self.jobs_by_key.get(job.key) is job:
+                    del self.jobs_by_key[job.key]
+
+    def submit(self, key: str, func, *args, on_complete=None) -> tuple[Job, bool]:
+        """Run func(*args, progress=job.report) as a job unless a job with the same key exists.
+
+        A failed job with the same key is replaced, so the client can retry it.
+
+        Args:
+        - on_complete: Called with no arguments after the job finishes (successfully or not), e.g. for cleanup
+
+        Returns:
+        - Job for key
+        - True if a new job was created, False if an existing job was returned
+        """
+        with self.lock:
+            self._evict()
+            existing = self.jobs_by_key.get(key)
+            if existing is not None and existing.status != "failed":
+                return existing, False
+
+            job = Job(key)
+            self.jobs[job.id] = job
+            self.jobs_by_key[key] = job
+
+        self.executor.submit(self._run, job, func, args, on_complete)
+        return job, True
+
+    def _run(self, job: Job, func, args, on_complete):
+        with job.changed:
+            job.status = "running"
+        job.report("running")
+        try:
+            result = func(*args, progress=job.report)
+            job.finish("done", result=result)
+        except Exception as e:
+            job.finish("failed", error=f"{type(e).__name__}: {e}")
+        finally:
+            if on_complete is not None:
+                on_complete()
+
+    def get(self, job_id: str) -> Job:
+        """Returns job with job_id, or None if it doesn't exist (or expired)."""
+        with self.lock:
+            self._evict()
+            return self.jobs.get(job_id)
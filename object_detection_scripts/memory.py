@@ -0,0 +1,121 @@
+"""Memory governor for detection: process RSS per stage and a memory budget for model inference.
+
+RSS (from psutil) is sampled at the end of each stage (preprocess, inference) and the highest value seen is
+reported per stage on '/metrics'. Freed memory mostly stays with the process, so RSS after a stage is close to
+its peak. With a budget, the model input size of the next image is reduced (down to min_image_size) when the
+estimated inference memory wouldn't fit, instead of letting the process swap or run out of memory.
+
+The estimate is the highest inference memory per pixel of the last few inferences, each measured only if no
+other stage ran in the process at the same time (RSS is per process, not per thread).
+"""
+
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import psutil
+
+from metrics import metrics
+
+MB = 1024 * 1024
+# Estimated inference memory per model input pixel, until an inference is measured
+DEFAULT_BYTES_PER_PIXEL = 1500.0
+# Inferences the estimate is the max of, older ones are forgotten (e.g. growth of the first, warm-up inference)
+LEARN_WINDOW = 32
+
+
+class MemoryGovernor:
+    """Tracks process memory per detection stage and picks model input sizes that fit a memory budget."""
+
+    def __init__(
+        self,
+        budget_mb: float = None,
+        min_image_size: int = 400,
+        max_input_pixels: int = 40_000_000,
+        bytes_per_pixel: float = DEFAULT_BYTES_PER_PIXEL,
+        learn_window: int = LEARN_WINDOW,
+    ):
+        """
+        Args:
+        - budget_mb: Max process RSS that inference should reach, None to never reduce input size
+        - min_image_size: Smallest shortest side model input is reduced to, used even if it doesn't fit
+        - max_input_pixels: Images with more pixels are rejected before they are decoded
+        - bytes_per_pixel: Initial estimate of inference memory per model input pixel
+        - learn_window: Number of recent inferences the estimate is the max of
+        """
+        self.budget = budget_mb * MB if budget_mb is not None else None
+        self.min_image_size = min_image_size
+        self.max_input_pixels = max_input_pixels
+        self.bytes_per_pixel = bytes_per_pixel
+        # Inference memory per pixel of recent measured inferences
+        self.samples: deque[float] = deque(maxlen=learn_window)
+        self.process = psutil.Process()
+        # Stage -> highest RSS seen at its end
+        self.peaks: dict[str, int] = {}
+        # Stages running now, and started so far, to tell if a stage ran alone
+        self.running = 0
+        self.started = 0
+        # Stage -> RSS growth during the calling thread's last run, None if another stage ran meanwhile
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def rss(self) -> int:
+        return self.process.memory_info().rss
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure RSS of the stage run in the 'with' block."""
+        with self.lock:
+            self.running += 1
+            self.started += 1
+            started = self.started
+            alone = self.running == 1
+        before = self.rss()
+        try:
+            yield
+        finally:
+            after = self.rss()
+            with self.lock:
+                self.running -= 1
+                # Growth is only this stage's if no other stage started before it ended
+                alone = alone and self.started == started
+                self.peaks[name] = max(self.peaks.get(name, 0), after)
+                peak = self.peaks[name]
+            if not hasattr(self.local, "growth"):
+                self.local.growth = {}
+            self.local.growth[name] = after - before if alone else None
+            metrics.set(f"memory_peak_rss_{name}_mb", peak / MB)
+            metrics.set("memory_rss_mb", after / MB)
+
+    def learn(self, input_pixels: int):
+        """Update inference memory estimate with this thread's last inference stage, run on input_pixels."""
+        growth = getattr(self.local, "growth", {}).pop("inference", None)
+        if input_pixels <= 0 or growth is None:
+            return
+        with self.lock:
+            self.samples.append(max(growth, 0) / input_pixels)
+            self.bytes_per_pixel = max(self.samples)
+        metrics.set("memory_bytes_per_pixel", self.bytes_per_pixel)
+
+    def fit_input_size(self, size: int, max_size: int) -> tuple[int, int]:
+        """Model input (shortest side, max longest side) for the next inference, reduced from size and max_size
+        if the budget would be exceeded.
+        """
+        if self.budget is None:
+            return size, max_size
+        available = self.budget - self.rss()
+        # Largest input the sizes allow
+        needed = self.bytes_per_pixel * size * max_size
+        if needed <= available:
+            return size, max_size
+
+        scale = math.sqrt(max(available, 0) / needed)
+        reduced = max(self.min_image_size, int(size * scale))
+        if reduced >= size:
+            return size, max_size
+        metrics.increment("memory_reduced_inputs")
+        print(
+            f"Memory budget: {available / MB:.0f} MB available, model input reduced from {size} to {reduced}"
+        )
+        return reduced, int(max_size * reduced / size)
@@ -0,0 +1,39 @@
+import threading
+
+
+class Metrics:
+    """Thread-safe counters and gauges reported by the '/metrics' endpoint."""
+
+    def __init__(self):
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        """Set gauge to its current value (e.g. queue depth)."""
+        with self.lock:
+            self.gauges[name] = value
+
+    def get(self, name: str) -> float:
+        """Current value of counter or gauge, 0 if it was never set."""
+        with self.lock:
+            return self.counters.get(name, self.gauges.get(name, 0))
+
+    def ratio(self, numerator: str, *others: str) -> float:
+        """numerator / (numerator + others), None if all are 0 (e.g. hit rate from hits and misses)."""
+        with self.lock:
+            hits = self.counters.get(numerator, 0)
+            total = hits + sum(self.counters.get(name, 0) for name in others)
+        return hits / total if total > 0 else None
+
+    def snapshot(self) -> dict[str, float]:
+        with self.lock:
+            return {**self.counters, **self.gauges}
+
+
+# Shared by all modules of the server
+metrics = Metrics()
@@ -0,0 +1,191 @@
+"""Pre-fork model workers: GroundingDINO is loaded once and its weights are shared by N worker processes.
+
+The model is loaded on CPU in the server process and its tensors are moved to shared memory. Worker processes
+are then forked and use those tensors directly (read-only), so adding workers adds CPU throughput without
+adding another copy of the weights. Detection calls are dispatched to the worker with the fewest outstanding
+requests.
+
+Meant for CPU nodes: CUDA can't be used in forked processes, so workers always run on CPU.
+"""
+
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+import torch.multiprocessing as mp
+
+from artifact_store import ArtifactStore
+from object_detection import (
+    DetectionException,
+    ObjectDetection,
+    ObjectDetectionInterface,
+)
+
+
+def _worker_main(
+    worker_id: int,
+    model: torch.nn.Module,
+    requests: mp.Queue,
+    results: mp.Queue,
+    num_threads: int,
+    artifact_store: ArtifactStore,
+):
+    """Worker process loop: run ObjectDetectionInterface methods sent by the dispatcher."""
+    torch.set_num_threads(num_threads)
+    detector = ObjectDetectionInterface(
+        ObjectDetection(model=model, device="cpu", artifact_store=artifact_store)
+    )
+    print(f"Model worker {worker_id} (pid {os.getpid()}) ready")
+
+    while True:
+        item = requests.get()
+        # None is the signal to exit
+        if item is None:
+            break
+        request_id, method, args, kwargs = item
+        try:
+            result = getattr(detector, method)(*args, **kwargs)
+            results.put((request_id, result, None))
+        except Exception as e:
+            # Send error as string since not all exceptions can be pickled
+            results.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class ModelWorkerPool:
+    """Dispatches detection calls to worker processes that share one copy of the model weights.
+
+    Can be used in place of ObjectDetectionInterface: any of its methods called on the pool run on a worker.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        threads_per_worker: int = None,
+        artifact_store: ArtifactStore = None,
+    ):
+        """
+        Args:
+        - num_workers: Number of worker processes
+        - threads_per_worker: Torch threads for each worker, defaults to splitting cores evenly between workers
+        - artifact_store: Store workers save detection plots to (shared through its directory on disk)
+        """
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+        # Load once on CPU and move weights to shared memory before forking
+        model = ObjectDetection(device="cpu").model
+        model.eval()
+        model.share_memory()
+
+        context = mp.get_context("fork")
+        self.results = context.Queue()
+        self.request_queues = []
+        self.processes = []
+        for worker_id in range(num_workers):
+            requests = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(
+                    worker_id,
+                    model,
+                    requests,
+                    self.results,
+                    threads_per_worker,
+                    artifact_store,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.request_queues.append(requests)
+            self.processes.append(process)
+
+        self.request_ids = itertools.count()
+        self.lock = threading.RLock()
+        # request_id -> (worker_id, Future)
+        self.pending: dict[int, tuple[int, Future]] = {}
+        self.outstanding = [0] * num_workers
+        self.alive = [True] * num_workers
+
+        self.collector = threading.Thread(target=self._collect_results, daemon=True)
+        self.collector.start()
+
+    def _collect_results(self):
+        """Resolve futures as workers finish, and fail requests of workers that died."""
+        while True:
+            try:
+                request_id, result, error = self.results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+
+            with self.lock:
+                # Already failed if its worker was found dead
+                if request_id not in self.pending:
+                    continue
+                worker_id, future = self.pending.pop(request_id)
+                self.outstanding[worker_id] -= 1
+            if error is not None:
+                future.set_exception(DetectionException(f"model worker: {error}"))
+            else:
+                future.set_result(result)
+
+    def _check_workers(self):
+        with self.lock:
+            for worker_id, process in enumerate(self.processes):
+                if not self.alive[worker_id] or process.is_alive():
+                    continue
+                print(f"Model worker {worker_id} exited ({process.exitcode})")
+                self.alive[worker_id] = False
+                for request_id, (owner, future) in list(self.pending.items()):
+                    if owner == worker_id:
+                        del self.pending[request_id]
+                        future.set_exception(
+                            DetectionException("model worker exited during request")
+                        )
+                self.outstanding[worker_id] = 0
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """Run ObjectDetectionInterface method on the least busy worker."""
+        with self.lock:
+            workers = [i for i, alive in enumerate(self.alive) if alive]
+            if len(workers) == 0:
+                raise DetectionException("no model workers are running")
+            worker_id = min(workers, key=lambda i: self.outstanding[i])
+            return self._submit_to(worker_id, method, *args, **kwargs)
+
+    def _submit_to(self, worker_id: int, method: str, *args, **kwargs) -> Future:
+        with self.lock:
+            request_id = next(self.request_ids)
+            future = Future()
+            self.pending[request_id] = (worker_id, future)
+            self.outstanding[worker_id] += 1
+            self.request_queues[worker_id].put((request_id, method, args, kwargs))
+        return future
+
+    def __getattr__(self, method: str):
+        """Any other ObjectDetectionInterface method is run on a worker, blocking until it finishes."""
+        if not hasattr(ObjectDetectionInterface, method):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self.submit(method, *args, **kwargs).result()
+
+        return call
+
+    def prime_detection_with_test(self):
+        """Prime every worker, since each one's first run takes longer."""
+        futures = [
+            self._submit_to(worker_id, "prime_detection_with_test")
+            for worker_id in range(len(self.processes))
+        ]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        for requests in self.request_queues:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
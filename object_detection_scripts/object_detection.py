@@ -1,91 +1,395 @@
+import hashlib
+import math
 import os
+import uuid
 import torch
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 
+from contextlib import contextmanager
 from datetime import datetime
-from groundingdino.util.inference import load_model, load_image, predict, annotate
+from functools import wraps
+from typing import NamedTuple
+from groundingdino.util.inference import (
+    load_model,
+    annotate,
+    preprocess_caption,
+)
+from groundingdino.util.misc import NestedTensor
+from groundingdino.util.utils import get_phrases_from_posmap
 from PIL import Image
+from torchvision.ops import roi_align
+from artifact_store import ArtifactStore
+from memory import MemoryGovernor
+from metrics import metrics
+from preprocessing import ImagePreprocessor, PreprocessedImage, get_target_size
 
 
 class DetectionException(Exception):
     """Exception encountered during or before object detection."""
 
 
+# Backbone -> (config file, weights file) of GroundingDINO model
+MODEL_FILES = {
+    "swint": ("GroundingDINO_SwinT_OGC.py", "groundingdino_swint_ogc.pth"),
+    "swinb": ("GroundingDINO_SwinB_cfg.py", "groundingdino_swinb_cogcoor.pth"),
+}
+
+
+class RawDetection(NamedTuple):
+    """Unthresholded model output for one image, kept when running inference with keep_raw."""
+
+    # (num_queries, 256) sigmoid confidence of each query for each caption token
+    logits: torch.Tensor
+    # (num_queries, 4) boxes as normalized (x, y, w, h)
+    boxes: torch.Tensor
+    # Token IDs of the preprocessed caption
+    token_ids: list[int]
+    # (width, height) boxes are scaled to
+    original_size: tuple[int, int]
+
+
+class Candidate(NamedTuple):
+    """Kept box of a detection in original image pixels, so clients can pick another box than the best."""
+
+    center: tuple[float, float]
+    # (x1, y1, x2, y2)
+    box: tuple[float, float, float, float]
+    confidence: float
+    phrase: str
+
+
+class BackboneFeatures(NamedTuple):
+    """Backbone output of one image, kept by detecting with keep_features to detect on its regions later."""
+
+    # Multi-scale feature maps (a NestedTensor with batch size 1 per level)
+    features: list
+    # (width, height) of model input the features were computed from
+    input_size: tuple[int, int]
+    # (width, height) of original image, regions are in these pixels
+    original_size: tuple[int, int]
+
+
+class InferenceMemo:
+    """Detection outputs of one request (e.g. the operator flow), so an inference with the same image, caption,
+    and threshold isn't run twice.
+
+    Images are identified by content hash, so a crop saved again from the same region also matches.
+    """
+
+    def __init__(self):
+        # (image hash, preprocessed caption, threshold) -> (model output, detector images)
+        self.entries: dict[tuple[str, str, float], tuple[tuple, PreprocessedImage]] = {}
+        # Inferences saved
+        self.hits = 0
+        self.misses = 0
+
+    def key(
+        self, image_path: str, prompt: str, threshold: float
+    ) -> tuple[str, str, float]:
+        with open(image_path, "rb") as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        return digest, preprocess_caption(prompt), float(threshold)
+
+    def get(self, key: tuple[str, str, float]) -> tuple[tuple, PreprocessedImage]:
+        """(model output, detector images) of an earlier inference with key, None if there wasn't one."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            metrics.increment("inference_memo_misses")
+        else:
+            self.hits += 1
+            metrics.increment("inference_memo_hits")
+        return entry
+
+    def put(
+        self,
+        key: tuple[str, str, float],
+        model_output: tuple,
+        images: PreprocessedImage,
+    ):
+        self.entries[key] = (model_output, images)
+
+    def clear(self):
+        """Drop the kept outputs and images (e.g. once nothing will detect on them again), counts are kept."""
+        self.entries.clear()
+
+
+def limit_decoder_queries(model: torch.nn.Module, num_queries: int = None):
+    """Run the decoder on only the num_queries highest scoring encoder proposals, None for all of the model's.
+
+    The model's learned content queries are cut to its first num_queries (they are paired with proposals in
+    score order). Changes the model, so it applies to every detector sharing it.
+    """
+    transformer = model.transformer
+    # Kept in a tuple so the full embedding isn't registered as another submodule
+    if not hasattr(transformer, "full_queries"):
+        transformer.full_queries = (transformer.tgt_embed, transformer.num_queries)
+    full_embed, full_num_queries = transformer.full_queries
+    if num_queries is None or num_queries >= full_num_queries:
+        transformer.tgt_embed = full_embed
+        transformer.num_queries = full_num_queries
+        return
+    if num_queries < 1:
+        raise DetectionException(f"decoder needs at least 1 query, got {num_queries}")
+    if full_embed is not None:
+        # A view of the full weights, nothing is copied
+        transformer.tgt_embed = torch.nn.Embedding.from_pretrained(
+            full_embed.weight[:num_queries], freeze=True
+        )
+    transformer.num_queries = num_queries
+
+
+def box_center_pixel(box_unscaled: torch.Tensor, image: np.ndarray) -> tuple[int, int]:
+    """Center pixel of normalized (x, y, w, h) box in image (which may be decoded smaller than the original)."""
+    return int(box_unscaled[0] * image.shape[1]), int(box_unscaled[1] * image.shape[0])
+
+
 class ObjectDetection:
     """Object detection using GroundingDINO model."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        model: torch.nn.Module = None,
+        device: str = None,
+        artifact_store: ArtifactStore = None,
+        backbone: str = "swinb",
+        image_size: int = 800,
+        max_image_size: int = 1333,
+        governor: MemoryGovernor = None,
+        num_queries: int = None,
+        top_k: int = None,
+    ):
         """Setup GroundingDINO model.
 
         Prereq: Requires GroundingDINO repo to be cloned to current working directory and weights to be downloaded.
         See 'GroundingDINO_HL_research.ipynb' for setup
+
+        Args:
+        - model: Already loaded GroundingDINO model to use (e.g. shared between processes), weights are loaded if None
+        - device: Device to run model on, defaults to CUDA if available
+        - artifact_store: Where detection plots are saved, current directory if None
+        - backbone: Model weights to load if model is None, a key of MODEL_FILES
+        - image_size: Shortest side images are resized to for the model
+        - max_image_size: Max longest side images are resized to for the model
+        - governor: Tracks memory per stage and reduces model input size to fit its budget (shared by the
+          detectors of a process), one without a budget if None
+        - num_queries: Decoder queries per image (see limit_decoder_queries), all of the model's if None
+        - top_k: Max boxes per image that go on to thresholds and phrase extraction (highest confidence
+          first), all if None. Also limits the boxes the two-pass crop region is made of
         """
-        self.CONFIG_PATH = (
-            "GroundingDINO/groundingdino/config/GroundingDINO_SwinB_cfg.py"
+        config_name, WEIGHTS_NAME = MODEL_FILES[backbone]
+        self.CONFIG_PATH = os.path.join(
+            "GroundingDINO/groundingdino/config", config_name
         )
         print(self.CONFIG_PATH, "; exist:", os.path.isfile(self.CONFIG_PATH))
-        # WEIGHTS_NAME = "groundingdino_swint_ogc.pth"
-        WEIGHTS_NAME = "groundingdino_swinb_cogcoor.pth"
         self.WEIGHTS_PATH = os.path.join("weights", WEIGHTS_NAME)
         print(self.WEIGHTS_PATH, "; exist:", os.path.isfile(self.WEIGHTS_PATH))
 
-        self.model = load_model(self.CONFIG_PATH, self.WEIGHTS_PATH)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        if model is None:
+            model = load_model(self.CONFIG_PATH, self.WEIGHTS_PATH)
+        self.model = model.to(self.device)
+        self.num_queries: int = None
+        if num_queries is not None:
+            self.set_num_queries(num_queries)
+        self.top_k = top_k
+        # Max images sent through the model in one forward pass when detecting on multiple images
+        self.max_batch_size = 4
+        self.preprocessor = ImagePreprocessor(image_size, max_image_size)
+        self.governor = governor if governor is not None else MemoryGovernor()
+        self.artifact_store = artifact_store
+        self.request_id: str = None
+
+    def set_num_queries(self, num_queries: int = None):
+        """Change decoder queries per image of the model (and every detector sharing it)."""
+        limit_decoder_queries(self.model, num_queries)
+        self.num_queries = num_queries
+        if num_queries is not None:
+            print(f"Decoder limited to {num_queries} queries")
+
+    def setup_new_detection(self, request_id: str = None):
+        """Setup new variables, called before each detection to clear variables.
 
-    def setup_new_detection(self):
-        """Setup new variables, called before each detection to clear variables."""
+        Args:
+        - request_id: Request this detection is for, plots are saved as its artifacts
+        """
         self.detection_path: str = None
-        self.images: tuple[np.ndarray, torch.Tensor] = None
+        self.images: PreprocessedImage = None
+        self.request_id = request_id
+        # Filled by inference run with keep_raw
+        self.raw_outputs: list[RawDetection] = None
+        # Filled by detection run with keep_features
+        self.backbone_features: BackboneFeatures = None
+
+    def release_detection(self):
+        """Drop images, features, and outputs of the last detection so they aren't kept until the next one."""
+        self.images = None
+        self.raw_outputs = None
+        self.backbone_features = None
+
+    def keeps_artifacts(self) -> bool:
+        """True if plots should be drawn and saved for the current detection."""
+        return self.artifact_store is None or self.artifact_store.is_kept(
+            self.request_id
+        )
 
-    def _model_inference(
+    def _predict_batch(
         self,
-        images: tuple[np.ndarray, torch.Tensor],
-        text_prompt: str,
+        model_images: list[torch.Tensor],
+        captions: list[str],
+        box_threshold: float,
+        text_threshold: float,
+        raw_outputs: list = None,
+    ) -> list[tuple[torch.Tensor, torch.Tensor, list[str]]]:
+        """Same as GroundingDINO's 'predict', but runs multiple images (and captions) in one forward pass.
+
+        Images can have different sizes, the model pads them into one batch and masks the padding.
+
+        Only the top_k highest confidence queries of each image are thresholded, and phrases are extracted only
+        for boxes above the thresholds.
+
+        Args:
+        - raw_outputs: If given, (logits, boxes, token IDs) of every query (before thresholds) are appended for each image
+
+        Returns:
+        - List with (boxes, logits, phrases) for each image, same as 'predict' output
+        """
+        captions = [preprocess_caption(caption) for caption in captions]
+        model_images = [image.to(self.device) for image in model_images]
+
+        with torch.inference_mode(), self.governor.stage("inference"):
+            outputs = self.model(model_images, captions=captions)
+        self.governor.learn(
+            sum(image.shape[-2] * image.shape[-1] for image in model_images)
+        )
+
+        # prediction_logits.shape = (batch, nq, 256), prediction_boxes.shape = (batch, nq, 4)
+        prediction_logits = outputs["pred_logits"].cpu().sigmoid()
+        prediction_boxes = outputs["pred_boxes"].cpu()
+
+        tokenizer = self.model.tokenizer
+        results = []
+        for image_logits, image_boxes, caption in zip(
+            prediction_logits, prediction_boxes, captions
+        ):
+            tokenized = None
+            if raw_outputs is not None:
+                tokenized = tokenizer(caption)
+                raw_outputs.append((image_logits, image_boxes, tokenized["input_ids"]))
+
+            scores = image_logits.max(dim=1)[0]
+            if self.top_k is not None and self.top_k < len(scores):
+                scores, kept = scores.topk(self.top_k)
+                image_logits, image_boxes = image_logits[kept], image_boxes[kept]
+            mask = scores > box_threshold
+            logits = image_logits[mask]
+            boxes = image_boxes[mask]
+
+            phrases = []
+            if len(logits) > 0:
+                if tokenized is None:
+                    tokenized = tokenizer(caption)
+                phrases = [
+                    get_phrases_from_posmap(
+                        logit > text_threshold, tokenized, tokenizer
+                    ).replace(".", "")
+                    for logit in logits
+                ]
+            results.append((boxes, scores[mask], phrases))
+
+        return results
+
+    def _model_inference_batch(
+        self,
+        images: list[PreprocessedImage],
+        text_prompts: list[str],
         threshold: float,
-    ):
-        """Perform object dectection on image to get boxes, logits, and phrases."""
-        print("Running model inference on image")
-        # begin = time.time()
-        TEXT_PROMPT = text_prompt
+        keep_raw: bool = False,
+    ) -> list[tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]]]:
+        """Perform object detection on multiple images (each with own prompt) in batches of max_batch_size.
+
+        Args:
+        - keep_raw: Also keep unthresholded logits and boxes of every query in self.raw_outputs (one per image),
+          e.g. to try other thresholds without running the model again
+        """
+        print(f"Running model inference on {len(images)} image(s)")
         BOX_TRESHOLD = threshold
         TEXT_TRESHOLD = threshold
 
-        image_source = images[0]
-        img_h = image_source.shape[0]
-        img_w = image_source.shape[1]
-
-        model_image = images[1]
-
-        # Tensor of found boxes (with confidence above box_threshold)
-        # Tensor of logits for text phrases
-        # List[str] of phrases from prompt found corresponding to boxes (with confidence above text_threshold)
-        boxes, logits, phrases = predict(
-            model=self.model,
-            image=model_image,
-            caption=TEXT_PROMPT,
-            box_threshold=BOX_TRESHOLD,
-            text_threshold=TEXT_TRESHOLD,
-        )
+        raw_outputs = [] if keep_raw else None
+        outputs = []
+        for start in range(0, len(images), self.max_batch_size):
+            batch_images = images[start : start + self.max_batch_size]
+            batch_prompts = text_prompts[start : start + self.max_batch_size]
+
+            # Tensor of found boxes (with confidence above box_threshold)
+            # Tensor of logits for text phrases
+            # List[str] of phrases from prompt found corresponding to boxes (with confidence above text_threshold)
+            predictions = self._predict_batch(
+                [image.image_tensor for image in batch_images],
+                batch_prompts,
+                BOX_TRESHOLD,
+                TEXT_TRESHOLD,
+                raw_outputs,
+            )
 
-        # Get box coordinates
-        scale_fct = torch.Tensor([img_w, img_h, img_w, img_h])
-        boxes_scaled = boxes * scale_fct
+            for image, (boxes, logits, phrases) in zip(batch_images, predictions):
+                # Get box coordinates in original image (image_source may have been decoded smaller)
+                img_w, img_h = image.original_size
+                scale_fct = torch.Tensor([img_w, img_h, img_w, img_h])
+                boxes_scaled = boxes * scale_fct
+                outputs.append((boxes, boxes_scaled, logits, phrases))
+
+        if keep_raw:
+            self.raw_outputs = [
+                RawDetection(logits, boxes, token_ids, image.original_size)
+                for (logits, boxes, token_ids), image in zip(raw_outputs, images)
+            ]
+        return outputs
+
+    def _model_inference(
+        self,
+        images: PreprocessedImage,
+        text_prompt: str,
+        threshold: float,
+        keep_raw: bool = False,
+    ):
+        """Perform object dectection on image to get boxes, logits, and phrases.
 
-        return boxes, boxes_scaled, logits, phrases
+        Args:
+        - keep_raw: Also keep unthresholded logits and boxes of every query in self.raw_outputs[0]
+        """
+        return self._model_inference_batch(
+            [images], [text_prompt], threshold, keep_raw
+        )[0]
 
     def save_detection_to_plot(self, image, filename):
-        """Save image to file system (current directory) with unique name."""
+        """Save image as artifact of current request, or to current directory with unique name if no artifact store."""
+        if self.artifact_store is None:
+            now = datetime.now()
+            timestamp = now.strftime("%m-%d_%H-%M-%S")
+            detection_filename = filename + "_" + timestamp + ".png"
+        else:
+            detection_filename = self.artifact_store.artifact_path(
+                self.request_id, filename + ".png"
+            )
+            if detection_filename is None:
+                return
+
         annotated_frame = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        plt.figure(figsize=(16, 16))
+        figure = plt.figure(figsize=(16, 16))
         plt.imshow(annotated_frame)
         plt.axis("off")
-        # Make file name
-        now = datetime.now()
-        timestamp = now.strftime("%m-%d_%H-%M-%S")
-        detection_filename = filename + "_" + timestamp + ".png"
         plt.savefig(detection_filename)
+        # Figures stay in memory until closed
+        plt.close(figure)
         self.detection_path = detection_filename
+        if self.artifact_store is not None:
+            self.artifact_store.saved()
 
     def draw_raw_detection(
         self,
@@ -95,33 +399,61 @@ class ObjectDetection:
         """Draw bounding boxes on input image and save plot."""
         boxes, boxes_scaled, logits, phrases = model_output
 
+        if boxes.numel() == 0:
+            print("No objects detected.")
+
+        if not self.keeps_artifacts():
+            return
+
         annotated_frame = annotate(
             image_source=self.images[0], boxes=boxes, logits=logits, phrases=phrases
         )
 
-        if boxes.numel() == 0:
-            print("No objects detected.")
-
-        for box in boxes_scaled:
+        for box in boxes:
             # Draw blue circle as center of each box (0, 0) is top-left of image
             annotated_frame = cv2.circle(
-                annotated_frame, (int(box[0]), int(box[1])), 10, (255, 0, 0), -1
+                annotated_frame,
+                box_center_pixel(box, self.images[0]),
+                10,
+                (255, 0, 0),
+                -1,
             )
 
         self.save_detection_to_plot(annotated_frame, draw_filename)
 
-    def _get_image(self, image_path: str) -> tuple[np.ndarray, torch.Tensor]:
+    def _get_image(self, image_path: str) -> PreprocessedImage:
         """Load image for object detection.
 
         Returns:
-        - Tuple of (raw image Numpy array, transformed image for object detection)
+        - Tuple of (raw image Numpy array, transformed image for object detection, original image size)
         """
         if not os.path.exists(image_path):
             raise FileExistsError("Detector Error: Image file does not exist.")
+        # Only the header is read
+        with Image.open(image_path) as image:
+            width, height = image.size
+        if width * height > self.governor.max_input_pixels:
+            raise DetectionException(
+                f"image is {width}x{height}, more than {self.governor.max_input_pixels} pixels"
+            )
 
-        images = load_image(image_path)
+        preprocessor = self.preprocessor
+        size, max_size = self.governor.fit_input_size(
+            preprocessor.size, preprocessor.max_size
+        )
+        if size != preprocessor.size:
+            # Lower resolution pass, so the budget isn't exceeded
+            preprocessor = ImagePreprocessor(size, max_size)
+            preprocessor.pool = self.preprocessor.pool
+        with self.governor.stage("preprocess"):
+            images = preprocessor(image_path)
         return images
 
+    def _release_model_image(self, images: PreprocessedImage) -> PreprocessedImage:
+        """Return model tensor to preprocessor for reuse, keeping only the raw image (used for drawing)."""
+        self.preprocessor.release(images)
+        return images._replace(image_tensor=None)
+
     def __call__(
         self,
         image_path: str,
@@ -129,25 +461,205 @@ class ObjectDetection:
         threshold: float,
         draw: bool = False,
         draw_filename: str = "",
+        keep_features: bool = False,
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]]:
         """Detect objects on image using prompt and threshold for model.
 
+        Args:
+        - keep_features: Also keep backbone output in self.backbone_features, see detect_on_region_features
+
         Returns:
         - Model output from object detection on image from image_path with prompt and threshold
         """
         self.images = self._get_image(image_path)
-        model_output = self._model_inference(self.images, prompt, threshold)
+        captured = []
+        hook = (
+            self.model.backbone.register_forward_hook(
+                lambda module, inputs, output: captured.append(output)
+            )
+            if keep_features
+            else None
+        )
+        try:
+            model_output = self._model_inference(self.images, prompt, threshold)
+        finally:
+            if hook is not None:
+                hook.remove()
+        if keep_features:
+            features, _ = captured[-1]
+            height, width = self.images.image_tensor.shape[-2:]
+            self.backbone_features = BackboneFeatures(
+                features, (width, height), self.images.original_size
+            )
+        self.images = self._release_model_image(self.images)
+        if draw:
+            self.draw_raw_detection(model_output, draw_filename)
+
+        return model_output
+
+    @contextmanager
+    def _backbone_replaced(self, features: list, poss: list):
+        """Model's backbone returns (features, poss) instead of encoding its input.
+
+        Not safe while other threads run detection on the same model, e.g. any server's detector (requests,
+        jobs, prefetching, and profiles share its model). Only for single-threaded tools like
+        benchmark_detection.py.
+        """
+        backbone = self.model.backbone
+        if "forward" in vars(backbone):
+            raise DetectionException(
+                "backbone is already replaced, features can't be reused on a model shared between threads"
+            )
+        backbone.forward = lambda samples: (features, poss)
+        try:
+            yield
+        finally:
+            del backbone.forward
+
+    def _region_features(
+        self, region: tuple[float, float, float, float]
+    ) -> tuple[list, list, tuple[int, int]]:
+        """ROI-align each kept feature level to region, at the size it would have if the region were cropped
+        and run through the backbone.
+
+        Returns:
+        - Features (NestedTensor per level) and position embeddings of region
+        - (width, height) model input size of the region
+        """
+        x1, y1, x2, y2 = region
+        original_width, original_height = self.backbone_features.original_size
+        input_width, input_height = self.backbone_features.input_size
+        crop_width, crop_height = get_target_size(
+            max(1, round(x2 - x1)),
+            max(1, round(y2 - y1)),
+            self.preprocessor.size,
+            self.preprocessor.max_size,
+        )
+        position_embedding = self.model.backbone[1]
+
+        features, poss = [], []
+        for level in self.backbone_features.features:
+            tensor = level.tensors
+            height, width = tensor.shape[-2:]
+            scale_x, scale_y = width / original_width, height / original_height
+            box = torch.tensor(
+                [[0, x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y]],
+                dtype=tensor.dtype,
+                device=tensor.device,
+            )
+            size = (
+                max(1, math.ceil(crop_height * height / input_height)),
+                max(1, math.ceil(crop_width * width / input_width)),
+            )
+            aligned = roi_align(
+                tensor, box, size, spatial_scale=1.0, sampling_ratio=2, aligned=True
+            )
+            mask = torch.zeros((1, *size), dtype=torch.bool, device=tensor.device)
+            nested = NestedTensor(aligned, mask)
+            features.append(nested)
+            poss.append(position_embedding(nested).to(aligned.dtype))
+        return features, poss, (crop_width, crop_height)
+
+    def detect_on_region_features(
+        self,
+        region: tuple[float, float, float, float],
+        prompt: str,
+        threshold: float,
+        draw: bool = False,
+        draw_filename: str = "",
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]]:
+        """Experimental: detect on region of the last image detected with keep_features without re-encoding it.
+
+        Backbone features of the full image are ROI-aligned to the region (upsampled, so there is no more
+        detail than the full image pass had) and only the encoder and decoder run.
+
+        Args:
+        - region: (x1, y1, x2, y2) in original image pixels
+
+        Returns:
+        - Same as __call__, with boxes in region pixels (like a detection on the cropped image)
+        """
+        if self.backbone_features is None:
+            raise DetectionException(
+                "no backbone features kept, detect with keep_features first"
+            )
+        with torch.inference_mode():
+            features, poss, (crop_width, crop_height) = self._region_features(region)
+        # Only its size is used (for the padding mask of the extra feature level)
+        placeholder = torch.zeros(3, crop_height, crop_width)
+        with self._backbone_replaced(features, poss):
+            boxes, logits, phrases = self._predict_batch(
+                [placeholder], [prompt], threshold, threshold
+            )[0]
+
+        x1, y1, x2, y2 = region
+        region_width, region_height = x2 - x1, y2 - y1
+        boxes_scaled = boxes * torch.Tensor(
+            [region_width, region_height, region_width, region_height]
+        )
+        model_output = (boxes, boxes_scaled, logits, phrases)
+
+        # Drawing uses the region of the decoded image (which may be smaller than the original)
+        source = self.images.image_source
+        source_x = source.shape[1] / self.backbone_features.original_size[0]
+        source_y = source.shape[0] / self.backbone_features.original_size[1]
+        self.images = PreprocessedImage(
+            source[
+                int(y1 * source_y) : math.ceil(y2 * source_y),
+                int(x1 * source_x) : math.ceil(x2 * source_x),
+            ],
+            None,
+            (round(region_width), round(region_height)),
+        )
         if draw:
             self.draw_raw_detection(model_output, draw_filename)
 
         return model_output
 
+    def detect_batch(
+        self,
+        image_paths: list[str],
+        prompts: list[str],
+        threshold: float,
+    ) -> list[tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]]]:
+        """Detect objects on multiple images, each with its own prompt, batching model inference.
+
+        Nothing is drawn since drawing uses the single image stored in self.images.
+
+        Returns:
+        - Model output for each image, in the same order as image_paths
+        """
+        images = [self._get_image(image_path) for image_path in image_paths]
+        outputs = self._model_inference_batch(images, prompts, threshold)
+        for image in images:
+            self._release_model_image(image)
+        return outputs
+
+
+def releases_detection(method):
+    """Interface method that is a whole detection, the detector's images and features are dropped after it."""
+
+    @wraps(method)
+    def releasing_method(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.detector.release_detection()
+
+    return releasing_method
+
 
 class ObjectDetectionInterface:
 
-    def __init__(self):
-        self.detector = ObjectDetection()
+    def __init__(self, detector: ObjectDetection = None):
+        self.detector = detector if detector is not None else ObjectDetection()
         # self.HOME = self.detector.HOME
+        # Width and height of region searched around a previous center hint, as fraction of the image size
+        self.hint_region_size = 0.4
+        # Experimental: second pass reuses first pass backbone features instead of re-encoding the crop
+        # (see ObjectDetection.detect_on_region_features and benchmark_detection.py). Never enable it on a server's
+        # detector: it swaps the shared model's backbone while detecting, which breaks detections on other threads.
+        self.reuse_features = False
 
     def _check_contains_box(
         self,
@@ -167,17 +679,12 @@ class ObjectDetectionInterface:
 
         return False
 
-    def _determine_best_box(
+    def _kept_results(
         self,
         detection_output: tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]],
-    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, str]:
-        """Gets best box from object detection given all boxes, confidences, and phrases.
-
-        Args:
-        - detection_output: All the boxes from detection in the form (boxes_unscaled, boxes, confidences, phrases)
-
-        Returns:
-        - Best box in the form of (box_unscaled, box, confidence, phrase)
+    ) -> list[tuple[torch.Tensor, torch.Tensor, torch.Tensor, str]]:
+        """Boxes that don't contain other boxes, as (box_unscaled, box, confidence, phrase) from lowest to highest
+        confidence.
         """
         # Contains only boxes that don't contain other boxes inside it
         boxes_unscaled, boxes, confidences, phrases = detection_output
@@ -204,6 +711,23 @@ class ObjectDetectionInterface:
 
         # Should at least have one box left if get to this point
         assert len(kept_results) > 0
+        return kept_results
+
+    def _determine_best_box(
+        self,
+        detection_output: tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]],
+        draw: bool = True,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, str]:
+        """Gets best box from object detection given all boxes, confidences, and phrases.
+
+        Args:
+        - detection_output: All the boxes from detection in the form (boxes_unscaled, boxes, confidences, phrases)
+        - draw: If true, draws kept boxes onto the image from the last detection and saves plot
+
+        Returns:
+        - Best box in the form of (box_unscaled, box, confidence, phrase)
+        """
+        kept_results = self._kept_results(detection_output)
 
         # Return box with highest confidence
         best_results = max(kept_results, key=lambda x: x[2])
@@ -211,10 +735,43 @@ class ObjectDetectionInterface:
         # Draws all box centers as blue dots and best box center as green dot
         # Note: Draws on existing plot from ObjectDetection which includes all boxes detected, but only
         # centers of kept boxes will be drawn
-        self.draw_detection_output(kept_results, best_results)
+        if draw:
+            self.draw_detection_output(kept_results, best_results)
 
         return best_results
 
+    def top_candidates(
+        self,
+        detection_output: tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]],
+        top_left_coord: tuple[float, float],
+        top_k: int,
+    ) -> list[Candidate]:
+        """Up to top_k boxes kept the same way as by _determine_best_box, highest confidence first.
+
+        Args:
+        - top_left_coord: Top left (x, y) of the image detection ran on (e.g. a crop) in the original image
+        """
+        kept_results = self._kept_results(detection_output)
+        offset_x, offset_y = top_left_coord
+        candidates = []
+        for _, box, confidence, phrase in reversed(kept_results[-top_k:]):
+            x, y, w, h = box.tolist()
+            x, y = x + offset_x, y + offset_y
+            candidates.append(
+                Candidate(
+                    (round(x, 1), round(y, 1)),
+                    (
+                        round(x - w / 2, 1),
+                        round(y - h / 2, 1),
+                        round(x + w / 2, 1),
+                        round(y + h / 2, 1),
+                    ),
+                    round(confidence.item(), 3),
+                    phrase,
+                )
+            )
+        return candidates
+
     def region_containing_all_boxes(
         self, boxes: torch.Tensor
     ) -> tuple[float, float, float, float]:
@@ -257,7 +814,10 @@ class ObjectDetectionInterface:
 
         now = datetime.now()
         timestamp = now.strftime("%m-%d_%H-%M-%S")
-        new_filename = "cropped_image_" + timestamp + ".jpg"
+        # Unique suffix since multiple crops can be made within the same second
+        new_filename = (
+            "cropped_image_" + timestamp + "_" + uuid.uuid4().hex[:8] + ".jpg"
+        )
         cropped_image.save(new_filename)
         return new_filename
 
@@ -274,6 +834,9 @@ class ObjectDetectionInterface:
 
         Saves plot to file system.
         """
+        if not self.detector.keeps_artifacts():
+            return
+
         # Add to current plot from ObjectDetector
         boxes_unscaled, boxes, logits, phrases = zip(*kept_output)
         boxes_unscaled = torch.stack(boxes_unscaled)
@@ -287,17 +850,21 @@ class ObjectDetectionInterface:
             phrases=phrases,
         )
 
-        for box in boxes:
+        for box in boxes_unscaled:
             # Draw blue circle as center of each box (0, 0) is top-left of image
             annotated_frame = cv2.circle(
-                annotated_frame, (int(box[0]), int(box[1])), 10, (255, 0, 0), -1
+                annotated_frame,
+                box_center_pixel(box, self.detector.images[0]),
+                10,
+                (255, 0, 0),
+                -1,
             )
 
-        best_box = best_output[1]
+        best_box = best_output[0]
         # Draw green dot for best box
         annotated_frame = cv2.circle(
             annotated_frame,
-            (int(best_box[0]), int(best_box[1])),
+            box_center_pixel(best_box, self.detector.images[0]),
             10,
             (0, 255, 0),
             -1,
@@ -313,50 +880,205 @@ class ObjectDetectionInterface:
         box_threshold: float,
         draw_raw: bool = False,
         draw_filename: str = "",
+        request_id: str = None,
+        keep_features: bool = False,
+        memo: InferenceMemo = None,
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[str]]:
         """Run GroundingDINO on file path specified.
         Args:
         - draw_raw: If true, draws direct output from GroundingDINO onto a plot
+        - request_id: Request this detection is for, plots are saved as its artifacts
+        - keep_features: Keep backbone features for detecting on a region afterwards (memo isn't used)
+        - memo: Output of an identical earlier inference of the request is reused from it, and new output is kept
 
         Returns:
         - Output of model: Tuple of (boxes_unscaled, boxes, confidences, phrases)
         """
+        key = None
+        if memo is not None and not keep_features:
+            key = memo.key(filepath, text_prompt, box_threshold)
+            entry = memo.get(key)
+            if entry is not None:
+                result, images = entry
+                # Restore image the output was detected on, drawing uses it
+                self.detector.setup_new_detection(request_id)
+                self.detector.images = images
+                if draw_raw:
+                    self.detector.draw_raw_detection(result, draw_filename)
+                return result
+
         # Run model on image
-        self.detector.setup_new_detection()
+        self.detector.setup_new_detection(request_id)
         result = self.detector(
             filepath,
             text_prompt,
             box_threshold,
             draw_raw,
             draw_filename,
+            keep_features,
         )
+        if key is not None:
+            memo.put(key, result, self.detector.images)
 
         return result
 
+    def hint_region(
+        self,
+        image_size: tuple[int, int],
+        roi: tuple[float, float, float, float] = None,
+        previous_center: tuple[float, float] = None,
+    ) -> tuple[float, float, float, float]:
+        """Region to search first given client hints, clipped to the image.
+
+        Args:
+        - image_size: (width, height) of image
+        - roi: (x1, y1, x2, y2) region of interest in image pixels, used if given
+        - previous_center: (x, y) where the object was last found, region of hint_region_size is centered on it
+
+        Returns:
+        - (x1, y1, x2, y2) region, None if there are no hints or the region is outside the image
+        """
+        width, height = image_size
+        if roi is not None:
+            x1, y1, x2, y2 = roi
+        elif previous_center is not None:
+            x, y = previous_center
+            half_w = width * self.hint_region_size / 2
+            half_h = height * self.hint_region_size / 2
+            x1, y1, x2, y2 = x - half_w, y - half_h, x + half_w, y + half_h
+        else:
+            return None
+
+        x1, y1 = max(0.0, float(x1)), max(0.0, float(y1))
+        x2, y2 = min(float(width), float(x2)), min(float(height), float(y2))
+        # Need at least a few pixels to detect on
+        if x2 - x1 < 8 or y2 - y1 < 8:
+            return None
+        return (x1, y1, x2, y2)
+
+    def run_object_detection_on_region(
+        self,
+        filepath: str,
+        region: tuple[float, float, float, float],
+        text_prompt: str,
+        threshold: float,
+        request_id: str = None,
+        memo: InferenceMemo = None,
+        top_k: int = 0,
+        candidates: list = None,
+    ):
+        """Single detection pass on a region of the image (e.g. from client hints).
+
+        Returns:
+        - Same as run_object_detection_with_crop, or (None, None, None) if nothing is found above threshold
+        """
+        cropped_image_path = self.crop_image_to_box(region, filepath)
+        detection_output = self.run_object_detection(
+            cropped_image_path,
+            text_prompt,
+            threshold,
+            draw_raw=True,
+            draw_filename="hint_region",
+            request_id=request_id,
+            memo=memo,
+        )
+
+        if detection_output[1].numel() == 0:
+            os.remove(cropped_image_path)
+            return None, None, None
+
+        _, best_box, confidence, best_phrase = self._determine_best_box(
+            detection_output
+        )
+        if top_k > 0:
+            candidates.extend(self.top_candidates(detection_output, region[:2], top_k))
+        print(
+            f"SELECTED BOX (hint region):\nconfidence: {confidence}\nbox: {best_box.tolist()}\nphrase: {best_phrase}"
+        )
+        return best_box.tolist()[:2], region[:2], cropped_image_path
+
+    @releases_detection
     def run_object_detection_with_crop(
         self,
         filepath: str,
         text_prompt: str,
         first_threshold: float,
         second_threshold: float,
+        request_id: str = None,
+        roi: tuple[float, float, float, float] = None,
+        previous_center: tuple[float, float] = None,
+        single_pass: bool = False,
+        memo: InferenceMemo = None,
+        top_k: int = 0,
+        candidates: list = None,
     ):
         """Steps:
+        - If there are hints (roi or previous_center), runs detection on the hinted region only and returns
+          its best box if any box is found
         - Runs detection on input image
-        - Crops to region containing all bounding boxes
-        - Runs detection again on cropped image
+        - Crops to region containing all bounding boxes (skipped if single_pass)
+        - Runs detection again on cropped image (skipped if single_pass)
         - Outputs highest confidence result
 
         Args:
         - filepath: Image path to run object detection on
         - text_prompt: Prompt to send to GroundingDINO for detection
         - first_threshold: Bounding box lower confidence for object detection in first (cropping) pass
-        - second_threshold: Bounding box lower confidence for object detection in final pass
+        - second_threshold: Bounding box lower confidence for object detection in final pass (and hint region)
+        - request_id: Request this detection is for, plots are saved as its artifacts
+        - roi: Optional (x1, y1, x2, y2) region of interest in image pixels (e.g. where the user is looking)
+        - previous_center: Optional (x, y) in image pixels where the object was last found
+        - single_pass: Pick the best box of one full image pass at second_threshold, cheaper but less accurate
+          on small objects (used when a request is short on time)
+        - memo: Inferences already run by the request (e.g. the operator flow's crop for GPT) are reused from it
+        - top_k: If over 0, up to top_k best boxes of the final pass are appended to candidates (as Candidate)
 
         Returns:
         - center: (x, y) coordinate in cropped image of result from object detection
         - top_left_coord: Top left (x, y) coordinate of cropped image for calculating position in original image
         - cropped_image_path: String path of saved cropped image
         """
+        if roi is not None or previous_center is not None:
+            with Image.open(filepath) as image:
+                region = self.hint_region(image.size, roi, previous_center)
+            if region is not None:
+                result = self.run_object_detection_on_region(
+                    filepath,
+                    region,
+                    text_prompt,
+                    second_threshold,
+                    request_id,
+                    memo,
+                    top_k,
+                    candidates,
+                )
+                if result[0] is not None:
+                    return result
+                print("Nothing found in hint region, searching full image.")
+
+        if single_pass:
+            detection_output = self.run_object_detection(
+                filepath,
+                text_prompt,
+                second_threshold,
+                draw_raw=True,
+                draw_filename="single_pass",
+                request_id=request_id,
+                memo=memo,
+            )
+            if detection_output[1].numel() == 0:
+                print("No objects detected during single object detection pass.")
+                return None, None, None
+            _, best_box, confidence, best_phrase = self._determine_best_box(
+                detection_output
+            )
+            if top_k > 0:
+                candidates.extend(self.top_candidates(detection_output, (0, 0), top_k))
+            print(
+                f"SELECTED BOX (single pass):\nconfidence: {confidence}\nbox: {best_box.tolist()}\nphrase: {best_phrase}"
+            )
+            return best_box.tolist()[:2], (0, 0), None
+
         # First pass saves raw detection output to plot
         _, boxes_pass1, _, _ = self.run_object_detection(
             filepath,
@@ -364,6 +1086,9 @@ class ObjectDetectionInterface:
             first_threshold,
             draw_raw=True,
             draw_filename="pre_cropped",
+            request_id=request_id,
+            keep_features=self.reuse_features,
+            memo=memo,
         )
 
         if boxes_pass1.numel() == 0:
@@ -372,14 +1097,28 @@ class ObjectDetectionInterface:
 
         # Run object detection again after cropping image to largest box
         region = self.region_containing_all_boxes(boxes_pass1)
-        cropped_image_path = self.crop_image_to_box(region, filepath)
-        detection_output = self.run_object_detection(
-            cropped_image_path,
-            text_prompt,
-            second_threshold,
-            draw_raw=True,
-            draw_filename="cropped",
-        )
+        if self.reuse_features:
+            cropped_image_path = None
+            detection_output = self.detector.detect_on_region_features(
+                region,
+                text_prompt,
+                second_threshold,
+                draw=True,
+                draw_filename="cropped",
+            )
+            # Features take a lot of memory, don't keep them until the next detection
+            self.detector.backbone_features = None
+        else:
+            cropped_image_path = self.crop_image_to_box(region, filepath)
+            detection_output = self.run_object_detection(
+                cropped_image_path,
+                text_prompt,
+                second_threshold,
+                draw_raw=True,
+                draw_filename="cropped",
+                request_id=request_id,
+                memo=memo,
+            )
 
         _, boxes, confidences, phrases = detection_output
         if boxes.numel() == 0:
@@ -400,9 +1139,99 @@ class ObjectDetectionInterface:
 
         center = best_box.tolist()[:2]
         top_left_coord = region[:2]
+        if top_k > 0:
+            candidates.extend(
+                self.top_candidates(detection_output, top_left_coord, top_k)
+            )
 
         return center, top_left_coord, cropped_image_path
 
+    @releases_detection
+    def run_object_detection_with_crop_batch(
+        self,
+        filepaths: list[str],
+        text_prompts: list[str],
+        first_threshold: float,
+        second_threshold: float,
+        top_k: int = 0,
+        candidates: list = None,
+    ) -> list[tuple[list[float], tuple[float, float], str]]:
+        """Same steps as run_object_detection_with_crop for multiple images, batching each pass.
+
+        Args:
+        - filepaths: Image paths to run object detection on
+        - text_prompts: Prompt for each image
+        - top_k: If over 0, a list of up to top_k best boxes (as Candidate) is appended to candidates for each
+          image in order, empty if nothing was detected
+
+        Returns:
+        - List of (center, top_left_coord, cropped_image_path) for each image in order, see
+          run_object_detection_with_crop. Entries are (None, None, None) if nothing was detected.
+        """
+        results = [(None, None, None)] * len(filepaths)
+        image_candidates = [[] for _ in filepaths]
+        if top_k > 0:
+            candidates.extend(image_candidates)
+
+        self.detector.setup_new_detection()
+        first_outputs = self.detector.detect_batch(
+            filepaths, text_prompts, first_threshold
+        )
+
+        # Crop images that had boxes to region containing all boxes
+        crop_indices = []
+        regions = []
+        cropped_paths = []
+        for i, (_, boxes_pass1, _, _) in enumerate(first_outputs):
+            if boxes_pass1.numel() == 0:
+                print(f"No objects detected during first pass for image {i}.")
+                continue
+            region = self.region_containing_all_boxes(boxes_pass1)
+            crop_indices.append(i)
+            regions.append(region)
+            cropped_paths.append(self.crop_image_to_box(region, filepaths[i]))
+
+        if len(crop_indices) == 0:
+            return results
+
+        second_outputs = self.detector.detect_batch(
+            cropped_paths,
+            [text_prompts[i] for i in crop_indices],
+            second_threshold,
+        )
+
+        for i, region, cropped_path, detection_output in zip(
+            crop_indices, regions, cropped_paths, second_outputs
+        ):
+            if detection_output[1].numel() == 0:
+                print(f"No objects detected during second pass for image {i}.")
+                results[i] = (None, None, cropped_path)
+                continue
+
+            _, best_box, confidence, best_phrase = self._determine_best_box(
+                detection_output, draw=False
+            )
+            print(
+                f"SELECTED BOX (image {i}):\nconfidence: {confidence}\nbox: {best_box.tolist()}\nphrase: {best_phrase}"
+            )
+            results[i] = (best_box.tolist()[:2], region[:2], cropped_path)
+            if top_k > 0:
+                image_candidates[i].extend(
+                    self.top_candidates(detection_output, region[:2], top_k)
+                )
+
+        return results
+
+    def keep_artifact(self, request_id: str, name: str, filepath: str) -> bool:
+        """Move file (e.g. a crop sent to GPT) into artifact store if request is sampled.
+
+        Returns:
+        - True if file was moved into the store, False if left where it is
+        """
+        if self.detector.artifact_store is None:
+            return False
+        return self.detector.artifact_store.add_file(request_id, name, filepath)
+
     def prime_detection_with_test(self):
         """Runs object detection on dummy image with dummy prompt (since first run always takes longer)."""
         test_filepath = "data/HL_coffee_pic.jpg"
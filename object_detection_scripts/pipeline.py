@@ -0,0 +1,323 @@
+"""Staged detection pipeline so image work for one request overlaps model inference for another.
+
+Stages (each connected by a bounded queue):
+- Preprocess: decode/crop/resize/normalize in a process pool (avoids the GIL), fed by one thread per process
+- Model: one thread running GroundingDINO, batching whatever preprocessed images are waiting
+- Post-process: picks the best box and maps its center back to the original image
+
+Each request goes through preprocess and model twice (full image, then crop), same as
+ObjectDetectionInterface.run_object_detection_with_crop. Requests with a hint region go through once on that
+region first, and only take the two full passes if nothing is found there. Single pass requests skip the
+cropped pass and pick the best box of the full image pass.
+"""
+
+import itertools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+from object_detection import DetectionException, ObjectDetectionInterface
+from preprocessing import ImagePreprocessor, PreprocessedImage
+
+# Preprocessor in each worker process, created on first use
+_worker_preprocessor: ImagePreprocessor = None
+
+
+def preprocess_in_worker(
+    source: Union[str, bytes],
+    region: tuple[float, float, float, float],
+    size: int,
+    max_size: int,
+) -> tuple[np.ndarray, tuple[int, int]]:
+    """Runs in a worker process: decode (and crop) image and make normalized model input array.
+
+    Only uses numpy/PIL so it is safe in a process forked from the server.
+
+    Returns:
+    - (3, H, W) float32 model input
+    - Original (width, height) of image or region
+    """
+    global _worker_preprocessor
+    if _worker_preprocessor is None:
+        _worker_preprocessor = ImagePreprocessor(size, max_size)
+    image, original_size = _worker_preprocessor.decode(source, region)
+    return _worker_preprocessor.to_array(image), original_size
+
+
+def start_preprocess_pool(workers: int) -> ProcessPoolExecutor:
+    """Fork the preprocessing worker processes now, before the model is loaded and any thread is started.
+
+    Forking a process that already runs other threads (torch, jobs, prefetching) can deadlock the child on a
+    lock one of them held. Fork (not spawn or forkserver) keeps workers from re-running the server's module, which
+    would load the model again.
+    """
+    pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    )
+    # With fork, the first task starts every worker at once (none are started later)
+    pool.submit(int).result()
+    return pool
+
+
+class PipelineRequest:
+    """State of one request as it moves through the pipeline stages."""
+
+    def __init__(
+        self,
+        source,
+        text_prompt,
+        first_threshold,
+        second_threshold,
+        hint_region: tuple[float, float, float, float] = None,
+        single_pass: bool = False,
+        top_k: int = 0,
+        candidates: list = None,
+    ):
+        self.source = source
+        self.text_prompt = text_prompt
+        self.single_pass = single_pass
+        # Full image pass is the final one when single pass
+        full_threshold = second_threshold if single_pass else first_threshold
+        self.thresholds = (second_threshold, full_threshold, second_threshold)
+        # 0 for hint region pass, 1 for full image pass, 2 for cropped pass
+        self.pass_num = 0 if hint_region is not None else 1
+        self.region: tuple[float, float, float, float] = hint_region
+        self.images: PreprocessedImage = None
+        self.model_output = None
+        self.top_k = top_k
+        self.candidates = candidates
+        self.future = Future()
+
+    @property
+    def threshold(self) -> float:
+        return self.thresholds[self.pass_num]
+
+
+class DetectionPipeline:
+    """Runs run_object_detection_with_crop requests through overlapping stages.
+
+    Has the same run_object_detection_with_crop method as ObjectDetectionInterface, so it can be passed
+    anywhere a detector is used for two-pass detection.
+    """
+
+    def __init__(
+        self,
+        detector: ObjectDetectionInterface,
+        preprocess_workers: int = 4,
+        max_in_flight: int = 16,
+        submit_timeout: float = 30,
+        pool: ProcessPoolExecutor = None,
+    ):
+        """
+        Args:
+        - detector: Detector whose model is used by the model stage
+        - preprocess_workers: Number of processes (and feeding threads) doing image preprocessing
+        - max_in_flight: Max requests in the pipeline at once, submitting more blocks (backpressure)
+        - submit_timeout: Seconds to wait for room in the pipeline before rejecting a request
+        - pool: Preprocessing worker processes from start_preprocess_pool, started here if None (only safe if
+          no other thread has started yet)
+        """
+        self.detector = detector
+        self.submit_timeout = submit_timeout
+        preprocessor = detector.detector.preprocessor
+        self.size = preprocessor.size
+        self.max_size = preprocessor.max_size
+
+        self.pool = (
+            pool if pool is not None else start_preprocess_pool(preprocess_workers)
+        )
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Queues can hold every request in flight, so stages never block each other (no deadlock)
+        # Cropped (second pass) requests go first since they are closer to finishing
+        self.preprocess_queue = queue.PriorityQueue(max_in_flight)
+        self.model_queue = queue.Queue(max_in_flight)
+        self.post_queue = queue.Queue(max_in_flight)
+        self.order = itertools.count()
+
+        self.threads = [
+            threading.Thread(target=self._preprocess_stage, daemon=True)
+            for _ in range(preprocess_workers)
+        ]
+        self.threads.append(threading.Thread(target=self._model_stage, daemon=True))
+        self.threads.append(threading.Thread(target=self._post_stage, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def _queue_preprocess(self, request: PipelineRequest):
+        # Lower pass number sorts last, count keeps FIFO order within a pass
+        self.preprocess_queue.put((-request.pass_num, next(self.order), request))
+
+    def submit(
+        self,
+        source: Union[str, bytes],
+        text_prompt: str,
+        first_threshold: float,
+        second_threshold: float,
+        hint_region: tuple[float, float, float, float] = None,
+        single_pass: bool = False,
+        top_k: int = 0,
+        candidates: list = None,
+    ) -> Future:
+        """Add request to pipeline, blocks while the pipeline is full.
+
+        Args:
+        - hint_region: Optional (x1, y1, x2, y2) region searched first, see ObjectDetectionInterface.hint_region
+        - single_pass: Skip the cropped pass, see ObjectDetectionInterface.run_object_detection_with_crop
+        - top_k, candidates: Up to top_k best final boxes are appended to candidates before the future is done
+
+        Returns:
+        - Future with (center, top_left_coord) result, see run_object_detection_with_crop
+        """
+        if not self.in_flight.acquire(timeout=self.submit_timeout):
+            raise DetectionException("detection pipeline is full, try again later")
+
+        request = PipelineRequest(
+            source,
+            text_prompt,
+            first_threshold,
+            second_threshold,
+            hint_region,
+            single_pass,
+            top_k,
+            candidates,
+        )
+        request.future.add_done_callback(lambda _: self.in_flight.release())
+        self._queue_preprocess(request)
+        return request.future
+
+    def run_object_detection_with_crop(
+        self,
+        filepath: str,
+        text_prompt: str,
+        first_threshold: float,
+        second_threshold: float,
+        request_id: str = None,
+        roi: tuple[float, float, float, float] = None,
+        previous_center: tuple[float, float] = None,
+        single_pass: bool = False,
+        top_k: int = 0,
+        candidates: list = None,
+    ):
+        """Blocking version of submit, returns same as ObjectDetectionInterface.run_object_detection_with_crop.
+
+        No cropped image file is made, so the cropped image path is always None. Detection plots aren't drawn
+        in the pipeline, so request_id (for artifacts) is unused.
+        """
+        hint_region = None
+        if roi is not None or previous_center is not None:
+            with Image.open(filepath) as image:
+                hint_region = self.detector.hint_region(
+                    image.size, roi, previous_center
+                )
+        center, top_left_coord = self.submit(
+            filepath,
+            text_prompt,
+            first_threshold,
+            second_threshold,
+            hint_region,
+            single_pass,
+            top_k,
+            candidates,
+        ).result()
+        return center, top_left_coord, None
+
+    def _preprocess_stage(self):
+        while True:
+            _, _, request = self.preprocess_queue.get()
+            try:
+                array, original_size = self.pool.submit(
+                    preprocess_in_worker,
+                    request.source,
+                    request.region,
+                    self.size,
+                    self.max_size,
+                ).result()
+                request.images = PreprocessedImage(
+                    None, torch.from_numpy(array), original_size
+                )
+                self.model_queue.put(request)
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def _model_stage(self):
+        model = self.detector.detector
+        while True:
+            # Batch everything that is ready, grouped by threshold
+            requests = [self.model_queue.get()]
+            while len(requests) < model.max_batch_size:
+                try:
+                    requests.append(self.model_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for threshold in set(request.threshold for request in requests):
+                batch = [r for r in requests if r.threshold == threshold]
+                try:
+                    outputs = model._model_inference_batch(
+                        [r.images for r in batch],
+                        [r.text_prompt for r in batch],
+                        threshold,
+                    )
+                except Exception as e:
+                    for request in batch:
+                        request.future.set_exception(e)
+                    continue
+                for request, output in zip(batch, outputs):
+                    # Model input isn't needed anymore
+                    request.images = None
+                    request.model_output = output
+                    self.post_queue.put(request)
+
+    def _post_stage(self):
+        while True:
+            request = self.post_queue.get()
+            try:
+                self._post_process(request)
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def _post_process(self, request: PipelineRequest):
+        _, boxes, _, _ = request.model_output
+        if boxes.numel() == 0 and request.pass_num == 0:
+            print("Nothing found in hint region, searching full image (pipeline).")
+            request.region = None
+            request.pass_num = 1
+            request.model_output = None
+            self._queue_preprocess(request)
+            return
+        if boxes.numel() == 0:
+            print(f"No objects detected during pass {request.pass_num} (pipeline).")
+            request.future.set_result((None, None))
+            return
+
+        if request.pass_num == 1 and not request.single_pass:
+            # Send back through pipeline on region containing all boxes
+            request.region = self.detector.region_containing_all_boxes(boxes)
+            request.pass_num = 2
+            request.model_output = None
+            self._queue_preprocess(request)
+            return
+
+        _, best_box, confidence, best_phrase = self.detector._determine_best_box(
+            request.model_output, draw=False
+        )
+        print(
+            f"SELECTED BOX (pipeline):\nconfidence: {confidence}\nbox: {best_box.tolist()}\nphrase: {best_phrase}"
+        )
+        top_left_coord = request.region[:2] if request.region is not None else (0, 0)
+        if request.top_k > 0:
+            request.candidates.extend(
+                self.detector.top_candidates(
+                    request.model_output, top_left_coord, request.top_k
+                )
+            )
+        request.future.set_result((best_box.tolist()[:2], top_left_coord))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
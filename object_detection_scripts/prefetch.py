@@ -0,0 +1,204 @@
+"""Speculative detection of the user's next steps while they are still doing the current one.
+
+After each user-mode frame, detection for the next pictures/instructions in 'parser_output.json' is run in the
+background on the latest frame. When the next '/upload_image' request arrives with a frame that looks the same
+as the one speculated on (small thumbnail difference), it is answered from that result instead of running
+two-pass detection again.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import metrics
+from task_guidance import OUTPUT_FILE, delete_images
+
+# Size of grayscale thumbnail used to tell if the scene changed
+SIGNATURE_SIZE = (32, 24)
+
+
+def frame_signature(image_path: str) -> np.ndarray:
+    """Small grayscale thumbnail of an image, cheap to compare between frames."""
+    with Image.open(image_path) as image:
+        # Decode JPEGs at reduced scale, only a thumbnail is needed
+        image.draft("L", (SIGNATURE_SIZE[0] * 8, SIGNATURE_SIZE[1] * 8))
+        thumbnail = image.convert("L").resize(SIGNATURE_SIZE, Image.BILINEAR)
+        return np.asarray(thumbnail, dtype=np.float32)
+
+
+def frame_difference(signature1: np.ndarray, signature2: np.ndarray) -> float:
+    """Mean absolute pixel difference (0-255) between two frame signatures."""
+    return float(np.mean(np.abs(signature1 - signature2)))
+
+
+def next_detections(instruction_num: int, picture_num: int) -> list[tuple[int, int]]:
+    """(instruction, picture) the user will most likely send next: rest of this instruction's pictures, then
+    every picture of the next instruction.
+    """
+    with open(OUTPUT_FILE, "r") as file:
+        if len(file.read(1)) == 0:
+            return []
+        file.seek(0)
+        json_data = json.load(file)
+
+    targets = []
+    for num in (instruction_num, instruction_num + 1):
+        if str(num) not in json_data:
+            continue
+        first_picture = picture_num + 1 if num == instruction_num else 0
+        num_pictures = len(json_data[str(num)]["objects"])
+        targets.extend((num, picture) for picture in range(first_picture, num_pictures))
+    return targets
+
+
+class PrefetchFrame(NamedTuple):
+    """Latest frame and what to speculatively detect on it."""
+
+    path: str
+    signature: np.ndarray
+    targets: list[tuple[int, int]]
+
+
+class PrefetchResult(NamedTuple):
+    signature: np.ndarray
+    center: tuple[float, float]
+    action: str
+    created: float
+
+
+class Prefetcher:
+    """Runs detection for the next steps on the latest frame in a background thread, newest frame wins."""
+
+    def __init__(
+        self,
+        detect: Callable[[str, int, int], tuple[tuple[float, float], str]],
+        detection_lock: threading.Lock,
+        max_difference: float = 6.0,
+        max_age: float = 60,
+    ):
+        """
+        Args:
+        - detect: detect(image_path, instruction_num, picture_num) -> (center, action), e.g. detect_objects_from_json
+        - detection_lock: Held while detecting, shared with request handlers when the detector isn't thread-safe
+        - max_difference: Max frame_difference for the scene to count as unchanged
+        - max_age: Seconds a speculative result can be used for
+        """
+        self.detect = detect
+        self.detection_lock = detection_lock
+        self.max_difference = max_difference
+        self.max_age = max_age
+        # (instruction_num, picture_num) -> result
+        self.results: dict[tuple[int, int], PrefetchResult] = {}
+        # Targets of the latest frame
+        self.targets: list[tuple[int, int]] = []
+        self.pending: PrefetchFrame = None
+        # Incremented by clear, results of detections started before it are dropped
+        self.generation = 0
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def update_frame(self, image_path: str, targets: list[tuple[int, int]]):
+        """Speculate on new frame (copied, caller can delete image_path), replacing any frame not started yet."""
+        if len(targets) == 0:
+            return
+        _, extension = os.path.splitext(image_path)
+        frame_path = f"prefetch_frame_{uuid.uuid4().hex[:8]}{extension}"
+        shutil.copyfile(image_path, frame_path)
+        frame = PrefetchFrame(frame_path, frame_signature(frame_path), targets)
+
+        with self.changed:
+            # Results for anything no longer a target won't be asked for
+            self.results = {
+                target: result
+                for target, result in self.results.items()
+                if target in targets
+            }
+            self.targets = targets
+            replaced = self.pending
+            self.pending = frame
+            self.changed.notify()
+        if replaced is not None:
+            delete_images(replaced.path)
+
+    def _is_match(
+        self, result: PrefetchResult, signature: np.ndarray, now: float
+    ) -> bool:
+        return (
+            now - result.created <= self.max_age
+            and frame_difference(result.signature, signature) <= self.max_difference
+        )
+
+    def lookup(
+        self, image_path: str, instruction_num: int, picture_num: int
+    ) -> tuple[tuple[float, float], str]:
+        """Speculative (center, action) for request if its frame matches the one detected on, else None."""
+        with self.changed:
+            result = self.results.get((instruction_num, picture_num))
+
+        if result is None:
+            metrics.increment("prefetch_misses")
+            return None
+        if not self._is_match(result, frame_signature(image_path), time.time()):
+            metrics.increment("prefetch_misses")
+            metrics.increment("prefetch_misses_scene_changed")
+            return None
+
+        metrics.increment("prefetch_hits")
+        print(f"Prefetch hit for instruction {instruction_num} picture {picture_num}")
+        return result.center, result.action
+
+    def clear(self):
+        """Forget all speculative results, e.g. when parser output changes."""
+        with self.changed:
+            self.results.clear()
+            self.targets = []
+            self.generation += 1
+
+    def _run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending is not None)
+                frame = self.pending
+                self.pending = None
+            try:
+                self._prefetch(frame)
+            finally:
+                delete_images(frame.path)
+
+    def _prefetch(self, frame: PrefetchFrame):
+        for target in frame.targets:
+            with self.changed:
+                # Newer frame arrived, start over on it
+                if self.pending is not None:
+                    return
+                existing = self.results.get(target)
+                generation = self.generation
+            if existing is not None and self._is_match(
+                existing, frame.signature, time.time()
+            ):
+                continue
+
+            try:
+                with self.detection_lock:
+                    center, action = self.detect(frame.path, *target)
+            except Exception as e:
+                print(
+                    f"Prefetch of instruction {target[0]} picture {target[1]} failed: {e}"
+                )
+                continue
+            metrics.increment("prefetch_detections")
+
+            with self.changed:
+                # Skip if a newer frame's targets don't include it anymore, or parser output changed meanwhile
+                if target in self.targets and generation == self.generation:
+                    self.results[target] = PrefetchResult(
+                        frame.signature, center, action, time.time()
+                    )
@@ -0,0 +1,200 @@
+import io
+import math
+import threading
+import time
+from typing import NamedTuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Same normalization as GroundingDINO's load_image (ImageNet mean and std)
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# Folds ToTensor (/255) and Normalize into one multiply-add per pixel
+SCALE = (1.0 / (255.0 * STD))[:, None, None]
+OFFSET = (-MEAN / STD)[:, None, None]
+# Modes Image.reduce can average directly (palette and 1-bit images are converted to RGB first)
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "YCbCr")
+
+
+class PreprocessedImage(NamedTuple):
+    """Image ready for object detection, indexable like load_image's (image_source, image_transformed) tuple."""
+
+    # RGB image as decoded (may be smaller than the original if decoded with JPEG draft mode)
+    image_source: np.ndarray
+    # Resized and normalized (3, H, W) tensor for the model
+    image_tensor: torch.Tensor
+    # (width, height) of the original image, boxes are scaled to this size
+    original_size: tuple[int, int]
+
+
+def get_target_size(
+    width: int, height: int, size: int = 800, max_size: int = 1333
+) -> tuple[int, int]:
+    """Size (width, height) image is resized to for the model, same as GroundingDINO's RandomResize([size], max_size)."""
+    min_original_size = float(min(width, height))
+    max_original_size = float(max(width, height))
+    if max_original_size / min_original_size * size > max_size:
+        size = int(round(max_size * min_original_size / max_original_size))
+
+    if (width <= height and width == size) or (height <= width and height == size):
+        return width, height
+    if width < height:
+        return size, int(size * height / width)
+    return int(size * width / height), size
+
+
+class TensorPool:
+    """Preallocated model input tensors, reused for images of the same size."""
+
+    def __init__(self, max_per_shape: int = 4, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+        - max_per_shape: Max free tensors kept of each shape
+        - max_bytes: Max total size of free tensors, crops of every size would otherwise keep adding shapes
+        """
+        self.max_per_shape = max_per_shape
+        self.max_bytes = max_bytes
+        self.free: dict[tuple[int, ...], list[torch.Tensor]] = {}
+        self.free_bytes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, shape: tuple[int, ...]) -> torch.Tensor:
+        with self.lock:
+            tensors = self.free.get(shape)
+            if tensors:
+                tensor = tensors.pop()
+                self.free_bytes -= tensor.nbytes
+                return tensor
+        return torch.empty(shape, dtype=torch.float32)
+
+    def release(self, tensor: torch.Tensor):
+        """Return tensor to the pool, it must not be used by the caller afterwards."""
+        with self.lock:
+            tensors = self.free.setdefault(tuple(tensor.shape), [])
+            if (
+                len(tensors) < self.max_per_shape
+                and self.free_bytes + tensor.nbytes <= self.max_bytes
+            ):
+                tensors.append(tensor)
+                self.free_bytes += tensor.nbytes
+
+
+class ImagePreprocessor:
+    """Decodes, resizes, and normalizes images for GroundingDINO in place of load_image.
+
+    - JPEGs are decoded at a reduced scale (DCT scaling, 1/2 to 1/8) when still larger than the model input size
+    - Other images more than twice the model input size are reduced right after decoding, so the decoded image
+      kept for drawing isn't much larger than what the model sees
+    - ToTensor and Normalize are done in one vectorized step written into a pooled tensor
+    """
+
+    def __init__(self, size: int = 800, max_size: int = 1333):
+        self.size = size
+        self.max_size = max_size
+        self.pool = TensorPool()
+
+    def decode(
+        self,
+        source: Union[str, bytes, Image.Image],
+        region: tuple[float, float, float, float] = None,
+    ) -> tuple[Image.Image, tuple[int, int]]:
+        """Decode image from path, bytes, or PIL image.
+
+        Args:
+        - region: Optional (x1, y1, x2, y2) box in original image pixels to crop to
+
+        Returns:
+        - RGB PIL image (cropped to region), possibly decoded at a reduced size
+        - Original (width, height) of image (or of region)
+        """
+        if isinstance(source, Image.Image):
+            image = source
+        elif isinstance(source, bytes):
+            image = Image.open(io.BytesIO(source))
+        else:
+            image = Image.open(source)
+
+        full_size = image.size
+        if region is not None:
+            # Same rounding as PIL's crop
+            box = tuple(int(round(coord)) for coord in region)
+            original_size = (box[2] - box[0], box[3] - box[1])
+        else:
+            original_size = full_size
+
+        if image.format == "JPEG":
+            # Scale full image so the region still decodes to at least the model input size.
+            # Decoder picks the largest scale reduction that keeps image at least the requested size.
+            target_w, target_h = get_target_size(
+                *original_size, self.size, self.max_size
+            )
+            image.draft(
+                "RGB",
+                (
+                    math.ceil(full_size[0] * target_w / original_size[0]),
+                    math.ceil(full_size[1] * target_h / original_size[1]),
+                ),
+            )
+
+        # Images decoded in full (e.g. PNGs) are reduced by an integer factor, staying at least twice the
+        # model input size. Reduced before converting, so only the smaller image is converted to RGB.
+        target_w, target_h = get_target_size(*original_size, self.size, self.max_size)
+        factor = min(
+            original_size[0] // (2 * target_w), original_size[1] // (2 * target_h)
+        )
+        if factor >= 2 and image.size == full_size:
+            if image.mode not in REDUCIBLE_MODES:
+                image = image.convert("RGB")
+            image = image.reduce(factor)
+        image = image.convert("RGB")
+
+        if region is not None:
+            scale_x = image.size[0] / full_size[0]
+            scale_y = image.size[1] / full_size[1]
+            image = image.crop(
+                (
+                    box[0] * scale_x,
+                    box[1] * scale_y,
+                    box[2] * scale_x,
+                    box[3] * scale_y,
+                )
+            )
+
+        return image, original_size
+
+    def to_array(self, image: Image.Image, out: np.ndarray = None) -> np.ndarray:
+        """Resize image to model input size and normalize into a (3, H, W) float32 array (out if given)."""
+        target_w, target_h = get_target_size(*image.size, self.size, self.max_size)
+        if (target_w, target_h) != image.size:
+            image = image.resize((target_w, target_h), Image.BILINEAR)
+
+        pixels = np.asarray(image).transpose(2, 0, 1)
+        if out is None:
+            out = np.empty((3, target_h, target_w), dtype=np.float32)
+        np.multiply(pixels, SCALE, out=out)
+        out += OFFSET
+        return out
+
+    def to_tensor(self, image: Image.Image) -> torch.Tensor:
+        """Resize image to model input size and normalize into a pooled (3, H, W) float tensor."""
+        target_w, target_h = get_target_size(*image.size, self.size, self.max_size)
+        tensor = self.pool.acquire((3, target_h, target_w))
+        self.to_array(image, out=tensor.numpy())
+        return tensor
+
+    def __call__(
+        self,
+        source: Union[str, bytes, Image.Image],
+        region: tuple[float, float, float, float] = None,
+    ) -> PreprocessedImage:
+        begin = time.time()
+        image, original_size = self.decode(source, region)
+        image_tensor = self.to_tensor(image)
+        print(f"Preprocessing time: {time.time() - begin} s")
+        return PreprocessedImage(np.asarray(image), image_tensor, original_size)
+
+    def release(self, images: PreprocessedImage):
+        """Done with model tensor of images, it can be reused for the next image."""
+        self.pool.release(images.image_tensor)
@@ -0,0 +1,91 @@
+"""Named detection quality/latency profiles and the detectors that serve them.
+
+A profile bundles the model backbone, input resolution, one or two detection passes, and thresholds, e.g. 'fast'
+for headsets in continuous guidance and 'accurate' for operators authoring tasks.
+"""
+
+from typing import NamedTuple
+
+import torch
+
+from artifact_store import ArtifactStore
+from memory import MemoryGovernor
+from object_detection import (
+    DetectionException,
+    ObjectDetection,
+    ObjectDetectionInterface,
+)
+
+
+class DetectionProfile(NamedTuple):
+    name: str
+    # Key of object_detection.MODEL_FILES
+    backbone: str
+    # Shortest side images are resized to for the model
+    image_size: int
+    # Max longest side images are resized to for the model
+    max_image_size: int
+    # Second pass on the crop containing all first pass boxes, else best box of a single full image pass
+    two_pass: bool
+    # Box threshold of first (cropping) pass
+    crop_threshold: float
+    # Box threshold of final pass
+    object_threshold: float
+
+
+PROFILES = {
+    "fast": DetectionProfile("fast", "swint", 512, 853, False, 0.25, 0.25),
+    # Same as the server without profiles
+    "balanced": DetectionProfile("balanced", "swinb", 800, 1333, True, 0.2, 0.2),
+    "accurate": DetectionProfile("accurate", "swinb", 1024, 1707, True, 0.15, 0.2),
+}
+
+
+class ProfileDetectors:
+    """One detector per profile, profiles with the same backbone share one loaded model."""
+
+    def __init__(
+        self,
+        names: list[str],
+        artifact_store: ArtifactStore = None,
+        models: dict[str, torch.nn.Module] = None,
+        governor: MemoryGovernor = None,
+        num_queries: int = None,
+        top_k: int = None,
+    ):
+        """
+        Args:
+        - names: Profiles (keys of PROFILES) to load
+        - artifact_store: Where detection plots are saved
+        - models: Already loaded model of each backbone (e.g. the server's default detector's), others are loaded
+        - governor: Memory governor of the process, shared by every profile's detector
+        - num_queries, top_k: Decoder queries and max thresholded boxes per image of every profile's detector
+        """
+        self.models = dict(models or {})
+        self.detectors: dict[str, ObjectDetectionInterface] = {}
+        for name in names:
+            profile = PROFILES[name]
+            detector = ObjectDetection(
+                self.models.get(profile.backbone),
+                artifact_store=artifact_store,
+                backbone=profile.backbone,
+                image_size=profile.image_size,
+                max_image_size=profile.max_image_size,
+                governor=governor,
+                num_queries=num_queries,
+                top_k=top_k,
+            )
+            self.models[profile.backbone] = detector.model
+            self.detectors[name] = ObjectDetectionInterface(detector)
+
+    def get(self, name: str) -> tuple[DetectionProfile, ObjectDetectionInterface]:
+        """Profile with name and its detector."""
+        if name not in self.detectors:
+            raise DetectionException(
+                f"unknown profile {name}, loaded profiles are {', '.join(self.detectors)}"
+            )
+        return PROFILES[name], self.detectors[name]
+
+    def prime_detection_with_test(self):
+        for detector in self.detectors.values():
+            detector.prime_detection_with_test()
@@ -0,0 +1,141 @@
+"""Keeps the conversation history sent to GPT-4V under a token budget.
+
+Recent steps are sent as full instruction/response turns (sliding window). Older steps are folded into the
+"completed instructions" message as a short summary (instruction and the action/object GPT chose), and the
+oldest summary entries are dropped if even that doesn't fit.
+"""
+
+import json
+import math
+from json import JSONDecodeError
+from typing import NamedTuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough size of English text and JSON in tokens, used when tiktoken isn't installed
+CHARS_PER_TOKEN = 4
+# Tokens the API adds around each message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens of text locally, exact with tiktoken if installed, otherwise estimated from length."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(text: str) -> int:
+    """Tokens of a text message, including per-message overhead."""
+    return count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+def turn_text(instruction: str) -> str:
+    """Text of the user message for an instruction."""
+    return f"Next Instruction: {instruction}"
+
+
+def completed_text(completed: list[str]) -> str:
+    """Text of the message listing completed instructions."""
+    return f"At this point, the user has completed these instructions: {', '.join(completed)}"
+
+
+def summarize_step(instruction: str, output: str) -> str:
+    """Short version of a step: instruction with the action and object GPT chose for it."""
+    try:
+        output_json = json.loads(output)
+        choices = [
+            f"{action} {obj}"
+            for obj, action in zip(output_json["objects"], output_json["actions"])
+        ]
+    except (JSONDecodeError, KeyError, TypeError):
+        return instruction
+    if len(choices) == 0:
+        return instruction
+    return f"{instruction} ({'; '.join(choices)})"
+
+
+class History(NamedTuple):
+    """History that fits in the token budget."""
+
+    # Entries of the completed instructions message, older steps are summarized
+    completed: list[str]
+    # Steps sent as full turns, oldest first
+    instructions: list[str]
+    outputs: list[str]
+    # Estimated tokens of all history messages
+    tokens: int
+
+
+def fit_history(
+    previous_instructions: list[str],
+    previous_outputs: list[str],
+    token_budget: int,
+    min_recent_steps: int = 1,
+) -> History:
+    """Pick which previous steps are sent as full turns and which are summarized, to fit in token_budget.
+
+    Args:
+    - previous_instructions: Instructions of previous steps, oldest first
+    - previous_outputs: GPT output (JSON string) of each previous step
+    - token_budget: Max tokens of history messages (turns plus completed instructions message)
+    - min_recent_steps: Most recent steps always sent as full turns, even if over budget
+
+    Returns:
+    - History with completed instructions entries and the window of recent steps
+    """
+    steps = list(zip(previous_instructions, previous_outputs))
+    turn_tokens = [
+        message_tokens(turn_text(instruction)) + message_tokens(output)
+        for instruction, output in steps
+    ]
+
+    # Grow window from newest step back while it fits
+    window_start = len(steps)
+    window_tokens = 0
+    while window_start > 0:
+        cost = turn_tokens[window_start - 1]
+        is_required = len(steps) - window_start < min_recent_steps
+        if not is_required and window_tokens + cost > token_budget:
+            break
+        window_start -= 1
+        window_tokens += cost
+
+    def fit_completed(window_start: int) -> list[str]:
+        """Completed instructions entries, dropping oldest summaries until they fit next to the window."""
+        summaries = [summarize_step(*step) for step in steps[:window_start]]
+        recent = [instruction for instruction, _ in steps[window_start:]]
+        completed = summaries + recent
+        omitted = 0
+        while window_tokens + message_tokens(
+            completed_text(completed)
+        ) > token_budget and omitted < len(summaries):
+            omitted += 1
+            completed = [f"{omitted} earlier steps"] + summaries[omitted:] + recent
+        return completed
+
+    # Full turns of recent steps are kept over summaries of older ones, only shrink window if the
+    # completed instructions message doesn't fit even with every summary dropped
+    completed = fit_completed(window_start)
+    while (
+        window_tokens + message_tokens(completed_text(completed)) > token_budget
+        and len(steps) - window_start > min_recent_steps
+    ):
+        window_tokens -= turn_tokens[window_start]
+        window_start += 1
+        completed = fit_completed(window_start)
+
+    return History(
+        completed,
+        [instruction for instruction, _ in steps[window_start:]],
+        [output for _, output in steps[window_start:]],
+        window_tokens + message_tokens(completed_text(completed)),
+    )
@@ -0,0 +1,138 @@
+"""Append-only archive of server traffic (image bytes, form fields, timings, responses) for replay.
+
+Archive is a directory of segment files. Each record in a segment is:
+- 8 byte header: big-endian uint32 length of JSON metadata, uint32 length of payload
+- JSON metadata (endpoint, method, form fields, file info, start time, duration, status, response)
+- Payload: uploaded file bytes back to back, sliced using each file's offset and size in metadata
+
+Records are only ever appended. A new segment is started once the current one reaches max_segment_bytes, and
+the oldest segments are deleted once the archive is over max_bytes.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+from typing import Iterator
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_EXTENSION = ".rec"
+
+
+class TrafficRecorder:
+    """Writes requests and their responses to a size-capped archive."""
+
+    def __init__(
+        self,
+        root: str = "recordings",
+        max_bytes: int = 2 * 1024 * 1024 * 1024,
+        max_segment_bytes: int = 64 * 1024 * 1024,
+    ):
+        """
+        Args:
+        - root: Directory segment files are written to
+        - max_bytes: Max total size of all segments, oldest segments are deleted when over
+        - max_segment_bytes: Size after which a new segment is started
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_segment_bytes = max_segment_bytes
+        self.lock = threading.Lock()
+        self.segment = None
+        os.makedirs(root, exist_ok=True)
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        # Nanosecond timestamp keeps segments sorted in recording order
+        path = os.path.join(self.root, f"{time.time_ns()}{SEGMENT_EXTENSION}")
+        self.segment = open(path, "ab")
+        self._enforce_max_bytes()
+
+    def _enforce_max_bytes(self):
+        segments = list_segments(self.root)
+        sizes = [os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        # Never delete the segment being written (last one)
+        for path, size in zip(segments[:-1], sizes):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def record(
+        self,
+        metadata: dict,
+        files: list[tuple[str, str, str, bytes]],
+    ):
+        """Append one request to the archive.
+
+        Args:
+        - metadata: JSON-serializable info about the request (endpoint, form, timings, response, ...)
+        - files: (field, filename, content type, bytes) of each uploaded file
+        """
+        file_info = []
+        offset = 0
+        for field, filename, content_type, data in files:
+            file_info.append(
+                {
+                    "field": field,
+                    "filename": filename,
+                    "contentType": content_type,
+                    "offset": offset,
+                    "size": len(data),
+                }
+            )
+            offset += len(data)
+        header = json.dumps({**metadata, "files": file_info}).encode("utf-8")
+
+        with self.lock:
+            if self.segment is None or self.segment.tell() >= self.max_segment_bytes:
+                self._open_segment()
+            self.segment.write(RECORD_HEADER.pack(len(header), offset))
+            self.segment.write(header)
+            for _, _, _, data in files:
+                self.segment.write(data)
+            self.segment.flush()
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+def list_segments(root: str) -> list[str]:
+    """Segment files of archive, oldest first."""
+    names = [name for name in os.listdir(root) if name.endswith(SEGMENT_EXTENSION)]
+    names.sort(key=lambda name: int(name.split(".")[0]))
+    return [os.path.join(root, name) for name in names]
+
+
+def read_archive(root: str) -> Iterator[tuple[dict, list[tuple[dict, bytes]]]]:
+    """Read recorded requests in order.
+
+    Yields:
+    - Metadata of request
+    - (file info, bytes) of each uploaded file
+    """
+    for path in list_segments(root):
+        with open(path, "rb") as segment:
+            while True:
+                record_header = segment.read(RECORD_HEADER.size)
+                if len(record_header) < RECORD_HEADER.size:
+                    break
+                header_size, payload_size = RECORD_HEADER.unpack(record_header)
+                header = segment.read(header_size)
+                payload = segment.read(payload_size)
+                # Last record is cut off if the server stopped while writing it
+                if len(header) < header_size or len(payload) < payload_size:
+                    print(f"Skipping incomplete record at end of {path}")
+                    break
+                metadata = json.loads(header)
+                files = [
+                    (info, payload[info["offset"] : info["offset"] + info["size"]])
+                    for info in metadata["files"]
+                ]
+                yield metadata, files
@@ -0,0 +1,190 @@
+"""Re-drive recorded traffic (see recorder.py) against a server and compare latency and outputs.
+
+Requests are sent at their recorded pacing divided by --speed (0 sends them back to back), from a thread pool so
+a slow response doesn't delay the ones after it. Use --concurrency 1 to keep requests strictly in order (e.g. a
+session that calls '/get_instructions' before detecting).
+
+Example: python replay.py recordings --url http://127.0.0.1:5000 --speed 4
+"""
+
+import argparse
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from recorder import read_archive
+
+
+def send_recorded(url: str, metadata: dict, files: list[tuple[dict, bytes]]) -> dict:
+    """Send one recorded request to server at url.
+
+    Returns:
+    - Recorded and replayed status, latency, and response of the request
+    """
+    upload = [
+        (info["field"], (info["filename"], data, info["contentType"]))
+        for info, data in files
+    ]
+    begin = time.time()
+    try:
+        response = requests.request(
+            metadata["method"],
+            url + metadata["endpoint"],
+            params=metadata["args"],
+            data=metadata["form"],
+            files=upload or None,
+        )
+        status, text = response.status_code, response.text
+    except requests.RequestException as e:
+        status, text = None, str(e)
+    return {
+        "endpoint": metadata["endpoint"],
+        "recordedStatus": metadata["status"],
+        "recordedDuration": metadata["duration"],
+        "recordedResponse": metadata["response"],
+        "status": status,
+        "duration": time.time() - begin,
+        "response": text,
+    }
+
+
+def parse_json(text: str):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def outputs_match(recorded, replayed, center_tolerance: float) -> bool:
+    """True if responses are the same, with centers allowed to move by center_tolerance pixels."""
+    if isinstance(recorded, dict) and isinstance(replayed, dict):
+        # Different every request
+        keys = (recorded.keys() | replayed.keys()) - {"requestId", "jobId"}
+        return all(
+            (
+                outputs_match(recorded.get(key), replayed.get(key), center_tolerance)
+                if key != "center"
+                else centers_match(
+                    recorded.get(key), replayed.get(key), center_tolerance
+                )
+            )
+            for key in keys
+        )
+    if isinstance(recorded, list) and isinstance(replayed, list):
+        return len(recorded) == len(replayed) and all(
+            outputs_match(a, b, center_tolerance) for a, b in zip(recorded, replayed)
+        )
+    return recorded == replayed
+
+
+def centers_match(recorded, replayed, tolerance: float) -> bool:
+    if recorded is None or replayed is None:
+        return recorded is None and replayed is None
+    return math.dist(recorded, replayed) <= tolerance
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def print_report(results: list[dict], center_tolerance: float):
+    """Latency per endpoint (recorded vs replayed) and requests whose output changed."""
+    by_endpoint: dict[str, list[dict]] = {}
+    for result in results:
+        by_endpoint.setdefault(result["endpoint"], []).append(result)
+
+    print(
+        f"{'endpoint':<24}{'count':>6}{'rec p50':>10}{'p50':>10}{'rec p95':>10}{'p95':>10}"
+    )
+    for endpoint, endpoint_results in sorted(by_endpoint.items()):
+        recorded = [r["recordedDuration"] for r in endpoint_results]
+        replayed = [r["duration"] for r in endpoint_results]
+        print(
+            f"{endpoint:<24}{len(endpoint_results):>6}"
+            f"{percentile(recorded, 0.5):>10.3f}{percentile(replayed, 0.5):>10.3f}"
+            f"{percentile(recorded, 0.95):>10.3f}{percentile(replayed, 0.95):>10.3f}"
+        )
+
+    mismatches = 0
+    for i, result in enumerate(results):
+        same_status = result["status"] == result["recordedStatus"]
+        same_output = outputs_match(
+            parse_json(result["recordedResponse"]),
+            parse_json(result["response"]),
+            center_tolerance,
+        )
+        if not same_status or not same_output:
+            mismatches += 1
+            print(f"\nRequest {i} ({result['endpoint']}) differs:")
+            recorded = (result["recordedResponse"] or "").strip()
+            print(f"  recorded ({result['recordedStatus']}): {recorded}")
+            print(f"  replayed ({result['status']}): {result['response'].strip()}")
+    print(
+        f"\n{len(results) - mismatches}/{len(results)} requests matched recorded output"
+    )
+
+
+def replay(
+    archive: str,
+    url: str,
+    speed: float = 1.0,
+    concurrency: int = 8,
+    center_tolerance: float = 10.0,
+) -> list[dict]:
+    """Replay every request in archive against url.
+
+    Args:
+    - speed: Pacing relative to the recording, e.g. 2 sends requests twice as fast, 0 sends them back to back
+    - concurrency: Max requests waiting on the server at once
+    - center_tolerance: Pixels a detected center can move and still count as the same output
+    """
+    results = []
+    lock = threading.Lock()
+    replay_begin = time.time()
+    first_start = None
+
+    def send(index: int, metadata: dict, files):
+        result = send_recorded(url, metadata, files)
+        with lock:
+            results.append((index, result))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, (metadata, files) in enumerate(read_archive(archive)):
+            if first_start is None:
+                first_start = metadata["start"]
+            if speed > 0:
+                send_at = replay_begin + (metadata["start"] - first_start) / speed
+                time.sleep(max(0, send_at - time.time()))
+            executor.submit(send, index, metadata, files)
+
+    results = [result for _, result in sorted(results, key=lambda item: item[0])]
+    print_report(results, center_tolerance)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("archive", help="Directory of recorded traffic")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Pacing relative to recording (1 original, 0 back to back)",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--center-tolerance", type=float, default=10.0)
+    parser.add_argument("--output", help="Write per-request results to this JSON file")
+    args = parser.parse_args()
+
+    results = replay(
+        args.archive, args.url, args.speed, args.concurrency, args.center_tolerance
+    )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
@@ -0,0 +1,343 @@
+"""Front-end router that forwards the server's endpoints to a pool of detection servers (server.py instances).
+
+- Session affinity: requests of a session ('X-Session-Id' header or 'sessionId' form field / query arg, else the
+  client address) all go to one node, so a task's parser output, instructions, and caches stay on it. Clients
+  should use the task as the session so operator and user mode of a task share a node.
+- New sessions go to the healthy node with the least outstanding requests
+- Health checks: each node's '/test_hello' is polled, a node is taken out after max_failures failed checks (or
+  right away when a request can't connect to it) and put back after a successful check
+- Failover: a session whose node is down moves to another healthy node, and a request that couldn't connect is
+  retried on another node. A POST whose connection broke after it was sent isn't retried (the node may already
+  have processed it), only GETs are
+- Job and request IDs returned by a node are remembered, so '/jobs/<id>' and '/artifacts/<id>' reach that node
+
+Parser output is written to each node's working directory, so nodes on one machine should run from separate
+directories.
+
+Example (local):
+    python server.py --port 5001
+    python server.py --port 5002
+    python router.py --nodes http://127.0.0.1:5001 http://127.0.0.1:5002 --port 5000
+"""
+
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from flask import Flask, Response, request
+from urllib3.exceptions import NewConnectionError
+
+# Headers that only apply to one connection, not forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+    "content-encoding",
+}
+# Endpoints whose second path part is an ID created by one node
+OWNED_ID_ENDPOINTS = ("jobs", "artifacts")
+
+
+class Node:
+    """One detection server."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        # Consecutive failed health checks
+        self.failures = 0
+        self.outstanding = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "outstanding": self.outstanding,
+        }
+
+
+class NodePool:
+    """Picks a node for each request (session affinity, least outstanding) and tracks node health."""
+
+    def __init__(
+        self,
+        urls: list[str],
+        health_interval: float = 2.0,
+        health_timeout: float = 1.0,
+        max_failures: int = 2,
+        session_ttl: float = 60 * 60,
+        max_owned_ids: int = 10000,
+    ):
+        """
+        Args:
+        - urls: Base URL of each node, e.g. 'http://127.0.0.1:5001'
+        - health_interval: Seconds between health checks of each node
+        - health_timeout: Seconds a health check can take before it counts as failed
+        - max_failures: Consecutive failed health checks before a node is taken out
+        - session_ttl: Seconds a session stays pinned to its node after its last request
+        - max_owned_ids: Job/request IDs remembered, oldest are forgotten first
+        """
+        self.nodes = [Node(url) for url in urls]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_failures = max_failures
+        self.session_ttl = session_ttl
+        self.max_owned_ids = max_owned_ids
+        # session -> (node, time of last request)
+        self.sessions: dict[str, tuple[Node, float]] = {}
+        # job/request ID -> node that created it, oldest first
+        self.owners: OrderedDict[str, Node] = OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._check_health, daemon=True)
+        self.thread.start()
+
+    def _least_outstanding(self, exclude: list[Node]) -> Node:
+        candidates = [
+            node for node in self.nodes if node.healthy and node not in exclude
+        ]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda node: node.outstanding)
+
+    def acquire(
+        self, session: str, owned_id: str = None, exclude: list[Node] = ()
+    ) -> Node:
+        """Node to send a request to (counted as outstanding until release), None if no node is healthy.
+
+        Args:
+        - session: Session the request belongs to
+        - owned_id: Job/request ID in the request path, its node is used if it is healthy
+        - exclude: Nodes already tried for this request
+        """
+        with self.lock:
+            owner = self.owners.get(owned_id) if owned_id is not None else None
+            entry = self.sessions.get(session)
+            if owner is not None and owner.healthy and owner not in exclude:
+                node = owner
+            elif entry is not None and entry[0].healthy and entry[0] not in exclude:
+                node = entry[0]
+            else:
+                node = self._least_outstanding(exclude)
+                if node is None:
+                    return None
+                if entry is not None:
+                    print(f"Session {session} moved from {entry[0].url} to {node.url}")
+            # Requests for another node's job/request ID don't move the session
+            if node is not owner or entry is None or entry[0] is node:
+                self.sessions[session] = (node, time.time())
+            node.outstanding += 1
+            return node
+
+    def release(self, node: Node):
+        with self.lock:
+            node.outstanding -= 1
+
+    def remember(self, owned_id: str, node: Node):
+        """Send later requests for job/request ID to node."""
+        with self.lock:
+            self.owners[owned_id] = node
+            self.owners.move_to_end(owned_id)
+            while len(self.owners) > self.max_owned_ids:
+                self.owners.popitem(last=False)
+
+    def mark_failed(self, node: Node):
+        """Take node out until its next successful health check (e.g. request couldn't connect)."""
+        with self.lock:
+            if node.healthy:
+                print(f"Node {node.url} is down")
+            node.healthy = False
+            node.failures = max(node.failures, self.max_failures)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "nodes": [node.to_dict() for node in self.nodes],
+                "sessions": len(self.sessions),
+            }
+
+    def _check_health(self):
+        while True:
+            for node in self.nodes:
+                try:
+                    ok = requests.get(
+                        node.url + "/test_hello", timeout=self.health_timeout
+                    ).ok
+                except requests.RequestException:
+                    ok = False
+                with self.lock:
+                    if ok:
+                        if not node.healthy:
+                            print(f"Node {node.url} is back up")
+                        node.healthy = True
+                        node.failures = 0
+                    else:
+                        node.failures += 1
+                        if node.healthy and node.failures >= self.max_failures:
+                            print(
+                                f"Node {node.url} failed {node.failures} health checks"
+                            )
+                            node.healthy = False
+
+            with self.lock:
+                # Forget idle sessions
+                expired = time.time() - self.session_ttl
+                self.sessions = {
+                    session: entry
+                    for session, entry in self.sessions.items()
+                    if entry[1] >= expired
+                }
+            time.sleep(self.health_interval)
+
+
+app = Flask(__name__)
+# NodePool, set in main
+app.config["NODES"] = None
+# Seconds to wait for a node to accept the connection and to respond
+app.config["CONNECT_TIMEOUT"] = 2.0
+app.config["READ_TIMEOUT"] = 300.0
+
+
+def request_session() -> str:
+    return (
+        request.headers.get("X-Session-Id")
+        or request.args.get("sessionId")
+        or request.form.get("sessionId")
+        or request.remote_addr
+    )
+
+
+def remember_owned_ids(pool: NodePool, node: Node, response: requests.Response):
+    """Remember node for job/request IDs in its JSON response."""
+    if not response.headers.get("Content-Type", "").startswith("application/json"):
+        return
+    try:
+        body = response.json()
+    except ValueError:
+        return
+    if not isinstance(body, dict):
+        return
+    items = [body] + [
+        item for item in body.get("results", []) if isinstance(item, dict)
+    ]
+    for item in items:
+        for key in ("jobId", "requestId"):
+            if item.get(key):
+                pool.remember(item[key], node)
+
+
+@app.route("/router/status", methods=["GET"])
+def router_status():
+    """Health and outstanding requests of each node."""
+    return app.config["NODES"].status()
+
+
+def never_sent(error: requests.ConnectionError) -> bool:
+    """True if the request failed before reaching the node (refused / unreachable / connect timeout)."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying connection error
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+@app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
+@app.route("/<path:path>", methods=["GET", "POST"])
+def forward(path: str):
+    """Send request to its session's node (failing over to others) and return the node's response."""
+    pool: NodePool = app.config["NODES"]
+    # Read raw body before form is parsed, so it is forwarded unchanged (including uploaded files)
+    body = request.get_data()
+    session = request_session()
+    parts = path.split("/")
+    owned_id = parts[1] if len(parts) > 1 and parts[0] in OWNED_ID_ENDPOINTS else None
+    headers = {
+        name: value
+        for name, value in request.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    }
+
+    tried = []
+    while True:
+        node = pool.acquire(session, owned_id, tried)
+        if node is None:
+            return {"error": "no detection server is available"}, 503
+        try:
+            response = requests.request(
+                request.method,
+                f"{node.url}/{path}",
+                params=request.args,
+                data=body,
+                headers=headers,
+                stream=True,
+                timeout=(app.config["CONNECT_TIMEOUT"], app.config["READ_TIMEOUT"]),
+            )
+        except requests.ConnectionError as e:
+            print(f"Request to {node.url} failed: {e}")
+            pool.release(node)
+            pool.mark_failed(node)
+            if request.method == "GET" or never_sent(e):
+                # Node is down and didn't process the request, it can go to another one
+                tried.append(node)
+                continue
+            return {
+                "error": f"connection to detection server {node.url} was lost, request may have been processed"
+            }, 502
+        except requests.Timeout:
+            pool.release(node)
+            return {"error": f"detection server {node.url} timed out"}, 504
+        except requests.RequestException as e:
+            pool.release(node)
+            return {"error": f"request to detection server {node.url} failed: {e}"}, 502
+        break
+
+    response_headers = [
+        (name, value)
+        for name, value in response.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    ]
+    if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+
+        def stream():
+            try:
+                yield from response.iter_content(chunk_size=None)
+            finally:
+                response.close()
+                pool.release(node)
+
+        return Response(stream(), response.status_code, response_headers)
+
+    try:
+        content = response.content
+        remember_owned_ids(pool, node, response)
+    finally:
+        pool.release(node)
+    return Response(content, response.status_code, response_headers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--nodes", nargs="+", required=True, help="Base URL of each server.py"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--health-interval", type=float, default=2.0)
+    parser.add_argument("--max-failures", type=int, default=2)
+    args = parser.parse_args()
+
+    app.config["NODES"] = NodePool(
+        args.nodes,
+        health_interval=args.health_interval,
+        max_failures=args.max_failures,
+    )
+    app.run(host=args.host, port=args.port, threaded=True, use_reloader=False)
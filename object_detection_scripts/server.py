@@ -1,38 +1,368 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import threading
 import time
+from contextlib import nullcontext
 from datetime import datetime
-from flask import Flask, request
+from functools import partial, wraps
+from flask import Flask, Response, g, request, send_file
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from admission import Overloaded, RequestScheduler, no_admission
+from appearance import AppearanceMemory
+from artifact_store import ArtifactStore
+from frame_quality import FrameGate
+from jobs import JobStore
+from memory import MemoryGovernor
+from metrics import metrics
+from model_workers import ModelWorkerPool
+from pipeline import DetectionPipeline, start_preprocess_pool
+from prefetch import Prefetcher, next_detections
+from profiles import PROFILES, DetectionProfile, ProfileDetectors
+from recorder import TrafficRecorder
 from object_detection import (
+    ObjectDetection,
     ObjectDetectionInterface,
     DetectionException,
 )
 from task_guidance import (
     delete_images,
     detect_objects_from_json,
+    detect_objects_from_json_batch,
     instruction_gpt_calls,
     get_instructions_from_file,
+    ingest_instructions,
+    parse_coordinates,
     updated_instructions,
 )
 from werkzeug.utils import secure_filename
 
 
 app = Flask(__name__)
-app.config["DETECTOR"] = ObjectDetectionInterface()
+# Debug artifacts (detection plots, crops sent to GPT) are saved per request in ARTIFACT_ROOT.
+# Only 1 in every ARTIFACT_SAMPLE_EVERY requests keeps artifacts (0 keeps none), oldest are evicted
+# once over ARTIFACT_MAX_BYTES / ARTIFACT_MAX_COUNT or older than ARTIFACT_MAX_AGE seconds.
+app.config["ARTIFACT_ROOT"] = "artifacts"
+app.config["ARTIFACT_MAX_BYTES"] = 500 * 1024 * 1024
+app.config["ARTIFACT_MAX_COUNT"] = 1000
+app.config["ARTIFACT_MAX_AGE"] = 24 * 60 * 60
+app.config["ARTIFACT_SAMPLE_EVERY"] = 1
+app.config["ARTIFACTS"] = ArtifactStore(
+    app.config["ARTIFACT_ROOT"],
+    app.config["ARTIFACT_MAX_BYTES"],
+    app.config["ARTIFACT_MAX_COUNT"],
+    app.config["ARTIFACT_MAX_AGE"],
+    app.config["ARTIFACT_SAMPLE_EVERY"],
+)
+artifacts: ArtifactStore = app.config["ARTIFACTS"]
+# Memory governor: uploads over MAX_CONTENT_LENGTH bytes are rejected with 413 and images over
+# MAX_INPUT_PIXELS before decoding. Peak RSS per detection stage is reported on '/metrics'. If MEMORY_BUDGET_MB
+# is set, model input is reduced (down to MEMORY_MIN_IMAGE_SIZE shortest side) when inference would exceed it.
+# Not used by MODEL_WORKERS processes, and the PIPELINE preprocesses at full size.
+app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024
+app.config["MAX_INPUT_PIXELS"] = 40_000_000
+app.config["MEMORY_BUDGET_MB"] = None
+app.config["MEMORY_MIN_IMAGE_SIZE"] = 400
+app.config["MEMORY_GOVERNOR"] = MemoryGovernor(
+    app.config["MEMORY_BUDGET_MB"],
+    app.config["MEMORY_MIN_IMAGE_SIZE"],
+    app.config["MAX_INPUT_PIXELS"],
+)
+# Decoder queries per image (GroundingDINO uses 900, our prompts are single objects so few are ever kept) and
+# max boxes per image thresholded and turned into phrases, None for all. Not applied in MODEL_WORKERS processes.
+app.config["DETECTION_NUM_QUERIES"] = None
+app.config["DETECTION_TOP_K"] = None
+# Number of model worker processes sharing one copy of the weights (CPU only), 0 runs detection in this process
+app.config["MODEL_WORKERS"] = 0
+# Staged pipeline for '/upload_image' that overlaps preprocessing with inference across requests
+# Needs the model in this process, so it isn't used with MODEL_WORKERS. Can't be combined with PROFILES_ENABLED
+# (requests would go to the profiles' detectors and bypass it).
+app.config["PIPELINE_ENABLED"] = False
+app.config["PIPELINE_PREPROCESS_WORKERS"] = 4
+app.config["PIPELINE_MAX_IN_FLIGHT"] = 16
+# Preprocessing processes are forked here, before the model is loaded or any thread starts
+app.config["PIPELINE_POOL"] = (
+    start_preprocess_pool(app.config["PIPELINE_PREPROCESS_WORKERS"])
+    if app.config["PIPELINE_ENABLED"] and app.config["MODEL_WORKERS"] == 0
+    else None
+)
+if app.config["MODEL_WORKERS"] > 0:
+    app.config["DETECTOR"] = ModelWorkerPool(
+        app.config["MODEL_WORKERS"], artifact_store=artifacts
+    )
+else:
+    app.config["DETECTOR"] = ObjectDetectionInterface(
+        ObjectDetection(
+            artifact_store=artifacts,
+            governor=app.config["MEMORY_GOVERNOR"],
+            num_queries=app.config["DETECTION_NUM_QUERIES"],
+            top_k=app.config["DETECTION_TOP_K"],
+        )
+    )
 detector: ObjectDetectionInterface = app.config["DETECTOR"]
 # Run object detection once on test image since first takes way longer (caching)
 detector.prime_detection_with_test()
 # Configure other app config data
 app.config["CROP_THRESHOLD"] = 0.2
 app.config["OBJECT_THRESHOLD"] = 0.2
+# Max 'topK' candidate boxes a detection request can ask for. Not supported with MODEL_WORKERS (their workers
+# can't fill the caller's list), responses then have no 'candidates'.
+app.config["MAX_TOP_K"] = 10
+# Quality/latency profiles (profiles.py) chosen per request ('profile' field or 'X-Detection-Profile' header) or
+# per session ('/profile'), DEFAULT_PROFILE otherwise. A detector is kept for each of PROFILES, profiles with the
+# same backbone share one model. Needs the model in this process, so it isn't used with MODEL_WORKERS.
+# Without profiles, every request uses DEFAULT_PROFILE with CROP_THRESHOLD and OBJECT_THRESHOLD.
+app.config["PROFILES_ENABLED"] = False
+app.config["PROFILES"] = ("fast", "balanced", "accurate")
+app.config["DEFAULT_PROFILE"] = "balanced"
+# Session ID -> profile name
+app.config["SESSION_PROFILES"] = {}
+app.config["PROFILE_DETECTORS"] = (
+    ProfileDetectors(
+        app.config["PROFILES"],
+        artifacts,
+        # Server's detector already loaded SwinB
+        models={"swinb": detector.detector.model},
+        governor=app.config["MEMORY_GOVERNOR"],
+        num_queries=app.config["DETECTION_NUM_QUERIES"],
+        top_k=app.config["DETECTION_TOP_K"],
+    )
+    if app.config["PROFILES_ENABLED"] and app.config["MODEL_WORKERS"] == 0
+    else None
+)
+profile_detectors: ProfileDetectors = app.config["PROFILE_DETECTORS"]
+if profile_detectors is not None:
+    profile_detectors.prime_detection_with_test()
+
+
+def get_profile(
+    name: str, default_detector: ObjectDetectionInterface
+) -> tuple[DetectionProfile, ObjectDetectionInterface]:
+    """Profile with name and its detector, or the default profile and default_detector if profiles are off.
+
+    Raises BadRequest (400) if name isn't a loaded profile.
+    """
+    if profile_detectors is None:
+        profile = PROFILES[app.config["DEFAULT_PROFILE"]]._replace(
+            crop_threshold=app.config["CROP_THRESHOLD"],
+            object_threshold=app.config["OBJECT_THRESHOLD"],
+        )
+        return profile, default_detector
+    try:
+        return profile_detectors.get(name)
+    except DetectionException as e:
+        raise BadRequest(str(e))
+
+
+# Appearance memory: the operator flow saves ORB features of each object it finds (in APPEARANCE_DIR), and
+# '/upload_image' first tries to find the object by matching them, running detection only if the match has
+# fewer than APPEARANCE_MIN_INLIERS (or APPEARANCE_MIN_INLIER_RATIO of) geometrically consistent matches
+app.config["APPEARANCE_ENABLED"] = False
+app.config["APPEARANCE_DIR"] = "appearance_memory"
+app.config["APPEARANCE_MIN_INLIERS"] = 15
+app.config["APPEARANCE_MIN_INLIER_RATIO"] = 0.4
+app.config["APPEARANCE"] = (
+    AppearanceMemory(
+        app.config["APPEARANCE_DIR"],
+        app.config["APPEARANCE_MIN_INLIERS"],
+        app.config["APPEARANCE_MIN_INLIER_RATIO"],
+    )
+    if app.config["APPEARANCE_ENABLED"]
+    else None
+)
+appearance: AppearanceMemory = app.config["APPEARANCE"]
 # Structure to hold instructions input in 'instructions.txt'
 app.config["INSTRUCTIONS"] = []
 instructions: list[str] = app.config["INSTRUCTIONS"]
 # Flag to determine whether to update instructions
 app.config["UPDATE"] = False
+# Background jobs for '/parse_instruction_job', completed jobs are kept for JOB_TTL seconds
+app.config["JOB_WORKERS"] = 2
+app.config["JOB_TTL"] = 600
+app.config["MAX_JOBS"] = 100
+app.config["JOBS"] = JobStore(
+    app.config["JOB_WORKERS"], app.config["JOB_TTL"], app.config["MAX_JOBS"]
+)
+jobs: JobStore = app.config["JOBS"]
+if app.config["PIPELINE_POOL"] is not None and profile_detectors is not None:
+    raise ValueError(
+        "PIPELINE_ENABLED and PROFILES_ENABLED can't both be set, profile detectors would bypass the pipeline"
+    )
+app.config["PIPELINE"] = (
+    DetectionPipeline(
+        detector,
+        app.config["PIPELINE_PREPROCESS_WORKERS"],
+        app.config["PIPELINE_MAX_IN_FLIGHT"],
+        pool=app.config["PIPELINE_POOL"],
+    )
+    if app.config["PIPELINE_POOL"] is not None
+    else None
+)
+# Speculatively detect the user's next step on the latest frame, '/upload_image' is answered from it if the
+# scene hasn't changed (thumbnail difference at most PREFETCH_MAX_DIFFERENCE, result at most PREFETCH_MAX_AGE s old)
+app.config["PREFETCH_ENABLED"] = False
+app.config["PREFETCH_MAX_DIFFERENCE"] = 6.0
+app.config["PREFETCH_MAX_AGE"] = 60
+# Detectors in this process hold per-detection state (images, request ID, raw outputs), so every detection
+# (requests, jobs, ingest, and prefetching) takes turns holding DETECTION_LOCK. GPT calls run without it.
+# MODEL_WORKERS processes and the PIPELINE keep no per-detection state in this process.
+app.config["DETECTION_LOCK"] = (
+    threading.Lock() if app.config["MODEL_WORKERS"] == 0 else nullcontext()
+)
+
+
+def detection_lock(profile_detector: ObjectDetectionInterface):
+    """Lock to hold while detecting with profile_detector, none for the pipeline."""
+    if profile_detector is app.config["PIPELINE"]:
+        return nullcontext()
+    return app.config["DETECTION_LOCK"]
+
+
+def prefetch_detection(image_path: str, instruction_num: int, picture_num: int):
+    profile, profile_detector = get_profile(
+        app.config["DEFAULT_PROFILE"], app.config["PIPELINE"] or detector
+    )
+    return detect_objects_from_json(
+        profile_detector,
+        image_path,
+        profile.crop_threshold,
+        profile.object_threshold,
+        instruction_num,
+        picture_num,
+        single_pass=not profile.two_pass,
+        appearance=appearance,
+    )
+
+
+app.config["PREFETCHER"] = (
+    Prefetcher(
+        prefetch_detection,
+        app.config["DETECTION_LOCK"],
+        app.config["PREFETCH_MAX_DIFFERENCE"],
+        app.config["PREFETCH_MAX_AGE"],
+    )
+    if app.config["PREFETCH_ENABLED"]
+    else None
+)
+prefetcher: Prefetcher = app.config["PREFETCHER"]
+# Record requests (image bytes, form fields, timings, responses) to an archive for replay.py
+# Oldest segments are deleted once the archive is over RECORD_MAX_BYTES
+app.config["RECORD_ENABLED"] = False
+app.config["RECORD_DIR"] = "recordings"
+app.config["RECORD_MAX_BYTES"] = 2 * 1024 * 1024 * 1024
+app.config["RECORD_SEGMENT_BYTES"] = 64 * 1024 * 1024
+# Endpoints not recorded (polling and debugging)
+app.config["RECORD_EXCLUDE"] = ("/metrics", "/artifacts", "/jobs", "/test_hello")
+app.config["RECORDER"] = (
+    TrafficRecorder(
+        app.config["RECORD_DIR"],
+        app.config["RECORD_MAX_BYTES"],
+        app.config["RECORD_SEGMENT_BYTES"],
+    )
+    if app.config["RECORD_ENABLED"]
+    else None
+)
+recorder: TrafficRecorder = app.config["RECORDER"]
+# Admission control: requests wait for one of ADMISSION_SLOTS slots, lower ADMISSION_PRIORITIES first, and
+# ADMISSION_RESERVED_SLOTS are kept for priority 0 (user mode) so operator parsing can't take every slot.
+# Requests are rejected with 503 if ADMISSION_MAX_QUEUE are already waiting or they can't finish before their
+# deadline ('X-Deadline-Ms' header or 'deadlineMs' form field, else ADMISSION_DEADLINES of the endpoint).
+# ADMISSION_DEGRADABLE endpoints admitted with too little time left for two passes are answered with one pass.
+app.config["ADMISSION_ENABLED"] = False
+app.config["ADMISSION_SLOTS"] = 2
+app.config["ADMISSION_RESERVED_SLOTS"] = 1
+app.config["ADMISSION_MAX_QUEUE"] = 16
+app.config["ADMISSION_PRIORITIES"] = {
+    "/upload_image": 0,
+    "/upload_images": 0,
+    "/parse_instruction": 1,
+    "/ingest_instructions": 1,
+}
+# Seconds from when the request arrives
+app.config["ADMISSION_DEADLINES"] = {
+    "/upload_image": 3.0,
+    "/upload_images": 10.0,
+    "/parse_instruction": 60.0,
+    "/ingest_instructions": 600.0,
+}
+app.config["ADMISSION_DEGRADABLE"] = ("/upload_image",)
+app.config["ADMISSION_SCHEDULER"] = (
+    RequestScheduler(
+        app.config["ADMISSION_SLOTS"],
+        app.config["ADMISSION_MAX_QUEUE"],
+        app.config["ADMISSION_RESERVED_SLOTS"],
+    )
+    if app.config["ADMISSION_ENABLED"]
+    else None
+)
+scheduler: RequestScheduler = app.config["ADMISSION_SCHEDULER"]
+# Frame-quality gate: '/upload_image' frames that are blurry (Laplacian variance below FRAME_GATE_MIN_SHARPNESS),
+# too dark or bright, mostly clipped, or changed more than FRAME_GATE_MAX_CHANGE from the session's previous
+# frame (sent within FRAME_GATE_CHANGE_WINDOW s, e.g. by '/upload_frame') are rejected with 422 before detection.
+# Change is only checked for requests with an explicit session ID, clients sharing an address would mix frames.
+app.config["FRAME_GATE_ENABLED"] = False
+app.config["FRAME_GATE_MIN_SHARPNESS"] = 100.0
+app.config["FRAME_GATE_MIN_BRIGHTNESS"] = 35.0
+app.config["FRAME_GATE_MAX_BRIGHTNESS"] = 225.0
+app.config["FRAME_GATE_MAX_CLIPPED"] = 0.6
+app.config["FRAME_GATE_MAX_CHANGE"] = 40.0
+app.config["FRAME_GATE_CHANGE_WINDOW"] = 2.0
+app.config["FRAME_GATE"] = (
+    FrameGate(
+        app.config["FRAME_GATE_MIN_SHARPNESS"],
+        app.config["FRAME_GATE_MIN_BRIGHTNESS"],
+        app.config["FRAME_GATE_MAX_BRIGHTNESS"],
+        app.config["FRAME_GATE_MAX_CLIPPED"],
+        app.config["FRAME_GATE_MAX_CHANGE"],
+        app.config["FRAME_GATE_CHANGE_WINDOW"],
+    )
+    if app.config["FRAME_GATE_ENABLED"]
+    else None
+)
+frame_gate: FrameGate = app.config["FRAME_GATE"]
+
+
+@app.before_request
+def start_request_timer():
+    g.request_begin = time.time()
+
+
+@app.after_request
+def record_request(response):
+    """Add request and its response to the traffic archive (if recording)."""
+    if recorder is None or request.path.startswith(app.config["RECORD_EXCLUDE"]):
+        return response
+
+    files = []
+    for field, image in request.files.items(multi=True):
+        # Handler already read the upload when saving it
+        image.stream.seek(0)
+        files.append((field, image.filename, image.mimetype, image.stream.read()))
+    streamed = response.is_streamed or response.direct_passthrough
+    recorder.record(
+        {
+            "endpoint": request.path,
+            "method": request.method,
+            "form": request.form.to_dict(flat=False),
+            "args": request.args.to_dict(flat=False),
+            "start": g.request_begin,
+            "duration": time.time() - g.request_begin,
+            "status": response.status_code,
+            "response": None if streamed else response.get_data(as_text=True),
+        },
+        files,
+    )
+    return response
 
 
 @app.after_request
 def print_response(response):
     """Called after request finishes, simply prints results."""
+    # Reading a streamed response here would consume it before it is sent
+    if response.is_streamed or response.direct_passthrough:
+        return response
     print(response.get_data(as_text=True))
     print(response.status_code)
     return response
@@ -43,6 +373,112 @@ def handle_exception(e):
     return {"error": f"{type(e).__name__}: {e}"}, 500
 
 
+@app.errorhandler(BadRequest)
+def handle_bad_request(e: BadRequest):
+    """Invalid request field, e.g. a deadline that isn't a number."""
+    return {"error": e.description}, 400
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(e: RequestEntityTooLarge):
+    return {
+        "error": f"upload is larger than {app.config['MAX_CONTENT_LENGTH']} bytes"
+    }, 413
+
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e: Overloaded):
+    """Request was shed by admission control, tell client when to retry."""
+    retry_after = str(max(1, math.ceil(e.retry_after)))
+    return {"error": str(e), "reason": e.reason}, 503, {"Retry-After": retry_after}
+
+
+def request_deadline() -> float:
+    """time.time() by which the current request must finish, from the client or the endpoint's default."""
+    deadline_ms = request.headers.get("X-Deadline-Ms") or request.form.get("deadlineMs")
+    if deadline_ms:
+        try:
+            deadline = float(deadline_ms)
+        except ValueError:
+            deadline = math.nan
+        if not math.isfinite(deadline):
+            raise BadRequest(
+                f"deadline '{deadline_ms}' is not a number of milliseconds"
+            )
+        return g.request_begin + deadline / 1000
+    return g.request_begin + app.config["ADMISSION_DEADLINES"][request.path]
+
+
+def explicit_session() -> str:
+    """Session ID sent with current request ('X-Session-Id' header or sessionId field), None if there is none."""
+    return (
+        request.headers.get("X-Session-Id")
+        or request.args.get("sessionId")
+        or request.form.get("sessionId")
+        or None
+    )
+
+
+def request_session() -> str:
+    """Session of current request, same as router.py's."""
+    return explicit_session() or request.remote_addr
+
+
+def request_profile(
+    default_detector: ObjectDetectionInterface,
+) -> tuple[DetectionProfile, ObjectDetectionInterface]:
+    """Profile (and its detector) of current request, from the request, else its session, else the default."""
+    name = (
+        request.headers.get("X-Detection-Profile")
+        or request.form.get("profile")
+        or app.config["SESSION_PROFILES"].get(request_session())
+        or app.config["DEFAULT_PROFILE"]
+    )
+    return get_profile(name, default_detector)
+
+
+def form_ints(name: str) -> list[int]:
+    """Values of repeated form field name, raises BadRequest (400) if one isn't an integer."""
+    values = request.form.getlist(name)
+    try:
+        return [int(value) for value in values]
+    except ValueError:
+        raise BadRequest(f"{name} fields {values} aren't all integers")
+
+
+def request_top_k() -> int:
+    """Candidate boxes requested ('topK' field), 0 if none or with MODEL_WORKERS, at most MAX_TOP_K."""
+    top_k = request.form.get("topK", "0")
+    try:
+        top_k = int(top_k)
+    except ValueError:
+        raise BadRequest(f"topK '{top_k}' is not an integer")
+    if app.config["MODEL_WORKERS"] > 0:
+        return 0
+    return max(0, min(top_k, app.config["MAX_TOP_K"]))
+
+
+def admitted(view):
+    """Run view once admission control gives it a slot, its ticket is g.admission (degraded if short on time)."""
+
+    @wraps(view)
+    def admitted_view(*args, **kwargs):
+        if scheduler is None:
+            ticket = no_admission()
+        else:
+            ticket = scheduler.admit(
+                request.path,
+                app.config["ADMISSION_PRIORITIES"][request.path],
+                request_deadline(),
+                request.path in app.config["ADMISSION_DEGRADABLE"],
+            )
+        with ticket:
+            g.admission = ticket
+            return view(*args, **kwargs)
+
+    return admitted_view
+
+
 def get_error_response(msg: str):
     """Creates HTTP response for an error case."""
     return {"message": msg}, 500
@@ -76,73 +512,534 @@ def save_image_from_request() -> str:
     return filename
 
 
+def save_images_from_request() -> list[str]:
+    """Checks and saves all images (repeated 'image' file field) from HTTP post request, in request order.
+
+    Returns: filepath string of each image
+    """
+    HEADER = "image"
+
+    images = request.files.getlist(HEADER)
+    if len(images) == 0:
+        raise DetectionException(
+            f"the file header {HEADER} does not exist in the request"
+        )
+
+    now = datetime.now()
+    timestamp = now.strftime("%m-%d_%H-%M-%S")
+
+    filenames = []
+    for i, image in enumerate(images):
+        if not image:
+            delete_images(*filenames)
+            raise DetectionException(f"file {i} in the request was not valid")
+        # Index keeps names unique since clients can send the same filename for every picture
+        filename = f"{timestamp}_{i}_{secure_filename(image.filename)}"
+        image.save(filename)
+        filenames.append(filename)
+
+    return filenames
+
+
+def file_hash(filepath: str) -> str:
+    """SHA-1 hex digest of file contents."""
+    with open(filepath, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
 @app.route("/upload_image", methods=["POST"])
+@admitted
 def upload_image():
     """Endpoint for Flask server to send an image and run object detection on it.
 
+    Optional hint fields, the hinted region is searched first and the full image only if nothing is found:
+    - roi: 'x1,y1,x2,y2' region of interest in image pixels (e.g. where the user is looking)
+    - previousCenter: 'x,y' where the object was last found in image pixels
+
+    Optional 'deadlineMs' field (or 'X-Deadline-Ms' header) is the time budget for admission control.
+    Optional 'profile' field (or 'X-Detection-Profile' header) picks a detection profile, see '/profile'.
+    Optional 'topK' field asks for up to that many candidate boxes, so the client can switch to another box
+    without a new request.
+
     Returns:
-    - Sends back response containing center (x, y) of detected object and action to perform
+    - Sends back response containing center (x, y) of detected object, action to perform, request ID
+      (artifacts are available from '/artifacts/<request_id>'), whether a single pass was used to
+      meet the deadline ('degraded'), and profile used
+    - With 'topK' (not supported with MODEL_WORKERS), also 'candidates': center, box (x1, y1, x2, y2) in image
+      pixels, confidence, and phrase of each, best first
+    - 422 if the frame-quality gate rejected the frame, with 'reason' and frame 'quality' scores. The client
+      should take a new picture: right away, or after holding still for 'retryAfterMs' if the reason is
+      'moving'
     """
     request_begin = time.time()
+    request_id = artifacts.new_request_id()
     filepath = save_image_from_request()
     instruction_num: int = int(request.form["instructionNum"])
     picture_num: int = int(request.form["pictureNum"])
-    found_center, action = detect_objects_from_json(
-        detector,
-        filepath,
-        app.config["CROP_THRESHOLD"],
-        app.config["OBJECT_THRESHOLD"],
-        instruction_num,
-        picture_num,
-    )
-
-    delete_images(filepath)
+    try:
+        if frame_gate is not None:
+            decision = frame_gate.check(filepath, explicit_session())
+            if not decision.passed:
+                response = {
+                    "error": f"frame rejected by quality gate ({decision.reason})",
+                    "reason": decision.reason,
+                    "quality": (
+                        decision.quality._asdict()
+                        if decision.quality is not None
+                        else None
+                    ),
+                }
+                if decision.reason == "moving":
+                    response["retryAfterMs"] = int(frame_gate.change_window * 1000)
+                return response, 422
+        roi = parse_coordinates(request.form.get("roi"), "roi", 4)
+        previous_center = parse_coordinates(
+            request.form.get("previousCenter"), "previousCenter", 2
+        )
+        profile, profile_detector = request_profile(app.config["PIPELINE"] or detector)
+        top_k = request_top_k()
+        candidates = []
+        # Prefetching detects with the default profile and only keeps the best box
+        prefetched = (
+            prefetcher.lookup(filepath, instruction_num, picture_num)
+            if prefetcher is not None
+            and profile.name == app.config["DEFAULT_PROFILE"]
+            and top_k == 0
+            else None
+        )
+        if prefetched is not None:
+            found_center, action = prefetched
+        else:
+            with detection_lock(profile_detector):
+                found_center, action = detect_objects_from_json(
+                    profile_detector,
+                    filepath,
+                    profile.crop_threshold,
+                    profile.object_threshold,
+                    instruction_num,
+                    picture_num,
+                    request_id,
+                    roi,
+                    previous_center,
+                    single_pass=not profile.two_pass or g.admission.degraded,
+                    top_k=top_k,
+                    candidates=candidates,
+                    appearance=appearance,
+                )
+        if prefetcher is not None:
+            prefetcher.update_frame(
+                filepath, next_detections(instruction_num, picture_num)
+            )
+    finally:
+        delete_images(filepath)
 
-    detector_response = {"center": found_center, "action": action}
+    detector_response = {
+        "center": found_center,
+        "action": action,
+        "requestId": request_id,
+        "degraded": prefetched is None and g.admission.degraded,
+        "profile": profile.name,
+    }
+    if top_k > 0:
+        detector_response["candidates"] = [
+            candidate._asdict() for candidate in candidates
+        ]
     # print(json.dumps(detector_response, indent=4))
     print(f"Request time: {time.time() - request_begin} s")
     return detector_response
 
 
+@app.route("/upload_images", methods=["POST"])
+@admitted
+def upload_images():
+    """Endpoint to send all pictures of an instruction in one request and run batched object detection.
+
+    Form fields:
+    - image: Repeated once per picture
+    - instructionNum: Instruction the pictures are for
+    - pictureNum (optional): Repeated once per image, defaults to 0, 1, 2, ... in image order
+    - topK (optional): Candidate boxes to return per picture, see '/upload_image'
+
+    Returns:
+    - 'results' list containing center (x, y) and action of each picture (and 'candidates' with topK), in the
+      same order as the images
+    - 400 if instructionNum or pictureNum fields aren't integers, or pictureNum fields don't match the images
+    """
+    request_begin = time.time()
+    # Fields are checked before the images are saved, so a bad request leaves no files behind
+    image_count = len(request.files.getlist("image"))
+    instruction_nums = form_ints("instructionNum")
+    if len(instruction_nums) != 1:
+        raise BadRequest("expected one instructionNum field")
+    instruction_num: int = instruction_nums[0]
+    picture_nums = form_ints("pictureNum")
+    if len(picture_nums) == 0:
+        picture_nums = list(range(image_count))
+    if len(picture_nums) != image_count:
+        raise BadRequest(
+            f"got {len(picture_nums)} pictureNum fields for {image_count} images"
+        )
+    profile, profile_detector = request_profile(detector)
+    top_k = request_top_k()
+
+    filepaths = save_images_from_request()
+    candidates = []
+    try:
+        with detection_lock(profile_detector):
+            results = detect_objects_from_json_batch(
+                profile_detector,
+                filepaths,
+                profile.crop_threshold,
+                profile.object_threshold,
+                instruction_num,
+                picture_nums,
+                top_k,
+                candidates,
+            )
+    finally:
+        delete_images(*filepaths)
+
+    detector_response = {
+        "results": [{"center": center, "action": action} for center, action in results]
+    }
+    if top_k > 0:
+        for result, image_candidates in zip(detector_response["results"], candidates):
+            result["candidates"] = [
+                candidate._asdict() for candidate in image_candidates
+            ]
+    print(f"Request time: {time.time() - request_begin} s")
+    return detector_response
+
+
+@app.route("/upload_frame", methods=["POST"])
+def upload_frame():
+    """Send latest frame while the user is doing a step, so the next step is prefetched on a current view.
+
+    Form fields:
+    - image: Latest frame
+    - instructionNum: Instruction the user is doing
+    - pictureNum (optional): Last picture of the instruction already answered, -1 (default) if none yet
+    """
+    if prefetcher is None and frame_gate is None:
+        return {"message": "prefetching is not enabled"}, 404
+    filepath = save_image_from_request()
+    instruction_num: int = int(request.form["instructionNum"])
+    picture_num: int = int(request.form.get("pictureNum", -1))
+    try:
+        # Frame-quality gate compares the next '/upload_image' frame with it to tell if the camera is moving
+        if frame_gate is not None:
+            frame_gate.observe(filepath, explicit_session())
+        if prefetcher is not None:
+            prefetcher.update_frame(
+                filepath, next_detections(instruction_num, picture_num)
+            )
+    finally:
+        delete_images(filepath)
+    return {"status": "ok"}
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Server counters, e.g. prefetch hits and misses, admission queue depth and shed requests, frame gate
+    decisions and thresholds.
+    """
+    return {
+        **metrics.snapshot(),
+        "prefetch_hit_rate": metrics.ratio("prefetch_hits", "prefetch_misses"),
+        "admission_shed_rate": metrics.ratio("admission_shed", "admission_admitted"),
+        "frame_gate_reject_rate": metrics.ratio(
+            "frame_gate_rejected", "frame_gate_passed"
+        ),
+        # Extra GPT calls per call that was needed
+        "gpt_retry_rate": (
+            (metrics.get("gpt_json_retries") + metrics.get("gpt_action_retries"))
+            / metrics.get("gpt_calls")
+            if metrics.get("gpt_calls") > 0
+            else None
+        ),
+    }
+
+
 @app.route("/test_hello", methods=["GET"])
 def test_hello():
     """Simple request for testing."""
     return {"test": "hello"}
 
 
+@app.route("/profile", methods=["GET", "POST"])
+def session_profile():
+    """Detection profiles and the one used by this session's requests (X-Session-Id header or sessionId field).
+
+    POST with 'profile' field sets the session's profile, e.g. 'fast' for continuous guidance on a headset.
+    """
+    session = request_session()
+    if request.method == "POST":
+        if profile_detectors is None:
+            return {"message": "detection profiles are not enabled"}, 404
+        name = request.form["profile"]
+        # Raises if profile isn't loaded
+        get_profile(name, detector)
+        app.config["SESSION_PROFILES"][session] = name
+    loaded = app.config["PROFILES"] if profile_detectors is not None else ()
+    return {
+        "profile": request_profile(detector)[0].name,
+        "profiles": {name: PROFILES[name]._asdict() for name in loaded},
+    }
+
+
 @app.route("/parse_instruction", methods=["POST"])
+@admitted
 def instruction_to_json():
     """Parse instruction. Must call 'get_instructions' endpoint first.
 
     Adds output to 'parser_output.json' file. If successful, returns object center and action.
+    Also returns request ID, its artifacts are available from '/artifacts/<request_id>'.
     """
     request_begin = time.time()
+    request_id = artifacts.new_request_id()
     filepath = save_image_from_request()
     instruction_num: int = int(request.form["instructionNum"])
+    profile, profile_detector = request_profile(detector)
     # Output will be written to parser_output.json
+    try:
+        found_center, action = instruction_gpt_calls(
+            profile_detector,
+            instructions,
+            instruction_num,
+            profile.crop_threshold,
+            profile.object_threshold,
+            filepath,
+            app.config["UPDATE"],
+            request_id=request_id,
+            appearance=appearance,
+            detection_lock=detection_lock(profile_detector),
+        )
+    finally:
+        delete_images(filepath)
+    # Parser output changed, speculative results may be for old prompts
+    if prefetcher is not None:
+        prefetcher.clear()
+
+    detector_response = {
+        "center": found_center,
+        "action": action,
+        "requestId": request_id,
+    }
+    # print(json.dumps(detector_response, indent=4))
+    print(f"Request time: {time.time() - request_begin} s")
+    return detector_response
+
+
+def run_parse_job(
+    filepath: str, instruction_num: int, update: bool, profile_name: str, progress
+):
+    """Job version of '/parse_instruction', reports progress to the job as it goes."""
+    request_id = artifacts.new_request_id()
+    profile, profile_detector = get_profile(profile_name, detector)
     found_center, action = instruction_gpt_calls(
-        detector,
+        profile_detector,
         instructions,
         instruction_num,
-        app.config["CROP_THRESHOLD"],
-        app.config["OBJECT_THRESHOLD"],
+        profile.crop_threshold,
+        profile.object_threshold,
         filepath,
+        update,
+        progress=progress,
+        request_id=request_id,
+        appearance=appearance,
+        detection_lock=detection_lock(profile_detector),
+    )
+    if prefetcher is not None:
+        prefetcher.clear()
+    return {"center": found_center, "action": action, "requestId": request_id}
+
+
+@app.route("/parse_instruction_job", methods=["POST"])
+def submit_parse_instruction_job():
+    """Submit instruction parsing as a background job and return its job ID right away.
+
+    Takes the same form fields as 'parse_instruction'. Optional 'requestId' field identifies the request so a
+    retry returns the existing job instead of parsing again (defaults to instruction, picture and image hash).
+    Progress and final center/action are available from '/jobs/<job_id>' and '/jobs/<job_id>/events'.
+    """
+    filepath = save_image_from_request()
+    instruction_num: int = int(request.form["instructionNum"])
+    picture_num = request.form.get("pictureNum", "")
+    key = request.form.get("requestId") or (
+        f"{instruction_num}:{picture_num}:{file_hash(filepath)}"
+    )
+
+    job, created = jobs.submit(
+        key,
+        run_parse_job,
+        filepath,
+        instruction_num,
         app.config["UPDATE"],
+        request_profile(detector)[0].name,
+        on_complete=partial(delete_images, filepath),
     )
+    # Retry of an existing job, image isn't needed
+    if not created:
+        delete_images(filepath)
 
-    delete_images(filepath)
+    return {"jobId": job.id, "status": job.status}, 202
 
-    detector_response = {"center": found_center, "action": action}
-    # print(json.dumps(detector_response, indent=4))
+
+@app.route("/ingest_instructions", methods=["POST"])
+@admitted
+def ingest_task():
+    """Parse a whole task in one call: every instruction in 'instructions.txt' with its pictures.
+
+    GPT parses run in history order, and detection of each picture runs while later pictures are parsed, so
+    this takes about as long as the chain of GPT calls. Instructions with pictures replace their output in
+    'parser_output.json' once everything is done, other instructions are kept.
+
+    Form fields:
+    - image: Repeated once per picture, in history order
+    - instructionNum (optional): Repeated once per image, defaults to 0, 1, 2, ... (one picture per instruction)
+
+    Returns:
+    - 'results' list containing instruction number, center (x, y), action, and request ID of each picture, and
+      'error' for pictures whose parse or detection failed (the other pictures are still saved)
+    - 400 if the instructionNum fields aren't integers, one per image, of instructions in 'instructions.txt'
+    """
+    request_begin = time.time()
+    # Fields are checked before the images are saved, so a bad request leaves no files behind
+    image_count = len(request.files.getlist("image"))
+    instruction_nums = form_ints("instructionNum")
+    if len(instruction_nums) == 0:
+        instruction_nums = list(range(image_count))
+    if len(instruction_nums) != image_count:
+        raise BadRequest(
+            f"got {len(instruction_nums)} instructionNum fields for {image_count} images"
+        )
+    instructions.clear()
+    instructions.extend(get_instructions_from_file())
+    for instruction_num in instruction_nums:
+        if not 0 <= instruction_num < len(instructions):
+            raise BadRequest(
+                f"instructionNum {instruction_num} is out of range, 'instructions.txt' has "
+                f"{len(instructions)} instructions"
+            )
+    profile, profile_detector = request_profile(detector)
+
+    filepaths = save_images_from_request()
+    # History order, pictures of the same instruction stay in request order
+    pictures = sorted(zip(instruction_nums, filepaths), key=lambda picture: picture[0])
+    request_ids = [artifacts.new_request_id() for _ in pictures]
+    errors = []
+
+    try:
+        results = ingest_instructions(
+            profile_detector,
+            instructions,
+            pictures,
+            profile.crop_threshold,
+            profile.object_threshold,
+            request_ids=request_ids,
+            appearance=appearance,
+            errors=errors,
+            detection_lock=detection_lock(profile_detector),
+        )
+    finally:
+        delete_images(*filepaths)
+    # Ingested instructions were parsed again, their appearances from before are stale. Only done once the
+    # ingest succeeded, a failed one keeps them along with the old parser output.
+    if appearance is not None:
+        appearance.forget(instruction_nums, request_begin)
+    updated_instructions.clear()
+    if prefetcher is not None:
+        prefetcher.clear()
+
+    detector_response = {
+        "results": [
+            {
+                "instructionNum": instruction_num,
+                "center": center,
+                "action": action,
+                "requestId": request_id,
+            }
+            for (instruction_num, _), (center, action), request_id in zip(
+                pictures, results, request_ids
+            )
+        ]
+    }
+    for result, error in zip(detector_response["results"], errors):
+        if error is not None:
+            result["error"] = error
     print(f"Request time: {time.time() - request_begin} s")
     return detector_response
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    """Status, progress events, and result (center and action) of a job."""
+    job = jobs.get(job_id)
+    if job is None:
+        return {"message": f"job {job_id} does not exist or has expired"}, 404
+    return job.to_dict()
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id: str):
+    """Server-Sent Events stream of job progress, ends after the job is done or failed.
+
+    Each event id is its index, so a reconnecting client (Last-Event-ID header) only gets events it missed.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return {"message": f"job {job_id} does not exist or has expired"}, 404
+    # Not an index we sent (e.g. from another server), so the client gets every event
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    def stream():
+        sent = start
+        while True:
+            events = job.wait_for_events(sent, timeout=15)
+            if len(events) == 0:
+                # Comment line keeps connection from timing out
+                yield ": keep-alive\n\n"
+            for event in events:
+                yield f"id: {sent}\nevent: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+                sent += 1
+            if job.completed and sent >= len(job.events):
+                break
+
+    return Response(
+        stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.route("/artifacts/<request_id>", methods=["GET"])
+def list_artifacts(request_id: str):
+    """Names of debug artifacts (detection plots, crops sent to GPT) saved for a request."""
+    names = artifacts.list_artifacts(request_id)
+    if len(names) == 0:
+        return {
+            "message": f"no artifacts for request {request_id} (not sampled or evicted)"
+        }, 404
+    return {"requestId": request_id, "artifacts": names}
+
+
+@app.route("/artifacts/<request_id>/<name>", methods=["GET"])
+def get_artifact(request_id: str, name: str):
+    """Download one debug artifact of a request."""
+    path = artifacts.get_artifact_path(request_id, name)
+    if path is None:
+        return {
+            "message": f"artifact {name} of request {request_id} does not exist"
+        }, 404
+    return send_file(os.path.abspath(path))
+
+
 @app.route("/update_instructions", methods=["GET"])
 def update_instructions():
     """Get list of instructions from 'instructions.txt' and add to instructions list."""
     app.config["UPDATE"] = True
     updated_instructions.clear()
+    if prefetcher is not None:
+        prefetcher.clear()
     return get_instructions()
 
 
@@ -161,9 +1058,18 @@ def new_instructions():
     Clearing the JSON output file means that the operator phase must occur again.
     """
     app.config["UPDATE"] = False
+    if prefetcher is not None:
+        prefetcher.clear()
+    if appearance is not None:
+        appearance.clear()
     return get_instructions(clear_output=True)
 
 
 # Run flask server
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True, use_reloader=False)
+    parser = argparse.ArgumentParser()
+    # Several servers can run on one machine behind router.py
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
@@ -1,21 +1,104 @@
+import asyncio
 import json
 import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
+from appearance import AppearanceMemory
 from instruction_parser import parse_instruction, possible_actions, pickup_actions
-from object_detection import DetectionException, ObjectDetectionInterface
+from metrics import metrics
+from object_detection import (
+    DetectionException,
+    InferenceMemo,
+    ObjectDetectionInterface,
+)
 
 
 OUTPUT_FILE = "parser_output.json"
 updated_instructions = []
 
 
+async def run_inline(func, *args, **kwargs):
+    """Run a blocking function directly on the calling thread.
+
+    Default dispatcher for the synchronous (Flask) server, where each request already has its own thread.
+    """
+    return func(*args, **kwargs)
+
+
+def executor_dispatcher(executor: Executor):
+    """run_blocking that submits work to executor right away, even while the event loop is busy in a blocking
+    call, so it runs alongside the caller.
+    """
+
+    def run_blocking(func, *args, **kwargs):
+        return asyncio.wrap_future(executor.submit(func, *args, **kwargs))
+
+    return run_blocking
+
+
+def locked(run_blocking, lock):
+    """run_blocking that holds lock while func runs, so detections on a detector shared with other threads
+    take turns (GPT calls don't hold it).
+    """
+
+    def run_locked(func, *args, **kwargs):
+        def call():
+            with lock:
+                return func(*args, **kwargs)
+
+        return run_blocking(call)
+
+    return run_locked
+
+
+def no_progress(stage: str, **data):
+    """Default progress callback for the operator flow, does nothing."""
+
+
+def new_inference_memo(detector: ObjectDetectionInterface) -> InferenceMemo:
+    """Memo shared by the detections of one operator request, None if detector can't use one.
+
+    Model workers (ModelWorkerPool) get a copy of their arguments in another process, so their outputs can't be
+    kept in the memo.
+    """
+    return InferenceMemo() if isinstance(detector, ObjectDetectionInterface) else None
+
+
+def report_inference_memo(*memos: InferenceMemo):
+    hits = sum(memo.hits for memo in memos if memo is not None)
+    total = hits + sum(memo.misses for memo in memos if memo is not None)
+    if total > 0:
+        print(f"Inference memo: {hits} of {total} inferences reused")
+
+
 def delete_images(*image_paths):
-    """Remove files that were saved."""
+    """Remove files that were saved (None or empty paths are skipped)."""
     for image in image_paths:
-        if os.path.exists(image):
+        if image and os.path.exists(image):
             os.remove(image)
 
 
+def parse_coordinates(value, name: str, count: int) -> tuple[float, ...]:
+    """Parse optional coordinates hint sent by a client, e.g. 'x1,y1,x2,y2' or [x1, y1, x2, y2].
+
+    Returns:
+    - Tuple of count floats, None if value is empty
+    """
+    if value is None or value == "" or value == []:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    try:
+        coordinates = tuple(float(coord) for coord in value)
+    except (TypeError, ValueError):
+        coordinates = ()
+    if len(coordinates) != count:
+        raise DetectionException(f"{name} must be {count} comma-separated numbers")
+    return coordinates
+
+
 def get_objects_from_json(
     json_data: dict[str, list[str]], picture_num: int
 ) -> tuple[str, str]:
@@ -39,13 +122,28 @@ def detect_objects_from_json(
     thres2: float,
     instruction_num: int,
     picture_num: int,
+    request_id: str = None,
+    roi: tuple[float, float, float, float] = None,
+    previous_center: tuple[float, float] = None,
+    single_pass: bool = False,
+    top_k: int = 0,
+    candidates: list = None,
+    appearance: AppearanceMemory = None,
 ) -> tuple[tuple[float, float], str]:
     """Run object detection on image.
 
     Args:
+    - detector: ObjectDetectionInterface, or anything with the same run_object_detection_with_crop (e.g. DetectionPipeline)
     - image_path: Image to run object detection on
     - thres1: Bounding box lower confidence for cropping
     - thres2: Bounding box Lower confidence for object detection on cropped image
+    - request_id: Request this is for, detection plots are saved as its artifacts
+    - roi: Optional (x1, y1, x2, y2) region of interest from the client, searched before the full image
+    - previous_center: Optional (x, y) where the object was last found, region around it is searched first
+    - single_pass: Skip the cropped second pass (faster, for requests short on time)
+    - top_k: If over 0, up to top_k best boxes in image pixels are appended to candidates (as Candidate)
+    - appearance: Object is first searched by matching its appearance saved by the operator flow, detection
+      only runs if it isn't matched
     """
     # Get JSON from current instruction_num from output file
     with open(OUTPUT_FILE, "r") as file:
@@ -55,14 +153,28 @@ def detect_objects_from_json(
 
     print(f"Running object detection on instruction {num}...")
     object_prompt, action = get_objects_from_json(instruction_json, picture_num)
+    if appearance is not None:
+        match = appearance.locate(image_path, instruction_num, object_prompt)
+        if match is not None:
+            if top_k > 0:
+                candidates.append(match)
+            return match.center, action
+
     center, top_left_coord, cropped_image = detector.run_object_detection_with_crop(
         image_path,
         object_prompt,
         thres1,
         thres2,
+        request_id=request_id,
+        roi=roi,
+        previous_center=previous_center,
+        single_pass=single_pass,
+        top_k=top_k,
+        candidates=candidates,
     )
 
     if center is None:
+        delete_images(cropped_image)
         return None, ""
 
     original_image_box_center = (
@@ -75,6 +187,65 @@ def detect_objects_from_json(
     return original_image_box_center, action
 
 
+def detect_objects_from_json_batch(
+    detector: ObjectDetectionInterface,
+    image_paths: list[str],
+    thres1: float,
+    thres2: float,
+    instruction_num: int,
+    picture_nums: list[int],
+    top_k: int = 0,
+    candidates: list = None,
+) -> list[tuple[tuple[float, float], str]]:
+    """Run object detection on all pictures of an instruction at once, batching model inference.
+
+    Args:
+    - image_paths: Images to run object detection on, one per picture
+    - picture_nums: Picture number of each image (selects object prompt and action from JSON)
+    - top_k: If over 0, a list of up to top_k best boxes is appended to candidates for each image
+    - See detect_objects_from_json for other arguments
+
+    Returns:
+    - List of (center, action) in same order as image_paths, (None, "") where no object was found
+    """
+    with open(OUTPUT_FILE, "r") as file:
+        json_data = json.load(file)
+    num = str(instruction_num)
+    instruction_json = json_data[num]
+
+    print(
+        f"Running object detection on {len(image_paths)} images of instruction {num}..."
+    )
+    prompts_and_actions = [
+        get_objects_from_json(instruction_json, picture_num)
+        for picture_num in picture_nums
+    ]
+    crop_results = detector.run_object_detection_with_crop_batch(
+        image_paths,
+        [object_prompt for object_prompt, _ in prompts_and_actions],
+        thres1,
+        thres2,
+        top_k=top_k,
+        candidates=candidates,
+    )
+
+    results = []
+    for (center, top_left_coord, cropped_image), (_, action) in zip(
+        crop_results, prompts_and_actions
+    ):
+        delete_images(cropped_image)
+        if center is None:
+            results.append((None, ""))
+            continue
+        original_image_box_center = (
+            top_left_coord[0] + center[0],
+            top_left_coord[1] + center[1],
+        )
+        results.append((original_image_box_center, action))
+
+    return results
+
+
 def get_instructions_from_file(clear_output: bool = False) -> list[str]:
     """Reads 'instructions.txt' and outputs list of instructions from the file."""
     instruction_file = "instructions.txt"
@@ -96,14 +267,20 @@ def get_cropped_image(
     threshold: float,
     filepath: str,
     json_input: dict[str, list[str]],
+    memo: InferenceMemo = None,
 ) -> str:
     """Runs object detection on 'filepath' to crop an image to relevant objects.
 
+    Args:
+    - memo: Request's inference memo, the final detection's first pass is usually the same inference
+
     Returns:
     - Filename of new saved cropped image
     """
     object_prompt, _ = get_objects_from_json(json_input, 0)
-    _, boxes, _, _ = detector.run_object_detection(filepath, object_prompt, threshold)
+    _, boxes, _, _ = detector.run_object_detection(
+        filepath, object_prompt, threshold, memo=memo
+    )
 
     # Signal to not run on cropped image if only 1 box is found.
     if boxes.shape[0] == 1:
@@ -129,6 +306,22 @@ def verify_pickup_and_place(new_action: str, previous_action: str) -> str:
     return verified_action
 
 
+def load_output_file() -> dict[str, dict[str, list[str]]]:
+    """All parsed instructions in output parser json file, empty if the file is empty."""
+    with open(OUTPUT_FILE, "r") as file:
+        # Only decode JSON if file is not empty
+        if len(file.read(1)) == 0:
+            return {}
+        # Return to beginning of file
+        file.seek(0)
+        return json.load(file)
+
+
+def save_output_file(current_json: dict[str, dict[str, list[str]]]):
+    with open(OUTPUT_FILE, "w") as file:
+        json.dump(current_json, file, indent=4)
+
+
 def add_json_to_output_file(
     json_data: dict[str, list[str]], instruction_num: int, update: bool
 ) -> tuple[bool, str, str]:
@@ -148,14 +341,25 @@ def add_json_to_output_file(
     - "Object prompt" added to JSON
     - "Action" added to JSON
     """
-    current_json = {}
-    with open(OUTPUT_FILE, "r") as file:
-        # Only decode JSON if file is not empty
-        if len(file.read(1)) != 0:
-            # Return to beginning of file
-            file.seek(0)
-            current_json: dict[str, dict[str, list[str]]] = json.load(file)
+    current_json = load_output_file()
+    valid, added_object, added_action = merge_json_output(
+        current_json, json_data, instruction_num, update
+    )
+    if valid:
+        save_output_file(current_json)
+    return valid, added_object, added_action
+
+
+def merge_json_output(
+    current_json: dict[str, dict[str, list[str]]],
+    json_data: dict[str, list[str]],
+    instruction_num: int,
+    update: bool,
+) -> tuple[bool, str, str]:
+    """Same as add_json_to_output_file, but adds to parsed instructions in memory (current_json).
 
+    current_json is left unchanged if the output has an invalid action.
+    """
     num = str(instruction_num)
 
     # Check if key (instruction number) already exists
@@ -165,14 +369,15 @@ def add_json_to_output_file(
             current_json[num] = json_data
             updated_instructions.append(instruction_num)
         else:
+            for action in json_data["actions"]:
+                if action not in possible_actions:
+                    print("**Re-running GPT, it output an invalid action")
+                    return False, "", ""
             # If so, append json to current instruction
             curr_instruction = current_json[num]
             for obj in json_data["objects"]:
                 curr_instruction["objects"].append(obj)
             for action in json_data["actions"]:
-                if action not in possible_actions:
-                    print("**Re-running GPT, it output an invalid action")
-                    return False, "", ""
                 # Ensures that both pickup and place are output
                 # Using [0] as index for action only works since current system only allows 2 object/actions max
                 # Will have to change 0 to find what the previous action index is if system allows for >2 objects.
@@ -188,26 +393,20 @@ def add_json_to_output_file(
                 return False, "", ""
         current_json[num] = json_data
 
-    with open(OUTPUT_FILE, "w") as file:
-        json.dump(current_json, file, indent=4)
-
     added_object = current_json[num]["objects"][-1]
     added_action = current_json[num]["actions"][-1]
     return True, added_object, added_action
 
 
 def get_previous_gpt_outputs(
-    instructions: list[str], instruction_num: int, update: bool
+    instructions: list[str],
+    instruction_num: int,
+    update: bool,
+    all_outputs: dict[str, dict[str, list[str]]] = None,
 ):
-    """Returns previous responses from parser output JSON file."""
-    with open(OUTPUT_FILE, "r") as file:
-        # Make sure file isn't empty
-        if len(file.read(1)) != 0:
-            # Return to beginning of file
-            file.seek(0)
-            all_outputs = json.load(file)
-        else:
-            return [], []
+    """Returns previous responses from parser output JSON file (or all_outputs if given)."""
+    if all_outputs is None:
+        all_outputs = load_output_file()
 
     previous_instructions = []
     previous_outputs = []
@@ -237,6 +436,10 @@ def instruction_gpt_calls(
     thres2: float,
     image_file: str,
     update: bool,
+    progress=no_progress,
+    request_id: str = None,
+    appearance: AppearanceMemory = None,
+    detection_lock=nullcontext(),
 ) -> tuple[tuple[float, float], str]:
     """Sends an instruction and image to be parsed by GPT-4V.
 
@@ -246,14 +449,124 @@ def instruction_gpt_calls(
     - thres2: Threshold for final object detection using GroundingDINO
     - image_file: Image to send to GPT-4V
     - update: True if should replace current instruction output in output file, else False
+    - progress: Callback progress(stage, **data) called as each GPT pass and detection finishes
+    - request_id: Request this is for, detection plots and crops sent to GPT are saved as its artifacts
+    - appearance: Appearance of the detected object is saved to it, for user mode to match
+    - detection_lock: Held during each detection (not during GPT calls), when detector is shared between threads
 
     Output is returned in JSON format.
     """
+    return asyncio.run(
+        instruction_gpt_calls_async(
+            detector,
+            instructions,
+            instruction_num,
+            thres1,
+            thres2,
+            image_file,
+            update,
+            parse=partial(run_inline, parse_instruction),
+            run_blocking=locked(run_inline, detection_lock),
+            progress=progress,
+            request_id=request_id,
+            appearance=appearance,
+        )
+    )
+
+
+async def parse_instruction_output_async(
+    detector: ObjectDetectionInterface,
+    instructions: list[str],
+    instruction_num: int,
+    thres1: float,
+    image_file: str,
+    update: bool,
+    parse,
+    run_blocking=run_inline,
+    progress=no_progress,
+    request_id: str = None,
+    task_json: dict[str, dict[str, list[str]]] = None,
+    memo: InferenceMemo = None,
+    output_lock: asyncio.Lock = None,
+) -> tuple[bool, str, str]:
+    """GPT part of instruction_gpt_calls_async: parse instruction (with a second pass on a crop) and add its
+    output to the parsed instructions.
+
+    Args:
+    - task_json: Parsed instructions to read history from and add output to, parser output file if None
+    - memo: Request's inference memo, cropping for GPT retries detects the same objects again
+    - output_lock: If given, held while parsed instructions are read and written, which then runs on a thread
+      (off the event loop)
+
+    Returns:
+    - False if GPT didn't output a valid action in 3 attempts (nothing is added), else True
+    - Object prompt added
+    - Action added
+    """
+    # Crops made for GPT pass 2, kept as artifacts (if request is sampled) or deleted once parsing is done
+    gpt_crops = []
+    try:
+        return await _parse_instruction_output(
+            detector,
+            instructions,
+            instruction_num,
+            thres1,
+            image_file,
+            update,
+            parse,
+            run_blocking,
+            progress,
+            task_json,
+            memo,
+            output_lock,
+            gpt_crops,
+        )
+    finally:
+        for i, crop in enumerate(gpt_crops):
+            detector.keep_artifact(request_id, f"gpt_crop_{i}.jpg", crop)
+        delete_images(*gpt_crops)
+
+
+async def _parse_instruction_output(
+    detector: ObjectDetectionInterface,
+    instructions: list[str],
+    instruction_num: int,
+    thres1: float,
+    image_file: str,
+    update: bool,
+    parse,
+    run_blocking,
+    progress,
+    task_json: dict[str, dict[str, list[str]]],
+    memo: InferenceMemo,
+    output_lock: asyncio.Lock,
+    gpt_crops: list[str],
+) -> tuple[bool, str, str]:
+    """parse_instruction_output_async without the cleanup, crops made for GPT pass 2 are appended to gpt_crops."""
     instruction = instructions[instruction_num]
     print(f"Parsing instruction: {instruction}...")
+    if task_json is None:
+        add_output = partial(
+            add_json_to_output_file, instruction_num=instruction_num, update=update
+        )
+    else:
+        add_output = partial(
+            merge_json_output,
+            task_json,
+            instruction_num=instruction_num,
+            update=update,
+        )
+    if output_lock is None:
+        output_io = run_inline
+    else:
+
+        async def output_io(func, *args, **kwargs):
+            async with output_lock:
+                return await asyncio.to_thread(func, *args, **kwargs)
+
     # Get previous info to give to GPT for conversation history
-    previous_instructions, previous_responses = get_previous_gpt_outputs(
-        instructions, instruction_num, update
+    previous_instructions, previous_responses = await output_io(
+        get_previous_gpt_outputs, instructions, instruction_num, update, task_json
     )
 
     valid_json = False
@@ -262,15 +575,18 @@ def instruction_gpt_calls(
         if parse_attempts >= 3:
             print("")
             raise DetectionException("GPT could not output valid JSON in 3 attempts.")
-        json_output: dict[str, list[str]] = parse_instruction(
+        json_output: dict[str, list[str]] = await parse(
             instruction, image_file, previous_instructions, previous_responses
         )
         if json_output is not None:
             valid_json = True
+        else:
+            metrics.increment("gpt_json_retries")
         parse_attempts += 1
 
     print("-------- GPT OUTPUT 1: ----------")
     print(json.dumps(json_output, indent=4))
+    progress("gpt_pass_1", output=json_output)
 
     valid_actions = False
     no_crop = False
@@ -282,22 +598,26 @@ def instruction_gpt_calls(
             print("GPT did not find a correct action in 3 attempts, moving on.")
             break
         if not no_crop:
-            cropped_image = get_cropped_image(detector, thres1, image_file, json_output)
+            cropped_image = await run_blocking(
+                get_cropped_image, detector, thres1, image_file, json_output, memo
+            )
             second_image = cropped_image
             # Don't run on cropped image if only 1 box is found, not necessary
             if cropped_image == "":
                 no_crop = True
                 second_image = image_file
+            else:
+                gpt_crops.append(cropped_image)
+            progress("crop", cropped=not no_crop)
 
         if no_crop:
             print("Checking first GPT output since no crop needed.")
-            valid_actions, prompt, action = add_json_to_output_file(
-                json_output, instruction_num, update
-            )
+            valid_actions, prompt, action = await output_io(add_output, json_output)
             # Don't run parser again if first output was valid and no need to crop
             if valid_actions:
                 break
             else:
+                metrics.increment("gpt_action_retries")
                 print("Parsing original image again to get valid actions.")
 
         # Give second pass higher detail to be sure outputs are correct
@@ -308,7 +628,7 @@ def instruction_gpt_calls(
                 raise DetectionException(
                     "GPT could not output valid JSON in 3 attempts."
                 )
-            parsed_output = parse_instruction(
+            parsed_output = await parse(
                 instruction,
                 second_image,
                 previous_instructions,
@@ -317,24 +637,83 @@ def instruction_gpt_calls(
             )
             if parsed_output is not None:
                 valid_json = True
+            else:
+                metrics.increment("gpt_json_retries")
             parse_attempts += 1
 
         print("-------- GPT OUTPUT 2: ----------")
         print(json.dumps(parsed_output, indent=4))
 
         # Add output to parser output JSON file
-        valid_actions, prompt, action = add_json_to_output_file(
-            parsed_output, instruction_num, update
-        )
+        valid_actions, prompt, action = await output_io(add_output, parsed_output)
+        progress("gpt_pass_2", output=parsed_output, valid_actions=valid_actions)
+        if not valid_actions:
+            metrics.increment("gpt_action_retries")
         attempts += 1
 
-    # delete_images(cropped_image)
+    return valid_actions, prompt, action
+
+
+async def instruction_gpt_calls_async(
+    detector: ObjectDetectionInterface,
+    instructions: list[str],
+    instruction_num: int,
+    thres1: float,
+    thres2: float,
+    image_file: str,
+    update: bool,
+    parse,
+    run_blocking=run_inline,
+    progress=no_progress,
+    request_id: str = None,
+    appearance: AppearanceMemory = None,
+    output_lock: asyncio.Lock = None,
+) -> tuple[tuple[float, float], str]:
+    """Implementation of instruction_gpt_calls where GPT and detection calls are awaited.
+
+    Args:
+    - parse: Coroutine function with the signature of parse_instruction that calls GPT-4V
+    - run_blocking: Coroutine function (func, *args) used to dispatch CPU/GPU-bound detection work
+    - output_lock: Held while the parser output file is read and written, so concurrent requests don't lose
+      each other's updates (the file is then accessed on a thread)
+
+    See instruction_gpt_calls for the other arguments.
+    """
+    # Cropping for GPT and the final detection's first pass run the same inference
+    memo = new_inference_memo(detector)
+    valid_actions, prompt, action = await parse_instruction_output_async(
+        detector,
+        instructions,
+        instruction_num,
+        thres1,
+        image_file,
+        update,
+        parse,
+        run_blocking,
+        progress,
+        request_id,
+        memo=memo,
+        output_lock=output_lock,
+    )
 
     # Ensure while loop didn't break after 3 attempts
     if valid_actions:
-        center = detect_object_from_prompt(detector, prompt, image_file, thres1, thres2)
+        center = await run_blocking(
+            detect_object_from_prompt,
+            detector,
+            prompt,
+            image_file,
+            thres1,
+            thres2,
+            request_id,
+            memo,
+            appearance,
+            instruction_num,
+        )
     else:
         center = None
+    report_inference_memo(memo)
+    progress("detection", center=center)
 
     if center is None:
         return None, ""
@@ -348,20 +727,39 @@ def detect_object_from_prompt(
     image_path: str,
     thres1: float,
     thres2: float,
+    request_id: str = None,
+    memo: InferenceMemo = None,
+    appearance: AppearanceMemory = None,
+    instruction_num: int = None,
 ) -> tuple[float, float]:
     """Runs object detection with json_data instead of grabbing it from the JSON file.
     This is planned to be called directly after GPT parses an instruction.
+
+    Args:
+    - memo: Request's inference memo, e.g. with the inference made to crop the image for GPT
+    - appearance, instruction_num: Appearance of the object found is saved as instruction_num's object
     """
     # print(f"Running object detection on instruction {instruction_num}...")
+    candidates = []
     center, top_left_coord, cropped_image = detector.run_object_detection_with_crop(
         image_path,
         object_prompt,
         thres1,
         thres2,
+        request_id=request_id,
+        memo=memo,
+        top_k=1 if appearance is not None else 0,
+        candidates=candidates,
     )
 
     if center is None:
+        delete_images(cropped_image)
         return None
+    # Model workers can't fill candidates
+    if appearance is not None and len(candidates) > 0:
+        appearance.remember(
+            image_path, candidates[0].box, instruction_num, object_prompt
+        )
 
     original_image_box_center = (
         top_left_coord[0] + center[0],
@@ -371,3 +769,176 @@ def detect_object_from_prompt(
     delete_images(cropped_image)
 
     return original_image_box_center
+
+
+async def ingest_instructions_async(
+    detector: ObjectDetectionInterface,
+    instructions: list[str],
+    pictures: list[tuple[int, str]],
+    thres1: float,
+    thres2: float,
+    parse,
+    run_blocking,
+    progress=no_progress,
+    request_ids: list[str] = None,
+    appearance: AppearanceMemory = None,
+    task_json: dict[str, dict[str, list[str]]] = None,
+    errors: list = None,
+) -> tuple[dict[str, dict[str, list[str]]], list[tuple[tuple[float, float], str]]]:
+    """Parse every picture of a task into new parsed instructions, pipelined across pictures.
+
+    GPT parses run one after another in history order, each starting as soon as the previous output is
+    accepted. Detection for a parsed picture is dispatched with run_blocking without waiting for it, so it
+    runs while later pictures are being parsed. Nothing is written to the parser output file.
+
+    A picture whose parse or detection fails is reported in errors, the other pictures are still parsed.
+
+    Args:
+    - pictures: (instruction number, image) of each picture, in history order
+    - run_blocking: Must start work right away (e.g. executor_dispatcher), else detection won't overlap parsing
+    - progress: Called as progress(stage, picture=index, **data) as each stage of each picture finishes
+    - request_ids: Request ID of each picture, for its artifacts
+    - appearance: Appearance of each detected object is saved to it
+    - task_json: Parsed instructions of other instructions (not in pictures), used as GPT history and returned
+      with the new ones
+    - errors: If given, filled with the error of each picture (None if it didn't fail)
+
+    See instruction_gpt_calls for the other arguments.
+
+    Returns:
+    - Parsed instructions, in the format of the parser output file
+    - (center, action) of each picture, (None, "") if not found or failed
+    """
+    if request_ids is None:
+        request_ids = [None] * len(pictures)
+    failures = [None] * len(pictures)
+    # One memo per picture (its GPT crop and detection usually make the same inference), cleared once the
+    # picture's detection is done so the task's decoded images aren't all held until it ends
+    memos = []
+    task_json = dict(task_json or {})
+    actions = []
+    detections = []
+    try:
+        for i, (instruction_num, image_file) in enumerate(pictures):
+            memo = new_inference_memo(detector)
+            memos.append(memo)
+            try:
+                valid_actions, prompt, action = await parse_instruction_output_async(
+                    detector,
+                    instructions,
+                    instruction_num,
+                    thres1,
+                    image_file,
+                    False,
+                    parse,
+                    run_blocking,
+                    partial(progress, picture=i),
+                    request_ids[i],
+                    task_json,
+                    memo,
+                )
+            except Exception as e:
+                # Parses already made are kept, later pictures just don't have this one as history
+                print(f"Parsing picture {i} failed: {e}")
+                failures[i] = f"parse failed: {type(e).__name__}: {e}"
+                valid_actions, action = False, ""
+            actions.append(action if valid_actions else "")
+            if valid_actions:
+                detection = asyncio.ensure_future(
+                    run_blocking(
+                        detect_object_from_prompt,
+                        detector,
+                        prompt,
+                        image_file,
+                        thres1,
+                        thres2,
+                        request_ids[i],
+                        memo,
+                        appearance,
+                        instruction_num,
+                    )
+                )
+                if memo is not None:
+                    detection.add_done_callback(lambda _, memo=memo: memo.clear())
+                detections.append(detection)
+            else:
+                if memo is not None:
+                    memo.clear()
+                detections.append(None)
+    finally:
+        # Images can't be deleted by the caller until detections using them are done
+        centers = await asyncio.gather(
+            *(detection for detection in detections if detection is not None),
+            return_exceptions=True,
+        )
+
+    report_inference_memo(*memos)
+    for center in centers:
+        # Cancelled or interrupted, not a failed detection
+        if isinstance(center, BaseException) and not isinstance(center, Exception):
+            raise center
+    centers = iter(centers)
+    results = []
+    for i, (detection, action) in enumerate(zip(detections, actions)):
+        center = next(centers) if detection is not None else None
+        if isinstance(center, Exception):
+            print(f"Detection of picture {i} failed: {center}")
+            failures[i] = f"detection failed: {type(center).__name__}: {center}"
+            center = None
+        progress("detection", picture=i, center=center, error=failures[i])
+        results.append((center, action) if center is not None else (None, ""))
+    if errors is not None:
+        errors.extend(failures)
+    return task_json, results
+
+
+def ingest_instructions(
+    detector: ObjectDetectionInterface,
+    instructions: list[str],
+    pictures: list[tuple[int, str]],
+    thres1: float,
+    thres2: float,
+    progress=no_progress,
+    request_ids: list[str] = None,
+    appearance: AppearanceMemory = None,
+    errors: list = None,
+    detection_lock=nullcontext(),
+) -> list[tuple[tuple[float, float], str]]:
+    """Parse and detect every picture of a task (see ingest_instructions_async), then write the results to the
+    parser output file in one write.
+
+    Instructions with pictures replace their parsed output, other instructions in the file are kept (and given
+    to GPT as history).
+
+    Args:
+    - errors: If given, filled with the error of each picture (None if it didn't fail)
+    - detection_lock: Held during each detection (not during GPT calls), when detector is shared between threads
+
+    Returns:
+    - (center, action) of each picture, (None, "") if not found or failed
+    """
+    ingested = {str(instruction_num) for instruction_num, _ in pictures}
+    kept = {
+        num: output for num, output in load_output_file().items() if num not in ingested
+    }
+    # One detection thread, the detector holds per-detection state
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        task_json, results = asyncio.run(
+            ingest_instructions_async(
+                detector,
+                instructions,
+                pictures,
+                thres1,
+                thres2,
+                parse=partial(run_inline, parse_instruction),
+                run_blocking=locked(executor_dispatcher(executor), detection_lock),
+                progress=progress,
+                request_ids=request_ids,
+                appearance=appearance,
+                task_json=kept,
+                errors=errors,
+            )
+        )
+    # Instructions in order, history is read in file order
+    save_output_file(dict(sorted(task_json.items(), key=lambda item: int(item[0]))))
+    return results
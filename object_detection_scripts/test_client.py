@@ -1,6 +1,7 @@
 import requests
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 def send_test_image():
@@ -93,6 +94,82 @@ def detection_only_test():
         print(response2.text)
 
 
+def batch_detection_test():
+    """Send all pictures of an instruction in one request (user mode)."""
+    DETECTOR_URL = "http://172.21.134.52:5000/upload_images"
+    GET_INSTRUCTION_URL = "http://172.21.134.52:5000/get_instructions"
+
+    response = requests.get(GET_INSTRUCTION_URL)
+    print(response.text)
+
+    filepath1 = os.path.join("data", "office_test", "bottle.jpg")
+    filepath2 = os.path.join("data", "office_test", "shelf.jpg")
+    files = [
+        ("image", open(filepath1, "rb")),
+        ("image", open(filepath2, "rb")),
+    ]
+
+    response = requests.post(
+        DETECTOR_URL,
+        data={"instructionNum": 0, "pictureNum": [0, 1]},
+        files=files,
+    )
+    print(response.text)
+
+
+def throughput_test(num_requests: int = 50, concurrency: int = 8):
+    """Send many detection requests at once (user mode) and report sustained throughput."""
+    DETECTOR_URL = "http://172.21.134.52:5000/upload_image"
+    filepath = os.path.join("data", "office_test", "bottle.jpg")
+
+    def send(_):
+        begin = time.time()
+        with open(filepath, "rb") as img_file:
+            requests.post(
+                DETECTOR_URL,
+                data={"instructionNum": 0, "pictureNum": 0},
+                files={"image": img_file},
+            )
+        return time.time() - begin
+
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(send, range(num_requests)))
+    total = time.time() - begin
+
+    print(
+        f"{num_requests / total:.2f} requests/s with {concurrency} concurrent clients"
+    )
+    print(
+        f"median latency {latencies[len(latencies) // 2]:.2f} s, max {latencies[-1]:.2f} s"
+    )
+
+
+def prefetch_test():
+    """Send the same frame for consecutive pictures (user mode), later ones should be prefetch hits.
+
+    Server needs PREFETCH_ENABLED.
+    """
+    DETECTOR_URL = "http://172.21.134.52:5000/upload_image"
+    METRICS_URL = "http://172.21.134.52:5000/metrics"
+    filepath = os.path.join("data", "office_test", "shelf.jpg")
+
+    for picture_num in range(2):
+        begin = time.time()
+        with open(filepath, "rb") as img_file:
+            response = requests.post(
+                DETECTOR_URL,
+                data={"instructionNum": 0, "pictureNum": picture_num},
+                files={"image": img_file},
+            )
+        print(response.text)
+        print(f"{time.time() - begin} seconds")
+        # Give prefetch time to finish before the next picture
+        time.sleep(5)
+
+    print(requests.get(METRICS_URL).text)
+
+
 def gpt_only_test():
     INSTRUCTION_URL = "http://172.21.134.52:5000/parse_instruction"
     GET_INSTRUCTION_URL = "http://172.21.134.52:5000/new_instructions"
@@ -132,6 +209,29 @@ def gpt_only_test():
     )
 
 
+def parse_job_test():
+    """Submit instruction parsing as a job, then follow its progress events until it finishes."""
+    JOB_URL = "http://172.21.134.52:5000/parse_instruction_job"
+    JOB_EVENTS_URL = "http://172.21.134.52:5000/jobs/{}/events"
+    GET_INSTRUCTION_URL = "http://172.21.134.52:5000/new_instructions"
+
+    response = requests.get(GET_INSTRUCTION_URL)
+    print(response.text)
+
+    filepath = os.path.join("data", "office_test", "bottle.jpg")
+    file = {"image": open(filepath, "rb")}
+    response = requests.post(
+        JOB_URL, data={"instructionNum": 0, "pictureNum": 0}, files=file
+    )
+    print(response.text)
+    job_id = response.json()["jobId"]
+
+    with requests.get(JOB_EVENTS_URL.format(job_id), stream=True) as events:
+        for line in events.iter_lines(decode_unicode=True):
+            if line.startswith("data:"):
+                print(line[len("data:") :].strip())
+
+
 def send_test():
     begin = time.time()
     URL = "http://172.21.134.52:5000/test_hello"
@@ -140,6 +240,20 @@ def send_test():
     print(f"{time.time() - begin} seconds")
 
 
+def router_test():
+    """Send a request through router.py (python router.py --nodes ...), it should reach a detection server."""
+    ROUTER_URL = "http://172.21.134.52:5000"
+
+    response = requests.get(f"{ROUTER_URL}/router/status")
+    print(response.text)
+    response = requests.get(
+        f"{ROUTER_URL}/test_hello", headers={"X-Session-Id": "router_test"}
+    )
+    print(response.text)
+    assert response.status_code == 200, "request didn't reach a detection server"
+    assert response.json() == {"test": "hello"}, "unexpected response from router"
+
+
 def update_output_test():
     # prereq: Run test (send_test_image) on same set of instructions
     DETECTOR_URL = "http://172.21.134.52:5000/upload_image"
@@ -192,3 +306,4 @@ if __name__ == "__main__":
     # detection_only_test()
 
     # send_test()
+    # router_test()
@@ -0,0 +1,314 @@
+"""Offline sweep of GroundingDINO box/text thresholds without re-running the model.
+
+Raw (unthresholded) logits and boxes of every query are computed once per image/caption and cached. Each
+threshold combination is then applied to the cached outputs with vectorized tensor ops, reporting for each one:
+- detection rate: fraction of cases with any box above the box threshold
+- accuracy: fraction of cases where the selected box center is inside the expected box (or, for cases without
+  one, within --center-tolerance pixels of the center selected at the --reference thresholds)
+- mean boxes and mean crop area: boxes kept and area of the region containing them (fraction of the image),
+  which is what the second (cropped) pass runs on
+- phrase rate: fraction of kept boxes with a phrase above the text threshold
+
+Box selection is the same as ObjectDetectionInterface._determine_best_box (drop boxes containing another kept
+box's center, then highest confidence), except boxes are dropped all at once instead of one by one.
+
+Cases file is a JSON list of {"image": path, "prompt": str, "expected": [x1, y1, x2, y2] (optional)}.
+
+Example: python threshold_sweep.py cases.json --box-thresholds 0.05:0.5:0.01 --text-thresholds 0.05:0.5:0.05
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+import torch
+
+from object_detection import ObjectDetection, RawDetection
+
+# [CLS], [SEP], and '.' in GroundingDINO's tokenizer (bert-base-uncased), not part of any phrase
+SPECIAL_TOKEN_IDS = {101, 102, 1012}
+
+
+def cache_key(image_path: str, prompt: str) -> str:
+    """SHA-1 of image contents and prompt."""
+    digest = hashlib.sha1()
+    with open(image_path, "rb") as file:
+        digest.update(file.read())
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_raw_detections(cases: list[dict], cache_dir: str) -> list[RawDetection]:
+    """Raw model output for each case, from cache_dir or by running the model (and caching it)."""
+    os.makedirs(cache_dir, exist_ok=True)
+    detector = None
+    raw_detections = []
+    for case in cases:
+        key = cache_key(case["image"], case["prompt"])
+        path = os.path.join(cache_dir, key + ".pt")
+        if os.path.exists(path):
+            cached = torch.load(path)
+            raw_detections.append(
+                RawDetection(
+                    cached["logits"].float(),
+                    cached["boxes"],
+                    cached["token_ids"],
+                    tuple(cached["original_size"]),
+                )
+            )
+            continue
+
+        if detector is None:
+            # Only load model if something isn't cached
+            detector = ObjectDetection()
+        detector.setup_new_detection()
+        images = detector._get_image(case["image"])
+        # Threshold doesn't matter, raw outputs are before thresholds
+        detector._model_inference(images, case["prompt"], 1.0, keep_raw=True)
+        detector._release_model_image(images)
+        raw = detector.raw_outputs[0]
+        torch.save(
+            {
+                # Half precision is plenty for confidences and halves the cache size
+                "logits": raw.logits.half(),
+                "boxes": raw.boxes,
+                "token_ids": raw.token_ids,
+                "original_size": raw.original_size,
+            },
+            path,
+        )
+        raw_detections.append(raw)
+    return raw_detections
+
+
+def sweep_case(
+    raw: RawDetection,
+    box_thresholds: torch.Tensor,
+    text_thresholds: torch.Tensor,
+) -> dict[str, torch.Tensor]:
+    """Apply every threshold combination to one case's raw output.
+
+    Returns:
+    - 'count' (B,): boxes kept for each box threshold
+    - 'crop_area' (B,): area of region containing kept boxes as fraction of the image, 0 if none
+    - 'center' (B, 2): selected box center in original image pixels, NaN if none
+    - 'phrased' (B, T): kept boxes with a phrase for each box and text threshold
+    """
+    confidences = raw.logits.max(dim=1)[0]
+    # Only queries above the lowest box threshold can ever be kept
+    candidates = confidences > box_thresholds.min()
+    confidences = confidences[candidates]
+    logits = raw.logits[candidates]
+    if len(confidences) == 0:
+        return {
+            "count": torch.zeros(len(box_thresholds), dtype=torch.long),
+            "crop_area": torch.zeros(len(box_thresholds)),
+            "center": torch.full((len(box_thresholds), 2), float("nan")),
+            "phrased": torch.zeros(
+                len(box_thresholds), len(text_thresholds), dtype=torch.long
+            ),
+        }
+
+    word_positions = [
+        i
+        for i, token_id in enumerate(raw.token_ids)
+        if token_id not in SPECIAL_TOKEN_IDS
+    ]
+    if len(word_positions) > 0:
+        word_confidences = logits[:, word_positions].max(dim=1)[0]
+    else:
+        word_confidences = torch.zeros(len(logits))
+
+    width, height = raw.original_size
+    boxes = raw.boxes[candidates] * torch.tensor([width, height, width, height])
+    x, y, w, h = boxes.unbind(dim=1)
+    x1, y1, x2, y2 = x - w / 2, y - h / 2, x + w / 2, y + h / 2
+
+    # (B, Q) which queries are kept at each box threshold
+    kept = confidences[None, :] > box_thresholds[:, None]
+    count = kept.sum(dim=1)
+
+    inf = torch.tensor(float("inf"))
+    region_x1 = torch.where(kept, x1, inf).min(dim=1)[0]
+    region_y1 = torch.where(kept, y1, inf).min(dim=1)[0]
+    region_x2 = torch.where(kept, x2, -inf).max(dim=1)[0]
+    region_y2 = torch.where(kept, y2, -inf).max(dim=1)[0]
+    crop_area = (region_x2 - region_x1) * (region_y2 - region_y1) / (width * height)
+    crop_area = torch.where(count > 0, crop_area, torch.zeros_like(crop_area))
+
+    # (Q, Q) query i's box contains query j's center
+    contains = (
+        (x1[:, None] < x[None, :])
+        & (x[None, :] < x2[:, None])
+        & (y1[:, None] < y[None, :])
+        & (y[None, :] < y2[:, None])
+    )
+    contains.fill_diagonal_(False)
+    # (B, Q) kept boxes that contain another kept box's center
+    contains_kept = (kept[:, None, :] & contains[None, :, :]).any(dim=2)
+    survivors = kept & ~contains_kept
+    # Boxes containing each other can all be dropped, fall back to every kept box
+    survivors = torch.where(survivors.any(dim=1, keepdim=True), survivors, kept)
+
+    best = torch.where(survivors, confidences[None, :], -inf).argmax(dim=1)
+    center = torch.stack([x[best], y[best]], dim=1)
+    center = torch.where((count > 0)[:, None], center, float("nan"))
+
+    # (T, Q) queries with a phrase at each text threshold
+    phrased_queries = word_confidences[None, :] > text_thresholds[:, None]
+    phrased = (kept[:, None, :] & phrased_queries[None, :, :]).sum(dim=2)
+
+    return {
+        "count": count,
+        "crop_area": crop_area,
+        "center": center,
+        "phrased": phrased,
+    }
+
+
+def is_correct(
+    center: torch.Tensor, expected: torch.Tensor, center_tolerance: float
+) -> torch.Tensor:
+    """(B,) whether each center is inside expected box (x1, y1, x2, y2) or near expected center (x, y)."""
+    if len(expected) == 4:
+        x1, y1, x2, y2 = expected
+        return (
+            (x1 <= center[:, 0])
+            & (center[:, 0] <= x2)
+            & (y1 <= center[:, 1])
+            & (center[:, 1] <= y2)
+        )
+    return (center - expected).norm(dim=1) <= center_tolerance
+
+
+def sweep(
+    cases: list[dict],
+    raw_detections: list[RawDetection],
+    box_thresholds: torch.Tensor,
+    text_thresholds: torch.Tensor,
+    reference: tuple[float, float],
+    center_tolerance: float,
+) -> list[dict]:
+    """Results of every (box threshold, text threshold) combination over all cases."""
+    num_box, num_text = len(box_thresholds), len(text_thresholds)
+    detected = torch.zeros(num_box)
+    correct = torch.zeros(num_box)
+    total_boxes = torch.zeros(num_box)
+    total_crop_area = torch.zeros(num_box)
+    total_phrased = torch.zeros(num_box, num_text)
+
+    for case, raw in zip(cases, raw_detections):
+        result = sweep_case(raw, box_thresholds, text_thresholds)
+        if case.get("expected") is not None:
+            expected = torch.tensor(case["expected"], dtype=torch.float32)
+        else:
+            # No label, compare with center selected at reference thresholds
+            reference_result = sweep_case(
+                raw, torch.tensor([reference[0]]), torch.tensor([reference[1]])
+            )
+            expected = reference_result["center"][0]
+
+        detected += (result["count"] > 0).float()
+        correct += is_correct(result["center"], expected, center_tolerance).float()
+        total_boxes += result["count"]
+        total_crop_area += result["crop_area"]
+        total_phrased += result["phrased"]
+
+    rows = []
+    for i, box_threshold in enumerate(box_thresholds.tolist()):
+        for j, text_threshold in enumerate(text_thresholds.tolist()):
+            rows.append(
+                {
+                    "box_threshold": round(box_threshold, 4),
+                    "text_threshold": round(text_threshold, 4),
+                    "detection_rate": detected[i].item() / len(cases),
+                    "accuracy": correct[i].item() / len(cases),
+                    "mean_boxes": total_boxes[i].item() / len(cases),
+                    "mean_crop_area": total_crop_area[i].item() / len(cases),
+                    "phrase_rate": (
+                        total_phrased[i, j].item() / total_boxes[i].item()
+                        if total_boxes[i] > 0
+                        else 0.0
+                    ),
+                }
+            )
+    return rows
+
+
+def parse_range(text: str) -> torch.Tensor:
+    """'start:stop:step' (stop included) or comma-separated values."""
+    if ":" in text:
+        start, stop, step = (float(value) for value in text.split(":"))
+        return torch.arange(start, stop + step / 2, step)
+    return torch.tensor([float(value) for value in text.split(",")])
+
+
+def print_report(rows: list[dict], reference: tuple[float, float]):
+    columns = list(rows[0].keys())
+    print("".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print("".join(f"{row[column]:>16.3f}" for column in columns))
+
+    reference_row = min(
+        rows,
+        key=lambda row: abs(row["box_threshold"] - reference[0])
+        + abs(row["text_threshold"] - reference[1]),
+    )
+    holding = [row for row in rows if row["accuracy"] >= reference_row["accuracy"]]
+    cheapest = min(holding, key=lambda row: row["mean_crop_area"])
+    print(
+        f"\nReference ({reference_row['box_threshold']}, {reference_row['text_threshold']}): "
+        f"accuracy {reference_row['accuracy']:.3f}, crop area {reference_row['mean_crop_area']:.3f}"
+    )
+    print(
+        f"Smallest crop area at same or better accuracy: box {cheapest['box_threshold']}, "
+        f"text {cheapest['text_threshold']} (accuracy {cheapest['accuracy']:.3f}, "
+        f"crop area {cheapest['mean_crop_area']:.3f})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", help="JSON file of cases")
+    parser.add_argument("--cache-dir", default="threshold_cache")
+    parser.add_argument("--box-thresholds", default="0.05:0.5:0.01")
+    parser.add_argument("--text-thresholds", default="0.05:0.5:0.05")
+    parser.add_argument(
+        "--reference",
+        type=float,
+        nargs=2,
+        default=(0.2, 0.2),
+        help="Current (box, text) thresholds, used as accuracy baseline and for unlabeled cases",
+    )
+    parser.add_argument("--center-tolerance", type=float, default=10.0)
+    parser.add_argument("--csv", help="Write all results to this CSV file")
+    args = parser.parse_args()
+
+    with open(args.cases, "r") as file:
+        cases = json.load(file)
+    raw_detections = load_raw_detections(cases, args.cache_dir)
+
+    box_thresholds = parse_range(args.box_thresholds)
+    text_thresholds = parse_range(args.text_thresholds)
+    begin = time.time()
+    rows = sweep(
+        cases,
+        raw_detections,
+        box_thresholds,
+        text_thresholds,
+        tuple(args.reference),
+        args.center_tolerance,
+    )
+    print(
+        f"Swept {len(rows)} threshold combinations over {len(cases)} cases in {time.time() - begin:.2f} s\n"
+    )
+    print_report(rows, tuple(args.reference))
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)